@@ -1,6 +1,11 @@
 from chatmessage import ChatMessages
 from IPython.display import display, Markdown
 from response import *
+from async_response import async_get_chat_response
+from model_profiles import get_tokens_threshold
+from agent_loop import AgentRun
+from policies import InteractivePolicy
+from sql_timeout import query_timeout
 
 
 class MateGen:
@@ -10,7 +15,14 @@ class MateGen:
                  system_content_list=None,
                  project=None,
                  messages=None,
-                 available_functions=None):
+                 available_functions=None,
+                 trim_policy=None,
+                 stream=False,
+                 budget=None,
+                 policy=None,
+                 router=None,
+                 schema_context=None,
+                 query_timeout=None):
         """
         Initializes the MateGen class to interact with OpenAI models.
 
@@ -20,26 +32,46 @@ class MateGen:
         :param project: Optional, an InterProject object for associating the conversation with a specific project.
         :param messages: Optional, a ChatMessages object or a list of dictionaries representing conversation history.
         :param available_functions: Optional, an AvailableFunction object representing external functions for the conversation.
+        :param trim_policy: Optional, a TrimPolicy object deciding which messages are dropped when the conversation exceeds the token limit.
+        :param stream: Optional, whether to stream the model's answers and render them as they arrive. Defaults to False.
+        :param budget: Optional, a StepBudget object limiting the steps, tokens and wall time of each question. Defaults to StepBudget().
+        :param policy: Optional, a ConversationPolicy object making the choices a user would otherwise type in (plan reviews, follow-up questions).
+                       Defaults to InteractivePolicy(); pass an AutoApprovePolicy to run headless.
+        :param router: Optional, a QuestionRouter classifying each question locally, so that only multi-step questions go through
+                       the task decomposition round trip; the function schemas are sent on every route. Defaults to None.
+        :param schema_context: Optional, a SchemaContext object. Each question is then sent with a system message describing only the
+                               tables and columns it is about, in place of a static data dictionary in system_content_list. Defaults to None.
+        :param query_timeout: Optional, the timeout in seconds of the SQL queries run for this session (0 for none). A query still running after it
+                              is cancelled on the server and the model is told to rewrite it. Defaults to MATEGEN_SQL_TIMEOUT (60 seconds).
         """
 
         self.api_key = api_key
         self.model = model
         self.project = project
         self.system_content_list = system_content_list if system_content_list is not None else []
-
-        # Set the token threshold depending on the model
-        if '1106' in model:
-            self.tokens_thr = 110000
-        elif '16k' in model:
-            self.tokens_thr = 12000
-        elif '4-0613' in model:
-            self.tokens_thr = 7000
-        else:
-            self.tokens_thr = 3000
+        self.trim_policy = trim_policy
+        self.stream = stream
+        self.budget = budget
+        self.policy = policy if policy is not None else InteractivePolicy()
+        self.router = router
+        self.schema_context = schema_context
+        if query_timeout is not None and query_timeout < 0:
+            raise ValueError(f"Invalid query timeout: {query_timeout}")
+        self.query_timeout = query_timeout
+        # Step trace of the last question, an AgentRun object
+        self.last_run = None
+        # Variables of the external functions (DataFrames of extract_data, python_inter variables), kept across questions
+        # and apart from those of the other sessions
+        self.namespace = new_namespace()
+
+        # Set the token threshold from the model's context window, leaving room for the answer and the function schemas
+        self.tokens_thr = get_tokens_threshold(model, available_functions.functions if available_functions else None)
 
         # Initialize message history
         self.messages = ChatMessages(system_content_list=self.system_content_list,
-                                     tokens_thr=self.tokens_thr)
+                                     tokens_thr=self.tokens_thr,
+                                     model=self.model,
+                                     trim_policy=self.trim_policy)
 
         # Append any initial messages provided
         if messages:
@@ -47,6 +79,43 @@ class MateGen:
 
         self.available_functions = available_functions
 
+    def _add_question(self, question):
+        # The schema summary of the question goes in first, so that trimming never drops the question for it
+        if self.schema_context is not None:
+            try:
+                self.messages.set_context_message(self.schema_context.render(question))
+            except Exception as e:
+                print(f"Schema summary unavailable, the question is sent without it: {e}")
+                self.messages.set_context_message(None)
+        self.messages.messages_append({"role": "user", "content": question})
+
+    def _new_run(self):
+        self.last_run = AgentRun(self.budget)
+        return self.last_run
+
+    # The SQL tools called while answering run under the query timeout of this session
+    def _get_response(self):
+        with query_timeout(self.query_timeout):
+            return get_chat_response(model=self.model,
+                                     messages=self.messages,
+                                     available_functions=self.available_functions,
+                                     stream=self.stream,
+                                     run=self._new_run(),
+                                     policy=self.policy,
+                                     router=self.router,
+                                     namespace=self.namespace)
+
+    async def _aget_response(self):
+        with query_timeout(self.query_timeout):
+            return await async_get_chat_response(model=self.model,
+                                                 messages=self.messages,
+                                                 available_functions=self.available_functions,
+                                                 stream=self.stream,
+                                                 run=self._new_run(),
+                                                 policy=self.policy,
+                                                 router=self.router,
+                                                 namespace=self.namespace)
+
     def chat(self, question=None):
         """
         Handles the conversation with the model, supporting both single-round and multi-round interactions.
@@ -57,28 +126,59 @@ class MateGen:
 
         # Single round mode if a question is provided
         if question:
-            self.messages.messages_append({"role": "user", "content": question})
-            self.messages = get_chat_response(model=self.model,
-                                              messages=self.messages,
-                                              available_functions=self.available_functions,)
+            self._add_question(question)
+            self.messages = self._get_response()
         else:
             # Multi-round mode for ongoing conversations
             while True:
-                self.messages = get_chat_response(model=self.model,
-                                                  messages=self.messages,
-                                                  available_functions=self.available_functions)
+                self.messages = self._get_response()
 
-                user_input = input("Do you have any other questions? (Type 'exit' to finish) ")
-                if user_input.lower() == "exit":
+                user_input = self.policy.next_question(self.messages)
+                if user_input is None:
                     break
                 else:
-                    self.messages.messages_append({"role": "user", "content": user_input})
+                    self._add_question(user_input)
+
+    async def achat(self, question):
+        """
+        Async single-round conversation. Many MateGen sessions can run concurrently on one event loop, e.g. with
+        asyncio.gather inside an async_response.openai_session() block, which pools the HTTP connections.
+
+        :param question: The question to be answered.
+        :return: The updated ChatMessages object.
+        """
+        self._add_question(question)
+        self.messages = await self._aget_response()
+        return self.messages
+
+    def run_batch(self, questions, reset=True):
+        """
+        Answers a queue of questions unattended. Use it with a headless policy such as AutoApprovePolicy,
+        so that no step waits for input().
+
+        :param questions: An iterable of questions.
+        :param reset: Optional, whether each question starts from a fresh conversation. Defaults to True.
+        :return: A list with, for each question, a dict holding the question, the final answer and the step trace summary.
+        """
+        results = []
+        for question in questions:
+            if reset:
+                self.reset()
+            self._add_question(question)
+            self.messages = self._get_response()
+            last_message = self.messages.history_messages[-1] if self.messages.history_messages else None
+            answer = last_message["content"] if last_message is not None and last_message["role"] == "assistant" else None
+            results.append({"question": question, "answer": answer, "run": self.last_run.summary()})
+        return results
 
     def reset(self):
         """
         Resets the current conversation history.
         """
-        self.messages = ChatMessages(system_content_list=self.system_content_list)
+        self.messages = ChatMessages(system_content_list=self.system_content_list,
+                                     tokens_thr=self.tokens_thr,
+                                     model=self.model,
+                                     trim_policy=self.trim_policy)
 
     def upload_messages(self):
         """
@@ -87,7 +187,7 @@ class MateGen:
         if self.project is None:
             print("Please provide a valid InterProject object for the project parameter before uploading messages.")
         else:
-            self.project.append_doc_content(content=self.messages.history_messages)
+            self.project.append_doc_content(content=[msg.to_dict() for msg in self.messages.history_messages])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+from tokenizer import count_tokens
+
+# States of the conversation driver in response.get_chat_response
+CALL_MODEL = 'call_model'  # Ask the model for the next message
+FUNCTION_CALL = 'function_call'  # Execute the external function(s) the model asked for
+TEXT_ANSWER = 'text_answer'  # Show a text answer and, for a task decomposition, let the user review it
+DONE = 'done'
+
+DEFAULT_MAX_STEPS = int(os.getenv('MATEGEN_MAX_STEPS', 30))
+
+
+class StepBudget:
+    """
+    Limits on one conversation session: how many steps the driver may run, how many tokens the model calls may use
+    and how long the session may take. A limit of None means unlimited.
+    """
+
+    def __init__(self, max_steps=DEFAULT_MAX_STEPS, max_tokens=None, max_seconds=None):
+        """
+        :param max_steps: Optional parameter, the maximum number of steps (model calls, function calls and reviews), default is 30.
+        :param max_tokens: Optional parameter, the maximum number of prompt plus completion tokens of all model calls, default is None.
+        :param max_seconds: Optional parameter, the maximum wall time of the session in seconds, default is None.
+        """
+        for name, value in (("max_steps", max_steps), ("max_tokens", max_tokens), ("max_seconds", max_seconds)):
+            if value is not None and value <= 0:
+                raise ValueError(f"Invalid {name}: {value}")
+        self.max_steps = max_steps
+        self.max_tokens = max_tokens
+        self.max_seconds = max_seconds
+
+    def __repr__(self):
+        return f"StepBudget(max_steps={self.max_steps}, max_tokens={self.max_tokens}, max_seconds={self.max_seconds})"
+
+
+class StepRecord:
+    """
+    Timing and token usage of one step of the driver.
+    """
+
+    __slots__ = ('index', 'state', 'llm_seconds', 'tool_seconds', 'prompt_tokens', 'completion_tokens', 'seconds')
+
+    def __init__(self, index, state):
+        self.index = index
+        self.state = state
+        self.llm_seconds = 0.0
+        self.tool_seconds = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.seconds = 0.0
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"StepRecord({self.to_dict()})"
+
+
+class AgentRun:
+    """
+    Trace of one conversation session: the budget it runs under, one StepRecord per step,
+    and the reason it stopped early if the budget ran out.
+    """
+
+    def __init__(self, budget=None):
+        """
+        :param budget: Optional parameter, a StepBudget object, default is StepBudget().
+        """
+        self.budget = budget if budget is not None else StepBudget()
+        self.steps = []
+        self.start = time.perf_counter()
+        self.end = None
+        self.stop_reason = None
+        self.num_revisions = 0  # Times a task decomposition was sent back for modification
+        self.route = None  # Route chosen by the QuestionRouter, if the session was routed
+
+    # Method to open the record of a new step
+    def start_step(self, state):
+        step = StepRecord(len(self.steps), state)
+        step.seconds = time.perf_counter()
+        self.steps.append(step)
+        return step
+
+    # Method to close the record of a step
+    def end_step(self, step):
+        step.seconds = time.perf_counter() - step.seconds
+
+    @property
+    def total_tokens(self):
+        return sum(step.prompt_tokens + step.completion_tokens for step in self.steps)
+
+    @property
+    def elapsed(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def check_budget(self):
+        """
+        :return: A description of the exhausted limit, or None if the session may run another step.
+        """
+        budget = self.budget
+        if budget.max_steps is not None and len(self.steps) >= budget.max_steps:
+            return f"reached the maximum of {budget.max_steps} steps"
+        if budget.max_tokens is not None and self.total_tokens >= budget.max_tokens:
+            return f"used {self.total_tokens} of {budget.max_tokens} tokens"
+        if budget.max_seconds is not None and self.elapsed >= budget.max_seconds:
+            return f"ran for more than {budget.max_seconds} seconds"
+        return None
+
+    # Method to stop the session early and tell the user why
+    def stop(self, reason):
+        self.stop_reason = reason
+        print(f"Stopping the conversation: {reason}.")
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    def summary(self):
+        """
+        :return: A dict with the number of steps, the model and function time, the tokens, the route, the wall time and the stop reason.
+        """
+        return {"steps": len(self.steps),
+                "llm_seconds": round(sum(step.llm_seconds for step in self.steps), 3),
+                "tool_seconds": round(sum(step.tool_seconds for step in self.steps), 3),
+                "prompt_tokens": sum(step.prompt_tokens for step in self.steps),
+                "completion_tokens": sum(step.completion_tokens for step in self.steps),
+                "revisions": self.num_revisions,
+                "route": self.route,
+                "seconds": round(self.elapsed, 3),
+                "stop_reason": self.stop_reason}
+
+
+def count_completion_tokens(message, model="gpt-3.5-turbo"):
+    """
+    Counts the tokens the model generated for a message: its content, or the names and arguments of its function calls.
+    :param message: Required parameter, the assistant message.
+    :param model: Optional parameter, the name of the model, default is 'gpt-3.5-turbo'.
+    :return: The number of tokens.
+    """
+    text = message.get("content") or ""
+    for function_call in message_function_calls(message):
+        text += (function_call.get("name") or "") + (function_call.get("arguments") or "")
+    return count_tokens(text, model) if text else 0
+
+
+def message_function_calls(message):
+    """
+    :param message: Required parameter, an assistant message.
+    :return: The list of function calls of the message: its function_call, or the function of each of its tool_calls.
+    """
+    if message.get("tool_calls"):
+        return [tool_call["function"] for tool_call in message["tool_calls"]]
+    if message.get("function_call"):
+        return [message["function_call"]]
+    return []
+
+
+def parse_function_arguments(function_call_message):
+    """
+    Parses the arguments of a function call message.
+    :param function_call_message: Required parameter, a message containing a function call.
+    :return: The arguments dict, or None if the model wrote invalid JSON.
+    """
+    try:
+        return json.loads(function_call_message["function_call"]["arguments"])
+    except (ValueError, TypeError):
+        return None
+
+
+def apply_review_choice(messages, text_answer_message, choice, new_user_content=None):
+    """
+    Applies the user's review of a task decomposition to the conversation.
+    :param messages: Required parameter, the ChatMessages object of the session.
+    :param text_answer_message: Required parameter, the message containing the proposed task decomposition.
+    :param choice: Required parameter, '1' to execute the plan, '2' to send modification feedback, '3' to ask a new question,
+    anything else to end the conversation.
+    :param new_user_content: Optional parameter, the feedback for choice '2' or the new question for choice '3'.
+    :return: The next state, whether the next model call is still a task decomposition,
+    and how many messages to delete after the next model call.
+    """
+    if choice == '1':
+        messages.messages_append(text_answer_message)
+        print("Okay, proceeding to execute the process step by step.")
+        messages.messages_append({"role": "user", "content": "Very well, please execute the process step by step."})
+        return CALL_MODEL, False, False
+
+    if choice == '2':
+        print("Okay, making modifications.")
+        messages.messages_append(text_answer_message)
+        messages.messages_append({"role": "user", "content": new_user_content})
+        # The draft and the feedback only serve the next decomposition and are removed once it has been created
+        return CALL_MODEL, True, 2
+
+    if choice == '3':
+        messages.set_message_content(-1, new_user_content)
+        return CALL_MODEL, True, False
+
+    print("Okay, exiting the current conversation.")
+    return DONE, False, False
+
+
+if __name__ == '__main__':
+    print("This file defines the step budget and the step trace of the conversation driver.")
@@ -0,0 +1,364 @@
+import os
+import time
+import asyncio
+import weakref
+import functools
+from contextlib import asynccontextmanager
+import aiohttp
+import openai
+from IPython.display import display, Markdown
+from planning import add_task_decomposition_prompt
+from response import new_namespace, function_to_call, tool_call_to_call, tool_call_batches, display_function_code, \
+    function_parameters, function_cache_parameters, get_tool_executor
+from model_profiles import get_model_profile, request_overhead_tokens, estimate_request_tokens
+from llm_backend import achat_completion
+from rate_limiter import acall_with_retries, get_rate_limiter
+from agent_loop import CALL_MODEL, FUNCTION_CALL, TEXT_ANSWER, DONE, AgentRun, count_completion_tokens, \
+    message_function_calls, parse_function_arguments, apply_review_choice
+from policies import InteractivePolicy, REVISE
+from router import route_session
+from sql_timeout import with_query_timeout
+from streaming import aconsume_stream, MarkdownStreamRenderer, render_message
+from response_cache import acached_chat_completion, get_response_cache, make_cache_key, response_cache_enabled, \
+    is_valid_chat_response
+
+# Maximum number of in-flight requests per model, shared by all sessions of the process
+DEFAULT_MODEL_CONCURRENCY = int(os.getenv('MATEGEN_MODEL_CONCURRENCY', 16))
+_model_concurrency = {}
+
+# asyncio primitives belong to one event loop, so semaphores are created per loop and per model
+_model_semaphores = weakref.WeakKeyDictionary()
+
+
+def set_model_concurrency(model, limit):
+    """
+    Sets how many requests to a model may be in flight at the same time across all sessions of the process.
+    :param model: Required parameter, the name of the model.
+    :param limit: Required parameter, the maximum number of concurrent requests.
+    """
+    if limit < 1:
+        raise ValueError(f"Invalid concurrency limit: {limit}")
+    _model_concurrency[model] = limit
+    for semaphores in _model_semaphores.values():
+        semaphores.pop(model, None)
+
+
+def _get_model_semaphore(model):
+    semaphores = _model_semaphores.setdefault(asyncio.get_running_loop(), {})
+    semaphore = semaphores.get(model)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(_model_concurrency.get(model, DEFAULT_MODEL_CONCURRENCY))
+        semaphores[model] = semaphore
+    return semaphore
+
+
+@asynccontextmanager
+async def openai_session(limit=100):
+    """
+    Opens a pooled aiohttp session and makes the openai library use it for every async request made inside the block,
+    so that concurrent sessions reuse connections instead of opening one per request.
+    :param limit: Optional parameter, the maximum number of pooled connections, default is 100.
+    """
+    connector = aiohttp.TCPConnector(limit=limit)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        token = openai.aiosession.set(session)
+        try:
+            yield session
+        finally:
+            openai.aiosession.reset(token)
+
+
+async def _run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # The tool threads run under the query timeout of the calling session
+    return await loop.run_in_executor(get_tool_executor(), functools.partial(with_query_timeout(func), *args, **kwargs))
+
+
+async def async_input(prompt):
+    """
+    Reads a line from the user without blocking the event loop.
+    :param prompt: Required parameter, the prompt to be shown.
+    :return: The line entered by the user.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, input, prompt)
+
+
+async def async_function_to_call(available_functions, function_call_message, namespace=None):
+    """
+    Async version of response.function_to_call; the external function runs on the tool thread pool.
+    :param available_functions: Required parameter, an AvailableFunctions object that describes the basic information of the current external functions.
+    :param function_call_message: Required parameter, a message representing an external function call.
+    :param namespace: Optional parameter, the namespace of the session passed to the function as `g`, default is None (the globals of response.py).
+    :return: `function_response_messages`, a message consisting of the external function's execution result.
+    """
+    return await _run_blocking(function_to_call,
+                               available_functions=available_functions,
+                               function_call_message=function_call_message,
+                               namespace=namespace)
+
+
+async def async_get_gpt_response(model,
+                                 messages,
+                                 available_functions=None,
+                                 stream=False):
+    """
+    Async version of response.get_gpt_response. The number of in-flight requests per model is limited by a semaphore
+    shared by all sessions of the event loop, on top of the model's shared RPM/TPM rate limiter. A streamed request
+    holds its place until the whole stream has been read.
+    :param model: Required parameter indicating the name of the large model to be called.
+    :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
+    :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.
+    Defaults to None, indicating no external functions.
+    :param stream: Optional parameter indicating whether to stream the response, rendering the text as it arrives, default is False.
+    :return: Returns the response message from the model.
+    """
+
+    functions = available_functions.functions if available_functions is not None else None
+    messages.fit(get_model_profile(model).input_budget - request_overhead_tokens(functions, model))
+
+    api_messages = messages.to_api_messages()
+    request_kwargs = {"model": model}
+    request_kwargs.update(function_parameters(available_functions))
+    if stream:
+        request_kwargs["stream"] = True
+
+    sent_at = []
+    semaphore = _get_model_semaphore(model)
+
+    async def request():
+        await semaphore.acquire()
+        try:
+            sent_at.append(time.perf_counter())
+            response = await achat_completion(messages=api_messages, **request_kwargs)
+        except BaseException:
+            semaphore.release()
+            raise
+        # The answer of a streamed request is still being generated: the semaphore is released once it is read
+        if not stream:
+            semaphore.release()
+        return response
+
+    estimated_tokens = estimate_request_tokens(messages, functions, model)
+
+    def limited_request():
+        return acall_with_retries(request, model=model, estimated_tokens=estimated_tokens)
+
+    if stream:
+        cache_key = make_cache_key(model, api_messages, *function_cache_parameters(request_kwargs)) \
+            if response_cache_enabled() else None
+        cached_response = get_response_cache().lookup(cache_key) if cache_key else None
+        if cached_response is not None:
+            response_message = cached_response["choices"][0]["message"]
+            render_message(response_message)
+            return response_message
+
+        response = await limited_request()
+        try:
+            response_message, stats = await aconsume_stream(response, model,
+                                                            renderer=MarkdownStreamRenderer(), start=sent_at[-1])
+        finally:
+            semaphore.release()
+        get_rate_limiter(model).record_usage(estimated_tokens, estimated_tokens + stats.completion_tokens)
+        response = {"choices": [{"message": response_message}]}
+        if cache_key and is_valid_chat_response(response):
+            get_response_cache().put(cache_key, response, stats.total_time)
+        return response_message
+
+    cache_functions, cache_function_call = function_cache_parameters(request_kwargs)
+    response = await acached_chat_completion(limited_request,
+                                             model=model,
+                                             messages=api_messages,
+                                             functions=cache_functions,
+                                             function_call=cache_function_call,
+                                             validate=is_valid_chat_response)
+
+    return response["choices"][0]["message"]
+
+
+async def async_model_step(model,
+                           messages,
+                           step,
+                           available_functions=None,
+                           delete_some_messages=False,
+                           is_task_decomposition=False,
+                           stream=False):
+    """
+    Async version of response.model_step.
+    """
+    request_messages = add_task_decomposition_prompt(messages) if is_task_decomposition else messages
+
+    start = time.perf_counter()
+    response_message = await async_get_gpt_response(model=model,
+                                                    messages=request_messages,
+                                                    available_functions=available_functions,
+                                                    stream=stream)
+    step.llm_seconds = time.perf_counter() - start
+    step.prompt_tokens = estimate_request_tokens(request_messages,
+                                                 available_functions.functions if available_functions else None,
+                                                 model)
+    step.completion_tokens = count_completion_tokens(response_message, model)
+
+    if delete_some_messages:
+        for i in range(delete_some_messages):
+            messages.messages_pop(manual=True, index=-1)
+
+    return response_message
+
+
+async def async_function_call_step(messages,
+                                   function_call_message,
+                                   step,
+                                   available_functions=None,
+                                   namespace=None):
+    """
+    Async version of response.function_call_step; the external functions run on the tool thread pool,
+    and the calls of thread-safe functions of one model turn run concurrently.
+    """
+    code_dicts = [parse_function_arguments({"function_call": function_call})
+                  for function_call in message_function_calls(function_call_message)]
+    if any(code_dict is None for code_dict in code_dicts):
+        print("JSON parsing error, recreating code...")
+        return CALL_MODEL
+
+    for code_dict in code_dicts:
+        display_function_code(code_dict)
+
+    start = time.perf_counter()
+    if function_call_message.get("tool_calls"):
+        function_response_messages = []
+        for batch in tool_call_batches(available_functions, function_call_message["tool_calls"]):
+            function_response_messages.extend(await asyncio.gather(
+                *(_run_blocking(tool_call_to_call, available_functions, tool_call, namespace) for tool_call in batch)))
+    else:
+        function_response_messages = [await async_function_to_call(available_functions=available_functions,
+                                                                   function_call_message=function_call_message,
+                                                                   namespace=namespace)]
+    step.tool_seconds = time.perf_counter() - start
+
+    messages.messages_append(function_call_message)
+    for function_response_message in function_response_messages:
+        messages.messages_append(function_response_message)
+
+    errors = [message["content"] for message in function_response_messages if "error" in message["content"]]
+    if errors:
+        for error in errors:
+            print(error)
+        return DONE
+
+    print("External function execution complete. Parsing the results...")
+    return CALL_MODEL
+
+
+async def async_text_answer_step(messages,
+                                 text_answer_message,
+                                 run,
+                                 is_task_decomposition=False,
+                                 stream=False,
+                                 policy=None):
+    """
+    Async version of response.text_answer_step. The interactive policy reads user input without blocking
+    the other sessions of the event loop.
+    """
+    if not stream:
+        print("Model's Answer:\n")
+        display(Markdown(text_answer_message["content"]))
+
+    if not is_task_decomposition:
+        messages.messages_append(text_answer_message)
+        return DONE, False, False
+
+    policy = policy if policy is not None else InteractivePolicy()
+    choice, new_user_content = await policy.areview_plan(text_answer_message, run.num_revisions)
+    if choice == REVISE:
+        run.num_revisions += 1
+
+    return apply_review_choice(messages, text_answer_message, choice, new_user_content)
+
+
+async def async_get_chat_response(model,
+                                  messages,
+                                  available_functions=None,
+                                  delete_some_messages=False,
+                                  is_task_decomposition=False,
+                                  stream=False,
+                                  budget=None,
+                                  run=None,
+                                  policy=None,
+                                  router=None,
+                                  namespace=None):
+    """
+    Async version of response.get_chat_response, responsible for executing a complete conversation session
+    with the same step-budgeted driver loop.
+    :param model: Required parameter indicating the name of the large model to be called.
+    :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
+    :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.
+    Defaults to None, indicating no external functions.
+    :param delete_some_messages: Optional parameter indicating whether to delete several intermediate messages when concatenating messages, default is False.
+    :param is_task_decomposition: Optional parameter indicating whether the current task is task decomposition review, default is False.
+    :param stream: Optional parameter indicating whether to stream the model's responses, default is False.
+    :param budget: Optional parameter, a StepBudget object limiting the steps, tokens and wall time of the session, default is StepBudget().
+    :param run: Optional parameter, an AgentRun object receiving the step trace of the session, default is a new one.
+    :param policy: Optional parameter, the ConversationPolicy making the review choices, default is InteractivePolicy() (asks the user).
+    :param router: Optional parameter, a QuestionRouter deciding before any model call whether the question is decomposed first;
+    the external functions are offered either way, default is None (no routing).
+    :param namespace: Optional parameter, the namespace in which the external functions run, e.g. MateGen.namespace,
+    so that concurrent sessions never share variables, default is a new one (see response.new_namespace()).
+    :return: Messages concatenating the final results of this Q&A session.
+    """
+
+    run = run if run is not None else AgentRun(budget)
+    namespace = namespace if namespace is not None else new_namespace()
+    # Only multi-step questions pay for the task decomposition round trip
+    if router is not None and not is_task_decomposition:
+        is_task_decomposition, available_functions = route_session(router, messages, available_functions, run)
+    state = CALL_MODEL
+    response_message = None
+
+    while state != DONE:
+        stop_reason = run.check_budget()
+        if stop_reason is not None:
+            run.stop(stop_reason)
+            break
+
+        step = run.start_step(state)
+
+        if state == CALL_MODEL:
+            response_message = await async_model_step(model=model,
+                                                      messages=messages,
+                                                      step=step,
+                                                      available_functions=available_functions,
+                                                      delete_some_messages=delete_some_messages,
+                                                      is_task_decomposition=is_task_decomposition,
+                                                      stream=stream)
+            if router is not None and is_task_decomposition:
+                router.record_decomposition(step.llm_seconds)
+            delete_some_messages = False
+            state = FUNCTION_CALL if message_function_calls(response_message) else TEXT_ANSWER
+
+        elif state == FUNCTION_CALL:
+            state = await async_function_call_step(messages=messages,
+                                                   function_call_message=response_message,
+                                                   step=step,
+                                                   available_functions=available_functions,
+                                                   namespace=namespace)
+            response_message = None
+
+        elif state == TEXT_ANSWER:
+            state, is_task_decomposition, delete_some_messages = await async_text_answer_step(
+                messages=messages,
+                text_answer_message=response_message,
+                run=run,
+                is_task_decomposition=is_task_decomposition,
+                stream=stream,
+                policy=policy)
+            response_message = None
+
+        run.end_step(step)
+
+    run.finish()
+    return messages
+
+
+if __name__ == '__main__':
+    print("This file contains the async versions of the functions used to get responses from LLM.")
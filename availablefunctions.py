@@ -13,7 +13,10 @@ class AvailableFunctions:
     It contains attributes for a list of external functions, descriptions of function parameters, and rules for function calls.
     """
 
-    def __init__(self, functions_list=None, functions=None, function_call="auto"):
+    def __init__(self, functions_list=None, functions=None, function_call="auto", parallel_tool_calls=False):
+        # Whether the model may request several function calls in one turn (sent as `tools` instead of `functions`)
+        self.parallel_tool_calls = parallel_tool_calls
+
         # Initialize with empty lists if no functions are provided
         self.functions_list = functions_list if functions_list is not None else []
         self.functions = functions if functions is not None else []
@@ -46,6 +49,23 @@ class AvailableFunctions:
         if function_call_update is not None:
             self.function_call = function_call_update
 
+    # Method to check whether an external function may run at the same time as other calls of the session,
+    # i.e. whether it is marked with `thread_safe = True` (such as the SQL tools)
+    def is_thread_safe(self, function_name):
+        return getattr(self.functions_dic.get(function_name), 'thread_safe', False) is True
+
+    # The function descriptions in the `tools` format used for parallel tool calls
+    @property
+    def tools(self):
+        return [{"type": "function", "function": function} for function in self.functions]
+
+    # The function_call rule in the `tool_choice` format used for parallel tool calls
+    @property
+    def tool_choice(self):
+        if isinstance(self.function_call, dict) and "name" in self.function_call:
+            return {"type": "function", "function": {"name": self.function_call["name"]}}
+        return self.function_call
+
 
 if __name__ == '__main__':
     print("This file defines the AvailableFunctions class.")
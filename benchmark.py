@@ -0,0 +1,918 @@
+import io
+import sys
+import time
+import contextlib
+import tracemalloc
+from chatmessage import ChatMessages
+from tokenizer import get_encoding, _encodings, TokenCache
+
+
+def time_per_call(func, repeat=200):
+    """
+    Measures the average wall time of a function call.
+    :param func: Required parameter, a callable without arguments to be timed.
+    :param repeat: Optional parameter, the number of times the callable is run, default is 200.
+    :return: The average time of one call in microseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def build_conversation(num_messages, system_content_list=None):
+    """
+    Builds a ChatMessages object holding `num_messages` alternating user and assistant messages.
+    :param num_messages: Required parameter, the number of conversation messages to create.
+    :param system_content_list: Optional parameter, a list of system documents, default is None.
+    :return: The ChatMessages object.
+    """
+    messages = ChatMessages(system_content_list=system_content_list, question="Question 0")
+    for i in range(1, num_messages):
+        role = "assistant" if i % 2 else "user"
+        messages.messages_append({"role": role, "content": f"Message {i} about the user_demographics table."})
+    return messages
+
+
+def benchmark_chat_messages(sizes=(1000, 10000)):
+    """
+    Measures the per-turn bookkeeping overhead of ChatMessages (append, pop and copy) for conversations of different sizes.
+    :param sizes: Optional parameter, the conversation sizes to measure, default is (1000, 10000).
+    """
+    with open('telco_data_dictionary.md', 'r', encoding='utf-8') as f:
+        data_dictionary = f.read()
+
+    print("ChatMessages per-turn overhead (microseconds)")
+    print(f"{'messages':>10} {'append+pop':>12} {'copy':>12} {'copy+append':>12}")
+    for size in sizes:
+        messages = build_conversation(size, system_content_list=[data_dictionary])
+        new_message = {"role": "user", "content": "How many records are in user_demographics?"}
+
+        def append_pop():
+            messages.messages_append(new_message)
+            messages.messages_pop(manual=True, index=-1)
+
+        def fork():
+            # A copy only pays for its own lists once it diverges from the original
+            messages.copy().messages_append(new_message)
+
+        append_pop_us = time_per_call(append_pop)
+        copy_us = time_per_call(messages.copy)
+        fork_us = time_per_call(fork, repeat=20)
+        print(f"{size:>10} {append_pop_us:>12.1f} {copy_us:>12.1f} {fork_us:>12.1f}")
+
+
+def benchmark_construction(model="gpt-3.5-turbo"):
+    """
+    Measures the cost of loading an encoder for the first time against the cost of constructing conversations once it is shared.
+    :param model: Optional parameter, the name of the model whose encoder is measured, default is 'gpt-3.5-turbo'.
+    """
+    _encodings.pop(model, None)
+    start = time.perf_counter()
+    get_encoding(model)
+    cold_ms = (time.perf_counter() - start) * 1e3
+
+    print("Encoder registry and ChatMessages construction")
+    print(f"{'first encoder load':<30} {cold_ms:>10.2f} ms")
+    print(f"{'shared encoder lookup':<30} {time_per_call(lambda: get_encoding(model), repeat=10000):>10.2f} us")
+    print(f"{'ChatMessages() construction':<30} {time_per_call(lambda: ChatMessages(model=model), repeat=2000):>10.2f} us")
+
+
+def benchmark_message_records(size=10000):
+    """
+    Compares the memory of Message records with plain dicts plus separate token counts, and times the index-backed
+    operations that used to scan the conversation (deleting all function messages, finding the last question).
+    :param size: Optional parameter, the number of conversation messages, default is 10000.
+    """
+    raw_messages = []
+    for i in range(size):
+        if i % 4 == 1:
+            raw_messages.append({"role": "assistant", "content": None,
+                                 "function_call": {"name": "sql_inter", "arguments": '{"sql_query": "SELECT 1"}'}})
+        elif i % 4 == 2:
+            raw_messages.append({"role": "function", "name": "sql_inter", "content": "[[1]]"})
+        else:
+            raw_messages.append({"role": "user" if i % 4 == 0 else "assistant", "content": f"Message {i}"})
+
+    def measure(build):
+        tracemalloc.start()
+        stored = build()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del stored
+        return current / size
+
+    messages = ChatMessages()
+    dict_bytes = measure(lambda: [(dict(msg), 10 ** 6 + i) for i, msg in enumerate(raw_messages)])
+    record_bytes = measure(lambda: [messages._new_message(msg) for msg in raw_messages])
+
+    for msg in raw_messages:
+        messages.messages_append(msg)
+
+    print(f"Message records ({size} messages)")
+    print(f"{'dict + token count per message':<34} {dict_bytes:>10.0f} bytes")
+    print(f"{'Message record per message':<34} {record_bytes:>10.0f} bytes")
+    print(f"{'last user question':<34} {time_per_call(lambda: messages.last_position('user'), repeat=10000):>10.2f} us")
+    print(f"{'delete_function_messages':<34} {time_per_call(lambda: messages.copy().delete_function_messages(), repeat=5) / 1e3:>10.2f} ms")
+
+
+def benchmark_token_cache(cache_dir=None):
+    """
+    Measures how long counting the tokens of telco_data_dictionary.md takes without the cache, on a cold cache,
+    from the disk cache (as a new worker process would) and from memory.
+    :param cache_dir: Optional parameter, the cache directory, default is a temporary directory.
+    """
+    import tempfile
+
+    with open('telco_data_dictionary.md', 'r', encoding='utf-8') as f:
+        data_dictionary = f.read()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = TokenCache(cache_dir=cache_dir or tmp_dir)
+        encoding = get_encoding()
+
+        def timed(func):
+            start = time.perf_counter()
+            func()
+            return (time.perf_counter() - start) * 1e3
+
+        print("Document token cache (milliseconds)")
+        print(f"{'tokenize without cache':<24} {timed(lambda: encoding.encode(data_dictionary)):>10.3f}")
+        print(f"{'cold cache (miss)':<24} {timed(lambda: cache.count(data_dictionary)):>10.3f}")
+        cache.clear_memory()
+        print(f"{'disk hit':<24} {timed(lambda: cache.count(data_dictionary)):>10.3f}")
+        print(f"{'memory hit':<24} {timed(lambda: cache.count(data_dictionary)):>10.3f}")
+        print(cache.stats())
+
+
+def benchmark_rate_limiter(num_requests=20, num_threads=16):
+    """
+    Sends fake requests from several threads through a RateLimiter with an empty bucket and reports how the limiter
+    spreads them over time, instead of letting them fail with rate limit errors.
+    :param num_requests: Optional parameter, the number of fake requests, default is 20.
+    :param num_threads: Optional parameter, the number of threads sending them, default is 16.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from rate_limiter import set_rate_limit, call_with_retries, get_rate_limiter
+
+    model = 'benchmark-model'
+    # 1200 RPM and 60000 TPM, with requests of 500 tokens: the TPM budget allows 2 requests per second
+    set_rate_limit(model, 1200, 60000)
+    limiter = get_rate_limiter(model)
+    limiter.requests.level = limiter.tokens.level = 0
+
+    def request():
+        return {"usage": {"total_tokens": 500}}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(lambda _: call_with_retries(request, model, estimated_tokens=500), range(num_requests)))
+    elapsed = time.perf_counter() - start
+
+    print(f"Rate limiter ({num_requests} requests from {num_threads} threads, 1200 RPM / 60000 TPM)")
+    print(f"{'wall time':<24} {elapsed:>10.2f} s")
+    print(f"{'achieved rate':<24} {num_requests / elapsed * 60:>10.0f} requests per minute")
+    print(limiter.metrics())
+
+
+def benchmark_streaming(num_chunks=200, chunk_interval=0.005, first_chunk_delay=0.3):
+    """
+    Replays a simulated streamed answer through consume_stream and compares the time until the user sees the first
+    tokens with the time a non-streamed call makes them wait for the whole answer.
+    :param num_chunks: Optional parameter, the number of content chunks of the answer, default is 200.
+    :param chunk_interval: Optional parameter, the seconds between two chunks, default is 0.005.
+    :param first_chunk_delay: Optional parameter, the seconds before the first chunk (prompt processing), default is 0.3.
+    """
+    from streaming import consume_stream
+
+    def fake_stream():
+        time.sleep(first_chunk_delay)
+        yield {"choices": [{"delta": {"role": "assistant"}, "finish_reason": None}]}
+        for i in range(num_chunks):
+            yield {"choices": [{"delta": {"content": f"word{i} "}, "finish_reason": None}]}
+            time.sleep(chunk_interval)
+        yield {"choices": [{"delta": {}, "finish_reason": "stop"}]}
+
+    message, stats = consume_stream(fake_stream(), "gpt-3.5-turbo")
+    print(f"Streaming ({num_chunks} chunks)")
+    print(f"{'time to first token':<24} {stats.time_to_first_token:>10.3f} s")
+    print(f"{'time to full answer':<24} {stats.total_time:>10.3f} s")
+    print(f"{'tokens per second':<24} {stats.tokens_per_second:>10.1f}")
+
+
+def benchmark_response_cache(num_threads=8, upstream_latency=0.2):
+    """
+    Measures a response cache miss (a simulated upstream call), a disk hit, and how many upstream calls
+    `num_threads` identical concurrent requests cost with single-flight de-duplication.
+    :param num_threads: Optional parameter, the number of concurrent identical requests, default is 8.
+    :param upstream_latency: Optional parameter, the seconds the simulated upstream call takes, default is 0.2.
+    """
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from response_cache import ResponseCache, make_cache_key
+
+    upstream_calls = []
+
+    def create():
+        upstream_calls.append(1)
+        time.sleep(upstream_latency)
+        return {"choices": [{"message": {"role": "assistant", "content": "There are 7043 records."}}]}
+
+    messages = build_conversation(20).to_api_messages()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = ResponseCache(path=f"{tmp_dir}/responses.sqlite3")
+        key = make_cache_key("gpt-3.5-turbo", messages)
+
+        print("Response cache")
+        print(f"{'canonical key':<24} {time_per_call(lambda: make_cache_key('gpt-3.5-turbo', messages)):>10.1f} us")
+        start = time.perf_counter()
+        cache.get_or_create(key, create)
+        print(f"{'miss (upstream call)':<24} {(time.perf_counter() - start) * 1e3:>10.1f} ms")
+        print(f"{'hit':<24} {time_per_call(lambda: cache.get_or_create(key, create)) / 1e3:>10.3f} ms")
+
+        upstream_calls.clear()
+        other_key = make_cache_key("gpt-3.5-turbo", messages[:-1])
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(lambda _: cache.get_or_create(other_key, create), range(num_threads)))
+        print(f"{'upstream calls for ' + str(num_threads) + ' identical requests':<24} {len(upstream_calls):>4}")
+        print(cache.stats())
+
+
+def benchmark_agent_loop(num_sessions=20, median_latency=0.05, p99_latency=0.3):
+    """
+    Runs whole conversation sessions (a function call, its execution and the final answer) offline against the
+    ScriptedBackend, with a seeded long-tailed model latency, and reports the session latency and the step trace.
+    :param num_sessions: Optional parameter, the number of sessions to run, default is 20.
+    :param median_latency: Optional parameter, the median latency of a model call in seconds, default is 0.05.
+    :param p99_latency: Optional parameter, the 99th percentile latency of a model call in seconds, default is 0.3.
+    """
+    import os
+    from response import get_chat_response
+    from agent_loop import AgentRun
+    from availablefunctions import AvailableFunctions
+    from llm_backend import ScriptedBackend, LogNormalLatency, set_backend, text_message, function_call_message
+
+    def python_inter(py_code, g='globals()'):
+        return str(eval(py_code))
+
+    python_inter_function = {"name": "python_inter",
+                             "description": "Runs Python code and returns its result.",
+                             "parameters": {"type": "object",
+                                            "properties": {"py_code": {"type": "string",
+                                                                       "description": "The Python code to run."}},
+                                            "required": ["py_code"]}}
+
+    # Call the function for a new question, answer once its result is known
+    def script(request):
+        if request["messages"][-1]["role"] == "function":
+            return text_message(f"The result is {request['messages'][-1]['content']}.")
+        return function_call_message("python_inter", {"py_code": "sum(range(100))"})
+
+    available_functions = AvailableFunctions(functions_list=[python_inter], functions=[python_inter_function])
+    cache_setting = os.environ.get('MATEGEN_RESPONSE_CACHE')
+    os.environ['MATEGEN_RESPONSE_CACHE'] = '0'
+    set_backend(ScriptedBackend(script, latency=LogNormalLatency(median_latency, p99_latency), seed=42))
+    try:
+        runs = []
+        for i in range(num_sessions):
+            run = AgentRun()
+            messages = ChatMessages(question=f"Question {i}: what is the sum of the first 100 integers?")
+            get_chat_response("gpt-3.5-turbo", messages, available_functions=available_functions, run=run)
+            runs.append(run)
+    finally:
+        set_backend(None)
+        if cache_setting is None:
+            os.environ.pop('MATEGEN_RESPONSE_CACHE')
+        else:
+            os.environ['MATEGEN_RESPONSE_CACHE'] = cache_setting
+
+    seconds = sorted(run.elapsed for run in runs)
+    llm_seconds = sum(step.llm_seconds for run in runs for step in run.steps)
+    tool_seconds = sum(step.tool_seconds for run in runs for step in run.steps)
+    print(f"Agent loop ({num_sessions} offline sessions, model latency median {median_latency}s, p99 {p99_latency}s)")
+    print(f"{'mean session':<24} {sum(seconds) / len(seconds) * 1e3:>10.1f} ms")
+    print(f"{'p95 session':<24} {seconds[int(len(seconds) * 0.95) - 1] * 1e3:>10.1f} ms")
+    print(f"{'model time share':<24} {llm_seconds / sum(seconds) * 100:>10.1f} %")
+    print(f"{'function time share':<24} {tool_seconds / sum(seconds) * 100:>10.1f} %")
+    print(runs[0].summary())
+
+
+def benchmark_parallel_tools(num_calls=4, query_latency=0.2, repeat=3):
+    """
+    Compares running the independent SQL queries of one model turn one after the other (one function call per turn)
+    with running them as parallel tool calls on the tool thread pool. The queries are simulated by a sleep.
+    :param num_calls: Optional parameter, the number of queries of the turn, default is 4.
+    :param query_latency: Optional parameter, the duration of one query in seconds, default is 0.2.
+    :param repeat: Optional parameter, the number of turns timed for each mode, default is 3.
+    """
+    from response import function_call_step
+    from agent_loop import StepRecord, FUNCTION_CALL
+    from availablefunctions import AvailableFunctions
+    from llm_backend import function_call_message, tool_calls_message
+
+    def sql_inter(sql_query, g='globals()'):
+        time.sleep(query_latency)
+        return f"{sql_query}: 42"
+
+    sql_inter.thread_safe = True
+
+    sql_inter_function = {"name": "sql_inter",
+                          "description": "Runs a SQL query and returns its result.",
+                          "parameters": {"type": "object",
+                                         "properties": {"sql_query": {"type": "string",
+                                                                      "description": "The SQL query to run."}},
+                                         "required": ["sql_query"]}}
+
+    available_functions = AvailableFunctions(functions_list=[sql_inter], functions=[sql_inter_function],
+                                             parallel_tool_calls=True)
+    queries = [{"sql_query": f"SELECT COUNT(*) FROM user_demographics WHERE tenure > {i}"} for i in range(num_calls)]
+
+    def sequential():
+        messages = ChatMessages(question="How many customers stayed longer than each tenure?")
+        for query in queries:
+            function_call_step(messages, function_call_message("sql_inter", query), StepRecord(0, FUNCTION_CALL),
+                               available_functions)
+
+    def parallel():
+        messages = ChatMessages(question="How many customers stayed longer than each tenure?")
+        function_call_step(messages, tool_calls_message([("sql_inter", query) for query in queries]),
+                           StepRecord(0, FUNCTION_CALL), available_functions)
+
+    # The function calls display their code; keep the benchmark output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        sequential_time = time_per_call(sequential, repeat=repeat)
+        parallel_time = time_per_call(parallel, repeat=repeat)
+    print(f"Parallel tool calls ({num_calls} queries of {query_latency}s)")
+    print(f"{'sequential':<24} {sequential_time / 1e3:>10.1f} ms")
+    print(f"{'parallel':<24} {parallel_time / 1e3:>10.1f} ms")
+    print(f"{'speedup':<24} {sequential_time / parallel_time:>10.1f} x")
+
+
+def benchmark_router(model_latency=0.05):
+    """
+    Measures the accuracy and the cost of the local question router on questions the rules were not written from, then
+    runs the questions offline
+    against the ScriptedBackend twice: always decomposing the task first, and decomposing only the questions routed as multi-step.
+    :param model_latency: Optional parameter, the latency of a model call in seconds, default is 0.05.
+    """
+    import os
+    from response import get_chat_response
+    from policies import AutoApprovePolicy
+    from availablefunctions import AvailableFunctions
+    from llm_backend import ScriptedBackend, FixedLatency, set_backend, text_message, function_call_message
+    from router import QuestionRouter, DIRECT, SINGLE_TOOL, MULTI_STEP
+
+    # Evaluation questions written apart from the rules and the seed examples, in the wording users actually use;
+    # none of them was used to write or tune the rules
+    held_out = [("Why do telecom companies care about churn?", DIRECT),
+                ("What is one-hot encoding?", DIRECT),
+                ("How does a random forest work?", DIRECT),
+                ("What is the difference between a LEFT JOIN and an INNER JOIN?", DIRECT),
+                ("Define customer lifetime value.", DIRECT),
+                ("What is paperless billing?", DIRECT),
+                ("What does tenure mean for a telecom subscription?", DIRECT),
+                ("How many customers pay by electronic check?", SINGLE_TOOL),
+                ("What share of customers have a two year contract?", SINGLE_TOOL),
+                ("Which internet service type has the most subscribers?", SINGLE_TOOL),
+                ("Give me the median monthly charge.", SINGLE_TOOL),
+                ("Are there duplicate customer IDs in user_services?", SINGLE_TOOL),
+                ("What fraction of senior citizens have churned?", SINGLE_TOOL),
+                ("How many customers use both streaming TV and streaming movies?", SINGLE_TOOL),
+                ("What is the highest monthly charge among churned users?", SINGLE_TOOL),
+                ("Does user_payments contain blank TotalCharges values?", SINGLE_TOOL),
+                ("Segment the customers by tenure and compare their churn.", MULTI_STEP),
+                ("Build a summary of churn drivers across all four tables.", MULTI_STEP),
+                ("Which combination of services best predicts churn, and how confident are you?", MULTI_STEP),
+                ("Clean the payment data, join it to demographics, and fit a decision tree.", MULTI_STEP),
+                ("Estimate how much revenue we lose to churn each month and where it comes from.", MULTI_STEP),
+                ("Check data quality in every table and propose fixes.", MULTI_STEP),
+                ("Figure out whether paperless billing customers churn more once contract type is accounted for.",
+                 MULTI_STEP)]
+
+    router = QuestionRouter()
+    decisions = [(router.route(question), route) for question, route in held_out]
+    correct = sum(decision.route == route for decision, route in decisions)
+    by_rule = sum(decision.source == 'rule' for decision, _ in decisions)
+    # Misrouting a data question as direct only skips the decomposition (functions are offered on every route),
+    # but it is the costliest mistake of the router, so it is counted apart
+    data_as_direct = sum(decision.route == DIRECT and route != DIRECT for decision, route in decisions)
+    classifier_router = QuestionRouter(use_rules=False, min_confidence=0)
+    classifier_correct = sum(classifier_router.route(question).route == route for question, route in held_out)
+    routing_time = time_per_call(lambda: router.route(held_out[-1][0]), repeat=1000)
+
+    def sql_inter(sql_query, g='globals()'):
+        return "42"
+
+    sql_inter_function = {"name": "sql_inter",
+                          "description": "Runs a SQL query and returns its result.",
+                          "parameters": {"type": "object",
+                                         "properties": {"sql_query": {"type": "string",
+                                                                      "description": "The SQL query to run."}},
+                                         "required": ["sql_query"]}}
+
+    # Propose a plan for a decomposition prompt, query the database when functions are offered, then answer
+    def script(request):
+        last_message = request["messages"][-1]
+        if last_message["role"] == "function":
+            return text_message(f"The answer is {last_message['content']}.")
+        if (last_message["content"] or "").startswith("The current question is"):
+            return text_message("Step 1: query the table. Step 2: summarize the result.")
+        if request.get("functions"):
+            return function_call_message("sql_inter", {"sql_query": "SELECT COUNT(*) FROM user_churn;"})
+        return text_message("A direct answer.")
+
+    available_functions = AvailableFunctions(functions_list=[sql_inter], functions=[sql_inter_function])
+    cache_setting = os.environ.get('MATEGEN_RESPONSE_CACHE')
+    os.environ['MATEGEN_RESPONSE_CACHE'] = '0'
+
+    def run_sessions(session_router):
+        backend = ScriptedBackend(script, latency=FixedLatency(model_latency))
+        set_backend(backend)
+        start = time.perf_counter()
+        for question, _ in held_out:
+            get_chat_response("gpt-3.5-turbo", ChatMessages(question=question), available_functions=available_functions,
+                              is_task_decomposition=session_router is None, policy=AutoApprovePolicy(),
+                              router=session_router)
+        return backend.num_calls, time.perf_counter() - start
+
+    session_router = QuestionRouter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            always_calls, always_seconds = run_sessions(None)
+            routed_calls, routed_seconds = run_sessions(session_router)
+    finally:
+        set_backend(None)
+        if cache_setting is None:
+            os.environ.pop('MATEGEN_RESPONSE_CACHE')
+        else:
+            os.environ['MATEGEN_RESPONSE_CACHE'] = cache_setting
+
+    print(f"Question router ({len(held_out)} held-out questions, model latency {model_latency}s)")
+    print(f"{'accuracy':<24} {correct / len(held_out) * 100:>10.1f} %")
+    print(f"{'decided by rules':<24} {by_rule / len(held_out) * 100:>10.1f} %")
+    print(f"{'data questions as direct':<24} {data_as_direct:>10}")
+    print(f"{'classifier alone':<24} {classifier_correct / len(held_out) * 100:>10.1f} %")
+    print(f"{'routing time':<24} {routing_time:>10.1f} us")
+    print(f"{'always decompose':<24} {always_calls:>6} calls {always_seconds * 1e3:>10.1f} ms")
+    print(f"{'routed':<24} {routed_calls:>6} calls {routed_seconds * 1e3:>10.1f} ms")
+    print(session_router.report())
+
+
+def benchmark_prompt_templates(repeat=2000):
+    """
+    Compares building the task decomposition request by appending the few-shot messages one by one, each of them encoded
+    and checked against the token limit, with splicing the precompiled example block in one step.
+    :param repeat: Optional parameter, the number of requests built in each mode, default is 2000.
+    """
+    from planning import TASK_DECOMPOSITION_TEMPLATE, add_task_decomposition_prompt
+
+    messages = build_conversation(20)
+    messages.messages_append({"role": "user", "content": "How many records are in user_demographics?"})
+    template = TASK_DECOMPOSITION_TEMPLATE
+
+    def append_one_by_one():
+        few_shot = messages.copy()
+        question = few_shot.history_messages[-1]["content"]
+        few_shot.messages_pop(manual=True, index=-1)
+        for user_content, assistant_content in template.examples:
+            few_shot.messages_append({"role": "user", "content": template.format_question(user_content)})
+            few_shot.messages_append({"role": "assistant", "content": assistant_content})
+        few_shot.messages_append({"role": "user", "content": template.format_question(question)})
+        return few_shot
+
+    append_time = time_per_call(append_one_by_one, repeat=repeat)
+    splice_time = time_per_call(lambda: add_task_decomposition_prompt(messages), repeat=repeat)
+    print(f"Few-shot prompt ({len(template.examples) * 2} example messages, {template.tokens(messages.model)} tokens)")
+    print(f"{'append one by one':<24} {append_time:>10.1f} us")
+    print(f"{'precompiled splice':<24} {splice_time:>10.1f} us")
+
+
+def benchmark_db_pool(num_threads=16, queries_per_thread=25, connect_latency=0.005):
+    """
+    Compares opening a connection for every query, as the SQL tools used to, with the shared ConnectionPool, on a SQLite
+    stand-in for MySQL. A MySQL connection costs a TCP handshake and an authentication round trip, simulated by a sleep
+    of `connect_latency` seconds when a connection is opened.
+    :param num_threads: Optional parameter, the number of concurrent sessions, default is 16.
+    :param queries_per_thread: Optional parameter, the number of short queries each session runs, default is 25.
+    :param connect_latency: Optional parameter, the simulated connection setup time in seconds, default is 0.005.
+    """
+    import os
+    import sqlite3
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from db import ConnectionPool
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'telco_db.sqlite3')
+        connection = sqlite3.connect(path)
+        connection.execute("CREATE TABLE user_demographics (customerID TEXT PRIMARY KEY, gender TEXT, SeniorCitizen INT)")
+        connection.executemany("INSERT INTO user_demographics VALUES (?, ?, ?)",
+                               [(f"{i:04d}-ABCDE", "Female" if i % 2 else "Male", i % 5 == 0) for i in range(5000)])
+        connection.commit()
+        connection.close()
+
+        def connect():
+            time.sleep(connect_latency)
+            return sqlite3.connect(path, check_same_thread=False)
+
+        def query(connection, i):
+            cursor = connection.cursor()
+            cursor.execute("SELECT gender, SeniorCitizen FROM user_demographics WHERE customerID = ?", (f"{i:04d}-ABCDE",))
+            cursor.fetchall()
+            cursor.close()
+
+        def connect_per_query(thread):
+            for i in range(queries_per_thread):
+                connection = connect()
+                try:
+                    query(connection, thread * queries_per_thread + i)
+                finally:
+                    connection.close()
+
+        pool = ConnectionPool(connect, min_size=2, max_size=8)
+
+        def pooled(thread):
+            for i in range(queries_per_thread):
+                with pool.connection() as connection:
+                    query(connection, thread * queries_per_thread + i)
+
+        results = {}
+        for name, session in (("connect per query", connect_per_query), ("connection pool", pooled)):
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                list(executor.map(session, range(num_threads)))
+            results[name] = time.perf_counter() - start
+        pool_stats = pool.stats()
+        pool.close()
+
+    num_queries = num_threads * queries_per_thread
+    print(f"Database connections ({num_threads} sessions x {queries_per_thread} queries, "
+          f"{connect_latency * 1e3:.0f} ms simulated connection setup, SQLite stand-in)")
+    for name, seconds in results.items():
+        print(f"{name:<24} {seconds * 1e3:>10.1f} ms {num_queries / seconds:>10.0f} queries/s")
+    print(pool_stats)
+
+
+def benchmark_sql_results(num_rows=200000):
+    """
+    Compares the old sql_inter (fetchall, then the whole result set as JSON) with the streamed, bounded result summary
+    on a `SELECT *` over a SQLite stand-in table: peak Python memory, wall time and size of the payload sent to the model.
+    :param num_rows: Optional parameter, the number of rows of the table, default is 200000.
+    """
+    import os
+    import json
+    import sqlite3
+    import tempfile
+    from db import ConnectionPool, stream_query
+    from sql_results import summarize_query
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'telco_db.sqlite3')
+        connection = sqlite3.connect(path)
+        connection.execute("CREATE TABLE user_services (customerID TEXT, PhoneService TEXT, InternetService TEXT, "
+                           "MonthlyCharges REAL)")
+        connection.executemany("INSERT INTO user_services VALUES (?, ?, ?, ?)",
+                               [(f"{i:07d}-ABCDE", "Yes" if i % 10 else "No", ("DSL", "Fiber optic", "No")[i % 3],
+                                 20 + i % 100) for i in range(num_rows)])
+        connection.commit()
+        connection.close()
+        pool = ConnectionPool(lambda: sqlite3.connect(path, check_same_thread=False))
+        sql_query = "SELECT * FROM user_services"
+
+        def fetch_all():
+            with pool.connection() as connection:
+                cursor = connection.cursor()
+                cursor.execute(sql_query)
+                results = cursor.fetchall()
+                cursor.close()
+            return json.dumps(results)
+
+        def streamed():
+            return summarize_query(stream_query(sql_query, pool=pool)).to_json()
+
+        results = {}
+        for name, run in (("fetchall + json.dumps", fetch_all), ("streamed summary", streamed)):
+            tracemalloc.start()
+            start = time.perf_counter()
+            payload = run()
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[name] = (seconds, peak, len(payload))
+        pool.close()
+
+    print(f"SQL result payload (SELECT * over {num_rows} rows, SQLite stand-in)")
+    for name, (seconds, peak, size) in results.items():
+        print(f"{name:<24} {seconds * 1e3:>10.1f} ms {peak / 1e6:>10.2f} MB peak {size:>12} bytes")
+
+
+def benchmark_extract_data(copies=20):
+    """
+    Compares the old extract_data (one pd.read_sql of the whole table) with the chunked, dtype-optimized loading on the
+    telco churn table repeated `copies` times in a SQLite stand-in: wall time, peak Python memory and the memory of the
+    resulting DataFrame.
+    :param copies: Optional parameter, the number of copies of the 7043-row table, default is 20.
+    """
+    import os
+    import sqlite3
+    import tempfile
+    import pandas as pd
+    from db import ConnectionPool
+    from dataframes import load_dataframe, memory_usage
+
+    data = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telco_data',
+                                    'WA_Fn-UseC_-Telco-Customer-Churn.csv'))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'telco_db.sqlite3')
+        connection = sqlite3.connect(path)
+        pd.concat([data] * copies, ignore_index=True).to_sql('telco', connection, index=False)
+        connection.close()
+        pool = ConnectionPool(lambda: sqlite3.connect(path, check_same_thread=False))
+        sql_query = "SELECT * FROM telco"
+
+        def read_sql():
+            with pool.connection() as connection:
+                return pd.read_sql(sql_query, connection)
+
+        def chunked():
+            return load_dataframe(sql_query, pool=pool)[0]
+
+        results = {}
+        for name, run in (("pd.read_sql", read_sql), ("chunked + dtypes", chunked)):
+            # Timed without tracemalloc, which slows down the per-value work of building the DataFrames
+            start = time.perf_counter()
+            df = run()
+            seconds = time.perf_counter() - start
+            del df
+            tracemalloc.start()
+            df = run()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[name] = (seconds, peak, memory_usage(df))
+            del df
+        pool.close()
+
+    print(f"extract_data (SELECT * over {len(data) * copies} telco rows, SQLite stand-in)")
+    for name, (seconds, peak, size) in results.items():
+        print(f"{name:<18} {seconds * 1e3:>10.1f} ms {peak / 2 ** 20:>10.2f} MB peak {size / 2 ** 20:>10.2f} MB DataFrame")
+
+
+def benchmark_sql_cache(sessions=20):
+    """
+    Runs the exploratory queries agents repeat in every session (row counts, key overlap between tables, missing-value
+    counts) for `sessions` sessions, written with the spacing and case varying between sessions, through sql_inter's
+    query path with and without the SqlResultCache. The telco tables live in a SQLite stand-in for MySQL.
+    :param sessions: Optional parameter, the number of sessions, default is 20.
+    """
+    import os
+    import sqlite3
+    import tempfile
+    import pandas as pd
+    from db import ConnectionPool, stream_query
+    from sql_results import summarize_query
+    from sql_cache import SqlResultCache, TableVersions
+
+    data_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telco_data')
+    queries = [
+        "SELECT COUNT(*) FROM user_demographics",
+        "SELECT COUNT(*) FROM user_services",
+        "SELECT COUNT(*) FROM user_demographics d JOIN user_services s ON d.customerID = s.customerID",
+        "SELECT COUNT(*) FROM user_services s LEFT JOIN user_demographics d ON d.customerID = s.customerID "
+        "WHERE d.customerID IS NULL",
+        "SELECT SUM(TotalCharges IS NULL OR TotalCharges = ' '), SUM(MonthlyCharges IS NULL) FROM user_payments",
+        "SELECT Contract, COUNT(*) FROM user_payments GROUP BY Contract",
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'telco_db.sqlite3')
+        connection = sqlite3.connect(path)
+        for table in ('user_demographics', 'user_services', 'user_payments'):
+            # The training tables repeated to the size of a production extract
+            data = pd.read_csv(os.path.join(data_directory, f'{table}_train.csv'))
+            pd.concat([data] * 20, ignore_index=True).to_sql(table, connection, index=False)
+        connection.close()
+        pool = ConnectionPool(lambda: sqlite3.connect(path, check_same_thread=False))
+
+        def sqlite_stamps(pool, tables=()):
+            with pool.connection() as connection:
+                return {name: ('sqlite', 1) for name, in
+                        connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+        cache = SqlResultCache(versions=TableVersions(pool, fetch=sqlite_stamps))
+
+        def run_sessions(cached):
+            for session in range(sessions):
+                for sql_query in queries:
+                    sql_query = sql_query.lower() if session % 2 else sql_query.replace(" ", "  ")
+
+                    def run():
+                        return summarize_query(stream_query(sql_query, pool=pool)).to_json()
+
+                    cache.get_or_run(sql_query, run) if cached else run()
+
+        results = {}
+        for name, cached in (("uncached", False), ("SqlResultCache", True)):
+            start = time.perf_counter()
+            run_sessions(cached)
+            results[name] = time.perf_counter() - start
+        stats = cache.stats()
+        pool.close()
+
+    print(f"Exploratory SQL queries ({sessions} sessions x {len(queries)} queries, SQLite stand-in)")
+    for name, seconds in results.items():
+        print(f"{name:<16} {seconds * 1e3:>10.1f} ms")
+    print(f"cache: {stats['hits']} hits, {stats['misses']} misses, {stats['bytes']} bytes")
+
+
+def benchmark_sql_backend(repeats=20):
+    """
+    Measures the latency of the queries agents typically run (row counts, key overlap between tables, missing values,
+    group statistics, a single record) through sql_inter's query path on the embedded SQLite backend, and on the MySQL
+    backend when a server is reachable with the MYSQL_* environment variables.
+    :param repeats: Optional parameter, the number of runs of each query, default is 20.
+    """
+    import os
+    import tempfile
+    import statistics
+    from db import stream_query
+    from sql_results import summarize_query
+    from sql_backend import MySQLBackend, SQLiteBackend
+
+    queries = {
+        "row count": "SELECT COUNT(*) FROM user_demographics",
+        "key overlap": "SELECT COUNT(*) FROM user_demographics d JOIN user_services s ON d.customerID = s.customerID",
+        "missing keys": "SELECT COUNT(*) FROM user_services s LEFT JOIN user_demographics d "
+                        "ON d.customerID = s.customerID WHERE d.customerID IS NULL",
+        "missing values": "SELECT COUNT(*) FROM user_payments WHERE TotalCharges IS NULL OR TotalCharges = ' '",
+        "churn by contract": "SELECT p.Contract, AVG(c.Churn = 'Yes') FROM user_payments p "
+                             "JOIN user_churn c ON p.customerID = c.customerID GROUP BY p.Contract",
+        "one record": "SELECT * FROM user_demographics WHERE customerID = '4223-BKEOR'",
+    }
+
+    def measure(pool):
+        latencies = {}
+        for name, sql_query in queries.items():
+            runs = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                summarize_query(stream_query(sql_query, pool=pool)).to_json()
+                runs.append(time.perf_counter() - start)
+            latencies[name] = statistics.median(runs)
+        return latencies
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        backend = SQLiteBackend(path=os.path.join(directory, 'telco_db.sqlite3'))
+        start = time.perf_counter()
+        backend.build()
+        build_seconds = time.perf_counter() - start
+        pool = backend.create_pool()
+        results["sqlite"] = measure(pool)
+        pool.close()
+    try:
+        pool = MySQLBackend(connect_timeout=2).create_pool(min_size=0)
+        results["mysql"] = measure(pool)
+        pool.close()
+    except Exception as e:
+        print(f"MySQL backend not measured: {e}")
+
+    print(f"Typical agent queries, median of {repeats} runs (SQLite database built in {build_seconds * 1e3:.0f} ms)")
+    print(f"{'query':<20}" + "".join(f"{name:>12}" for name in results))
+    for query in queries:
+        print(f"{query:<20}" + "".join(f"{results[name][query] * 1e3:>9.2f} ms" for name in results))
+
+
+def benchmark_schema_context(extra_tables=20):
+    """
+    Compares the prompt tokens of the static data dictionary sent with every question with those of the per-question
+    schema summary, over the tool questions of the router's seed examples, on the embedded SQLite database. The database
+    then gets `extra_tables` unrelated tables to show how both grow with the schema.
+    :param extra_tables: Optional parameter, the number of tables added for the scaling measurement, default is 20.
+    """
+    import os
+    import sqlite3
+    import tempfile
+    import statistics
+    from router import SEED_EXAMPLES, DIRECT
+    from schema_context import SchemaContext
+    from sql_backend import SQLiteBackend
+    from tokenizer import count_tokens
+
+    questions = [question for question, route in SEED_EXAMPLES if route != DIRECT]
+    with open('telco_data_dictionary.md', 'r', encoding='utf-8') as f:
+        dictionary_tokens = count_tokens(f.read())
+
+    def measure(context):
+        start = time.perf_counter()
+        context.load(force=True)
+        load_seconds = time.perf_counter() - start
+        tokens, latencies = [], []
+        for question in questions:
+            start = time.perf_counter()
+            tokens.append(count_tokens(context.render(question)))
+            latencies.append(time.perf_counter() - start)
+        full_tokens = count_tokens(context.render(max_tokens=10 ** 6))
+        return load_seconds, statistics.mean(tokens), max(tokens), statistics.median(latencies), full_tokens
+
+    with tempfile.TemporaryDirectory() as directory:
+        backend = SQLiteBackend(path=os.path.join(directory, 'telco_db.sqlite3'), test_splits=False)
+        backend.build()
+        pool = backend.create_pool()
+        context = SchemaContext.from_data_dictionary('telco_data_dictionary.md', pool=pool)
+        rows = {"telco tables": measure(context)}
+
+        connection = sqlite3.connect(backend.path)
+        for i in range(extra_tables):
+            connection.execute(f'CREATE TABLE "network_metric_{i}" ("siteID" TEXT, "region" TEXT, "latency_{i}" REAL, '
+                               f'"dropped_calls_{i}" INTEGER, "recorded_at" TEXT)')
+            connection.executemany(f'INSERT INTO "network_metric_{i}" VALUES (?, ?, ?, ?, ?)',
+                                   [(f"S{j:04d}", ("North", "South", "East")[j % 3], j * 0.5, j % 7, f"2024-01-{j % 28 + 1:02d}")
+                                    for j in range(500)])
+        connection.commit()
+        connection.close()
+        rows[f"+{extra_tables} tables"] = measure(context)
+        pool.close()
+
+    print(f"Prompt tokens per question over {len(questions)} questions; the data dictionary costs {dictionary_tokens} tokens "
+          f"per request")
+    print(f"{'schema':<14}{'load':>10}{'full schema':>13}{'mean':>8}{'max':>8}{'render':>12}")
+    for name, (load_seconds, mean_tokens, max_tokens, latency, full_tokens) in rows.items():
+        print(f"{name:<14}{load_seconds * 1e3:>7.0f} ms{full_tokens:>13}{mean_tokens:>8.0f}{max_tokens:>8}"
+              f"{latency * 1e3:>9.2f} ms")
+
+
+def benchmark_query_timeout(timeouts=(0.25, 0.5, 1.0), repeats=200):
+    """
+    Measures how long sql_inter's query path stays blocked by a runaway query (a three-way cross join) with and without
+    a query timeout, and what the timeout watchdog adds to a fast query, on the embedded SQLite backend.
+    :param timeouts: Optional parameter, the timeouts to measure in seconds, default is (0.25, 0.5, 1.0).
+    :param repeats: Optional parameter, the number of runs of the fast query, default is 200.
+    """
+    import os
+    import tempfile
+    import statistics
+    from db import stream_query
+    from sql_results import summarize_query
+    from sql_backend import SQLiteBackend
+    from sql_timeout import QueryTimeout
+
+    runaway = ("SELECT COUNT(*) FROM user_demographics a, user_demographics b, user_demographics c "
+               "WHERE a.gender = c.gender")
+    fast = "SELECT * FROM user_demographics WHERE customerID = '4223-BKEOR'"
+
+    with tempfile.TemporaryDirectory() as directory:
+        backend = SQLiteBackend(path=os.path.join(directory, 'telco_db.sqlite3'), test_splits=False)
+        pool = backend.create_pool()
+
+        def run(sql_query, timeout):
+            start = time.perf_counter()
+            try:
+                summarize_query(stream_query(sql_query, pool=pool, timeout=timeout)).to_json()
+                status = "finished"
+            except QueryTimeout:
+                status = "cancelled"
+            return time.perf_counter() - start, status
+
+        run(fast, 0)
+        print("Runaway query (three-way cross join of user_demographics)")
+        for timeout in timeouts:
+            seconds, status = run(runaway, timeout)
+            print(f"  timeout {timeout:>5.2f} s: {status} after {seconds:.3f} s")
+        # Without a timeout the query would run for hours; it is measured under a long timeout instead
+        seconds, status = run(runaway, 10)
+        print(f"  no timeout: still running after {seconds:.1f} s" if status == "cancelled"
+              else f"  no timeout: finished after {seconds:.1f} s")
+
+        for timeout, label in ((0, "without timeout"), (30, "with timeout")):
+            latencies = [run(fast, timeout)[0] for _ in range(repeats)]
+            print(f"Fast query {label}: median {statistics.median(latencies) * 1e3:.3f} ms")
+        pool.close()
+
+
+BENCHMARKS = {
+    'chat_messages': benchmark_chat_messages,
+    'construction': benchmark_construction,
+    'message_records': benchmark_message_records,
+    'token_cache': benchmark_token_cache,
+    'rate_limiter': benchmark_rate_limiter,
+    'streaming': benchmark_streaming,
+    'response_cache': benchmark_response_cache,
+    'agent_loop': benchmark_agent_loop,
+    'parallel_tools': benchmark_parallel_tools,
+    'router': benchmark_router,
+    'prompt_templates': benchmark_prompt_templates,
+    'db_pool': benchmark_db_pool,
+    'sql_results': benchmark_sql_results,
+    'extract_data': benchmark_extract_data,
+    'sql_cache': benchmark_sql_cache,
+    'sql_backend': benchmark_sql_backend,
+    'schema_context': benchmark_schema_context,
+    'query_timeout': benchmark_query_timeout,
+}
+
+
+if __name__ == '__main__':
+    # Run the benchmarks named on the command line, or all of them
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+        print()
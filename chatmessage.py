@@ -1,35 +1,198 @@
-import tiktoken
 import openai
-import copy
+from bisect import bisect_left
+from tokenizer import get_encoding
+from model_profiles import count_message_tokens
+from trimming import TokenIndex, OldestFirstPolicy
+
+
+class Message:
+    """
+    A compact, immutable conversation message. Messages are stored as __slots__ records holding the role, the kind
+    ('system', 'user', 'assistant', 'function_call' or 'function', the last two including parallel tool calls and their
+    results), the content and the cached token count, which takes far less memory than one dict per message.
+    ChatMessages copies share their Message objects instead of duplicating them, so a message never changes after it has
+    been created; use ChatMessages.set_message_content to replace one.
+    A Message can be read like a dict (msg["content"], msg.get("function_call")); use to_dict() before sending it to the Chat model.
+    """
+
+    __slots__ = ('role', 'kind', 'content', 'name', 'function_call', 'extra', 'tokens')
+
+    def __init__(self, role, content=None, name=None, function_call=None, extra=None, tokens=None):
+        setattr_ = object.__setattr__
+        setattr_(self, 'role', role)
+        if function_call or (extra and extra.get("tool_calls")):
+            kind = 'function_call'
+        else:
+            # Results of parallel tool calls are function results too
+            kind = 'function' if role == 'tool' else role
+        setattr_(self, 'kind', kind)
+        setattr_(self, 'content', content)
+        setattr_(self, 'name', name)
+        setattr_(self, 'function_call', function_call)
+        setattr_(self, 'extra', extra)  # Any other keys of the original message, or None
+        setattr_(self, 'tokens', tokens)
+
+    def __setattr__(self, key, value):
+        raise TypeError("Message objects are immutable; use ChatMessages.set_message_content instead.")
+
+    def __delattr__(self, key):
+        raise TypeError("Message objects are immutable; use ChatMessages.set_message_content instead.")
+
+    def __reduce__(self):
+        return Message, (self.role, self.content, self.name, self.function_call, self.extra, self.tokens)
+
+    # Method to create a Message from a dict or OpenAIObject, reusing objects that already are one
+    @classmethod
+    def freeze(cls, message, tokens=None):
+        if type(message) is cls:
+            return message
+        message = dict(message)
+        role = message.pop("role")
+        content = message.pop("content", None)
+        name = message.pop("name", None)
+        function_call = message.pop("function_call", None)
+        if function_call is not None:
+            function_call = dict(function_call)
+        return cls(role, content, name, function_call, message or None, tokens)
+
+    # Method to get the message as a plain dict in the format expected by the Chat model
+    def to_dict(self):
+        message = {"role": self.role, "content": self.content}
+        if self.name is not None:
+            message["name"] = self.name
+        if self.function_call is not None:
+            message["function_call"] = self.function_call
+        if self.extra:
+            message.update(self.extra)
+        return message
+
+    # Read-only dict interface, so that existing code reading messages keeps working
+    def __getitem__(self, key):
+        if key == "role" or key == "content":
+            return getattr(self, key)
+        if key == "name" or key == "function_call":
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        elif self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __len__(self):
+        return len(self.to_dict())
+
+    # Method to get a mutable dict copy of the message
+    def copy(self):
+        return self.to_dict()
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class KindIndex:
+    """
+    Maps each message kind to the sorted positions of the conversation messages of that kind, so that finding
+    all function messages or the last user question does not require scanning the conversation.
+    Positions are stored relative to a moving base, so dropping the oldest messages does not renumber the others.
+    """
+
+    def __init__(self, messages=()):
+        self._base = 0  # Absolute position of the first message
+        self._length = 0
+        self._positions = {}
+        for message in messages:
+            self.append(message.kind)
+
+    def append(self, kind):
+        self._positions.setdefault(kind, []).append(self._base + self._length)
+        self._length += 1
+
+    # Method to get the positions of all messages of a kind
+    def positions(self, kind):
+        base = self._base
+        return [position - base for position in self._positions.get(kind, ())]
+
+    # Method to get the position of the last message of a kind, or None if there is none
+    def last(self, kind):
+        positions = self._positions.get(kind)
+        return positions[-1] - self._base if positions else None
+
+    # Method to forget the last message, which has the given kind
+    def pop_last(self, kind):
+        self._positions[kind].pop()
+        self._length -= 1
+
+    # Method to drop the first k messages
+    def drop_prefix(self, k):
+        self._base += k
+        self._length -= k
+        for positions in self._positions.values():
+            del positions[:bisect_left(positions, self._base)]
+
+    def copy(self):
+        new_index = KindIndex.__new__(KindIndex)
+        new_index._base = self._base
+        new_index._length = self._length
+        new_index._positions = {kind: list(positions) for kind, positions in self._positions.items()}
+        return new_index
 
 
 class ChatMessages:
     """
     The ChatMessages class is designed to construct message objects that can be processed by the Chat model. This class serves as a more structured representation of the original messages that the model receives.
-    It accepts a list of dictionaries as one of its attributes, distinguishing between system-related and historical conversation messages. Additionally, it manages token counts and can automatically trim older messages to ensure the conversation fits within the token limit for multi-turn interactions.
+    It holds lists of Message records, distinguishing between system-related and historical conversation messages. Additionally, it manages token counts and can automatically trim older messages to ensure the conversation fits within the token limit for multi-turn interactions.
+    Which messages are trimmed is decided by a TrimPolicy from trimming.py (oldest messages first by default); system messages and the current question are always kept.
     """
 
-    def __init__(self, system_content_list=None, question='Hello', tokens_thr=None, project=None):
+    def __init__(self, system_content_list=None, question='Hello', tokens_thr=None, project=None, model="gpt-3.5-turbo",
+                 trim_policy=None):
         self.system_content_list = system_content_list if system_content_list is not None else []
         system_messages = []  # Stores system-related messages
         history_messages = []  # Stores the user and assistant conversation messages
         messages_all = []  # Combines system and conversation messages
-        system_content = ''  # Concatenated system messages string
-        history_content = question  # User input as a string
-        content_all = ''  # Combines all message content
         num_of_system_messages = 0  # Tracks how many system messages are included
         all_tokens_count = 0  # Total number of tokens in the messages
 
-        # Get the appropriate encoding method for token counting
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        # Get the shared encoding of the model for token counting
+        self.model = model
+        self.encoding = get_encoding(model)
 
         # If system content exists, process the system messages
+        system_tokens_count = 0
         if self.system_content_list:
             for content in self.system_content_list:
-                system_messages.append({"role": "system", "content": content})
-                system_content += content
+                system_messages.append(self._new_message({"role": "system", "content": content}, document=True))
 
-            system_tokens_count = len(encoding.encode(system_content))
+            system_tokens_count = sum(msg.tokens for msg in system_messages)
             messages_all.extend(system_messages)
             num_of_system_messages = len(self.system_content_list)
 
@@ -43,11 +206,10 @@ class ChatMessages:
         all_tokens_count += system_tokens_count
 
         # Add the initial user message
-        history_messages = [{"role": "user", "content": question}]
+        history_messages = [self._new_message({"role": "user", "content": question})]
         messages_all.extend(history_messages)
 
-        user_tokens_count = len(encoding.encode(question))
-        all_tokens_count += user_tokens_count
+        all_tokens_count += history_messages[0].tokens
 
         if tokens_thr is not None and all_tokens_count >= tokens_thr:
             print("User message exceeds token limit. Please adjust the input or external documents.")
@@ -64,18 +226,104 @@ class ChatMessages:
         self.tokens_count = all_tokens_count
         self.num_of_system_messages = num_of_system_messages
         self.tokens_thr = tokens_thr
-        self.encoding = encoding
         self.project = project
+        self._history_index = TokenIndex(msg.tokens for msg in history_messages)  # Prefix sums over the conversation token counts
+        self._kind_index = KindIndex(history_messages)  # Positions of the conversation messages by kind
+        self.trim_policy = trim_policy if trim_policy is not None else OldestFirstPolicy()
+        self.prompt_suffixes = ()  # Instructions appended to the last user message when the messages are rendered
+        self.suffix_tokens = 0
+        self.context_message = None  # System message describing what the current question needs, e.g. the relevant schema
+        self._shared = False  # True while the lists above may be shared with a copy
+
+    # Method to create a Message record and count its tokens, including the per-message overhead of the model's profile;
+    # this is the only place a message is encoded. Static documents (system messages) are counted through the
+    # disk-backed token cache shared by all processes.
+    def _new_message(self, message, document=False):
+        if isinstance(message, Message) and message.tokens is not None:
+            return message
+        return Message.freeze(message, tokens=count_message_tokens(message, self.model, document=document))
+
+    # Method to get the messages as plain dicts, in the format expected by the Chat model.
+    # The prompt suffixes are appended to the last user message here, so the stored messages never change
+    def to_api_messages(self):
+        api_messages = [msg.to_dict() for msg in self.messages]
+        position = self.last_position('user')
+        if self.prompt_suffixes and position is not None:
+            message = api_messages[self.num_of_system_messages + position]
+            message["content"] = (message["content"] or "") + "".join(self.prompt_suffixes)
+        return api_messages
+
+    # Method to set the instructions (e.g. chain of thought, Markdown output) appended to the question when rendering
+    def set_prompt_suffixes(self, suffixes):
+        self.prompt_suffixes = tuple(suffixes)
+        self.suffix_tokens = len(self.encoding.encode("".join(self.prompt_suffixes))) if self.prompt_suffixes else 0
+
+    # Method to get the positions of the conversation messages of a kind ('user', 'assistant', 'function_call', 'function')
+    def positions(self, kind):
+        return self._kind_index.positions(kind)
+
+    # Method to get the position of the last conversation message of a kind, or None if there is none
+    def last_position(self, kind):
+        return self._kind_index.last(kind)
+
+    # Method to give this object its own lists before the first write after a copy (copy-on-write)
+    def _detach(self):
+        if self._shared:
+            self.system_content_list = list(self.system_content_list)
+            self.system_messages = list(self.system_messages)
+            self.history_messages = list(self.history_messages)
+            self.messages = list(self.messages)
+            self._history_index = self._history_index.copy()
+            self._kind_index = self._kind_index.copy()
+            self._shared = False
+
+    # Method to remove several conversation messages at once, keeping every list and index in sync
+    def _remove_messages(self, indices):
+        self._detach()
+        num_removed = len(indices)
+        if max(indices) == num_removed - 1:
+            # Contiguous block of the oldest messages: slice it off instead of rebuilding the lists
+            self.tokens_count -= self._history_index.prefix(num_removed)
+            del self.history_messages[:num_removed]
+            self._history_index.drop_prefix(num_removed)
+            self._kind_index.drop_prefix(num_removed)
+        else:
+            self.tokens_count -= sum(self._history_index.tokens(i) for i in indices)
+            self.history_messages = [msg for i, msg in enumerate(self.history_messages) if i not in indices]
+            self._history_index.remove(indices)
+            self._kind_index = KindIndex(self.history_messages)
+        self.messages = self.system_messages + self.history_messages
+
+    # Method to free at least `needed` tokens according to the trimming policy
+    def _free_tokens(self, needed):
+        indices = self.trim_policy.select(self.history_messages, self._history_index, needed,
+                                          current_question=self.last_position('user'))
+        if indices:
+            self._remove_messages(indices)
+
+    # Method to trim the conversation below the token threshold
+    def _trim(self):
+        self._free_tokens(self.tokens_count - self.tokens_thr + 1)
+
+    # Method to trim the conversation so that its messages hold at most `max_tokens` tokens, e.g. right before a request
+    def fit(self, max_tokens):
+        if self.tokens_count + self.suffix_tokens > max_tokens:
+            self._free_tokens(self.tokens_count + self.suffix_tokens - max_tokens)
 
     # Method to remove messages manually or based on token limits
     def messages_pop(self, manual=False, index=None):
         def remove_message(index):
-            removed_message = self.history_messages.pop(index)
-            self.tokens_count -= len(self.encoding.encode(str(removed_message)))
+            if index == -1 or index == len(self.history_messages) - 1:
+                self._detach()
+                removed_message = self.history_messages.pop()
+                self.messages.pop()
+                self.tokens_count -= self._history_index.pop()
+                self._kind_index.pop_last(removed_message.kind)
+            else:
+                self._remove_messages({index})
 
-        if self.tokens_thr is not None:
-            while self.tokens_count >= self.tokens_thr:
-                remove_message(-1)
+        if self.tokens_thr is not None and self.tokens_count >= self.tokens_thr:
+            self._trim()
 
         if manual:
             if index is None:
@@ -85,76 +333,140 @@ class ChatMessages:
             else:
                 raise ValueError(f"Invalid index value: {index}")
 
-        # Update the complete messages list
-        self.messages = self.system_messages + self.history_messages
-
     # Method to add new conversation messages
     def messages_append(self, new_messages):
-        if isinstance(new_messages, (dict, openai.openai_object.OpenAIObject)):
+        self._detach()
+        if isinstance(new_messages, (dict, Message, openai.openai_object.OpenAIObject)):
+            new_messages = self._new_message(new_messages)
             self.messages.append(new_messages)
-            self.tokens_count += len(self.encoding.encode(str(new_messages)))
+            self.history_messages.append(new_messages)
+            self._history_index.append(new_messages.tokens)
+            self._kind_index.append(new_messages.kind)
+            self.tokens_count += new_messages.tokens
 
         elif isinstance(new_messages, ChatMessages):
-            self.messages += new_messages.messages
+            # Reuse the cached counts of the other object instead of re-encoding its messages
+            for msg in new_messages.messages:
+                self.messages.append(msg)
+                self.history_messages.append(msg)
+                self._history_index.append(msg.tokens)
+                self._kind_index.append(msg.kind)
             self.tokens_count += new_messages.tokens_count
 
-        # Refresh the history messages and handle token constraints
-        self.history_messages = self.messages[self.num_of_system_messages:]
+        # Handle token constraints
+        self.messages_pop()
+
+    # Method to add a sequence of messages in one step, e.g. a precompiled few-shot block whose token counts are already
+    # known; the lists and indexes are extended once and the token limit is checked once
+    def messages_extend(self, new_messages):
+        self._detach()
+        new_messages = [self._new_message(msg) for msg in new_messages]
+        self.messages.extend(new_messages)
+        self.history_messages.extend(new_messages)
+        self._history_index.extend(msg.tokens for msg in new_messages)
+        for msg in new_messages:
+            self._kind_index.append(msg.kind)
+        self.tokens_count += sum(msg.tokens for msg in new_messages)
+
         self.messages_pop()
 
     # Method to create a copy of the message object
     def copy(self):
-        system_content_str_list = [msg['content'] for msg in self.system_messages]
-        copy_instance = ChatMessages(
-            system_content_list=copy.deepcopy(system_content_str_list),
-            question=self.history_messages[0]['content'] if self.history_messages else '',
-            tokens_thr=self.tokens_thr
-        )
-        copy_instance.history_messages = copy.deepcopy(self.history_messages)
-        copy_instance.messages = copy.deepcopy(self.messages)
+        # Bypass __init__ so that the copy does not re-encode any message.
+        # The copy shares the immutable messages and the lists holding them; whichever object writes first
+        # takes its own lists in _detach, so copying is O(1) and message contents are never duplicated.
+        copy_instance = ChatMessages.__new__(ChatMessages)
+        copy_instance.system_content_list = self.system_content_list
+        copy_instance.system_messages = self.system_messages
+        copy_instance.history_messages = self.history_messages
+        copy_instance.messages = self.messages
         copy_instance.tokens_count = self.tokens_count
         copy_instance.num_of_system_messages = self.num_of_system_messages
+        copy_instance.tokens_thr = self.tokens_thr
+        copy_instance.model = self.model
+        copy_instance.encoding = self.encoding
+        copy_instance.project = self.project
+        copy_instance._history_index = self._history_index
+        copy_instance._kind_index = self._kind_index
+        copy_instance.trim_policy = self.trim_policy
+        copy_instance.prompt_suffixes = self.prompt_suffixes
+        copy_instance.suffix_tokens = self.suffix_tokens
+        copy_instance.context_message = self.context_message
+        copy_instance._shared = self._shared = True
         return copy_instance
 
+    # Method to replace the content of a conversation message, e.g. when the user rewrites the question
+    def set_message_content(self, index, content):
+        if not (0 <= index < len(self.history_messages) or -len(self.history_messages) <= index < 0):
+            raise ValueError(f"Invalid index value: {index}")
+
+        self._detach()
+        new_message = self.history_messages[index].to_dict()
+        new_message["content"] = content
+        new_message = self._new_message(new_message)
+
+        index = index % len(self.history_messages)
+        self.tokens_count += new_message.tokens - self._history_index.tokens(index)
+        self.history_messages[index] = new_message
+        self._history_index.set(index, new_message.tokens)
+        self.messages[self.num_of_system_messages + index] = new_message
+
     # Method to add new system messages
     def add_system_messages(self, new_system_content):
         if isinstance(new_system_content, str):
             new_system_content = [new_system_content]
 
+        self._detach()
         self.system_content_list.extend(new_system_content)
 
-        new_system_content_str = ''.join(new_system_content)
-        new_token_count = len(self.encoding.encode(new_system_content_str))
-        self.tokens_count += new_token_count
+        # Only the new documents are encoded; existing system messages keep their cached counts
+        for content in new_system_content:
+            system_message = self._new_message({"role": "system", "content": content}, document=True)
+            self.system_messages.append(system_message)
+            self.tokens_count += system_message.tokens
 
-        system_messages = [{"role": "system", "content": msg} for msg in self.system_content_list]
+        self.num_of_system_messages = len(self.system_messages)
+        self.messages = self.system_messages + self.history_messages
 
-        self.system_messages = system_messages
-        self.num_of_system_messages = len(self.system_content_list)
+        self.messages_pop()
+
+    # Method to set the system message that depends on the current question (e.g. the schema of the tables it is about),
+    # replacing the previous one; None removes it. It is not part of system_content_list, so copies and sessions sharing
+    # that list keep their own
+    def set_context_message(self, content):
+        self._detach()
+        if self.context_message is not None:
+            position = next(i for i, msg in enumerate(self.system_messages) if msg is self.context_message)
+            self.tokens_count -= self.context_message.tokens
+            del self.system_messages[position]
+            self.context_message = None
+        if content:
+            self.context_message = self._new_message({"role": "system", "content": content})
+            self.system_messages.append(self.context_message)
+            self.tokens_count += self.context_message.tokens
+
+        self.num_of_system_messages = len(self.system_messages)
         self.messages = self.system_messages + self.history_messages
 
         self.messages_pop()
 
     # Method to delete all system messages
     def delete_system_messages(self):
-        if self.system_content_list:
-            combined_system_content = ''.join(self.system_content_list)
-            delete_token_count = len(self.encoding.encode(combined_system_content))
-
-            self.tokens_count -= delete_token_count
+        if self.system_messages:
+            self._detach()
+            self.tokens_count -= sum(msg.tokens for msg in self.system_messages)
             self.num_of_system_messages = 0
             self.system_content_list.clear()
             self.system_messages.clear()
-            self.messages = self.history_messages
+            self.context_message = None
+            self.messages = list(self.history_messages)
 
     # Method to delete function-related messages from history
     def delete_function_messages(self):
-        for index in range(len(self.history_messages) - 1, -1, -1):
-            msg = self.history_messages[index]
-            if msg.get("function_call") or msg.get("role") == "function":
-                self.messages_pop(manual=True, index=index)
+        indices = set(self.positions('function_call')) | set(self.positions('function'))
+        if indices:
+            self._remove_messages(indices)
 
 
 if __name__ == '__main__':
     print("This file defines the ChatMessages class.")
-
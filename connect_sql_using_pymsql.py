@@ -1,15 +1,7 @@
-import pymysql
 import pandas as pd
-import os
-mysql_pw = os.getenv("MYSQL_PW")
-print(mysql_pw)
-connection = pymysql.connect(
-    host='localhost',  
-    user='root',  
-    passwd=mysql_pw,  
-    db='telco_db',  
-    charset='utf8' 
-)
+from db import mysql_config, mysql_connect
+print(mysql_config()["host"], mysql_config()["db"])
+connection = mysql_connect()
 print(connection)
 cursor = connection.cursor()
 sql_query = "SELECT * FROM user_demographics LIMIT 10"
@@ -0,0 +1,189 @@
+import os
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from db import stream_query
+
+# Loading options of extract_data, configurable through the environment
+DEFAULT_CHUNK_SIZE = int(os.getenv('MATEGEN_DF_CHUNK_SIZE', 10000))  # Rows converted to a DataFrame at a time
+DEFAULT_CATEGORY_RATIO = float(os.getenv('MATEGEN_DF_CATEGORY_RATIO', 0.5))  # Maximum distinct values / rows of a category column
+
+# Text columns of the telco tables that hold numbers; TotalCharges is blank for customers with no billing yet.
+# Other text columns are never converted to numbers
+NUMERIC_COLUMNS = ('TotalCharges',)
+
+
+def _is_text(column):
+    return not isinstance(column.dtype, pd.CategoricalDtype) and (column.dtype == object
+                                                                  or pd.api.types.is_string_dtype(column.dtype))
+
+
+def _to_numeric(column):
+    """
+    Converts a text column of numbers to a numeric column; blank and invalid values become NaN.
+    """
+    stripped = column.astype(str).str.strip().where(column.notna()).replace('', None)
+    return pd.to_numeric(stripped, errors='coerce')
+
+
+def _holds_numbers(column):
+    """
+    Whether an object column holds the numbers of a numeric database column, such as the Decimal values of a DECIMAL
+    column. Text is never treated as a number here: digits in a text column (zip codes, ids) keep their leading zeros.
+    """
+    if column.dtype != object:
+        return False
+    values = column.dropna()
+    return len(values) > 0 and all(isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+                                   for value in values)
+
+
+def _downcast(column):
+    """
+    Returns a numeric column in the smallest dtype holding its values: the smallest integer type, or float32 when it keeps
+    the values to six significant digits.
+    """
+    if pd.api.types.is_bool_dtype(column.dtype) or not pd.api.types.is_numeric_dtype(column.dtype):
+        return column
+    if pd.api.types.is_integer_dtype(column.dtype):
+        return pd.to_numeric(column, downcast='integer')
+    non_null = column.dropna()
+    # Whole numbers without NULLs (e.g. DECIMAL(10, 0) columns) become integers; with NULLs they stay floats
+    if len(non_null) == len(column) and len(non_null) and (non_null % 1 == 0).all() and non_null.abs().max() < 2 ** 53:
+        return pd.to_numeric(column.astype(np.int64), downcast='integer')
+    downcast = column.astype(np.float32)
+    if np.allclose(downcast.to_numpy(dtype=np.float64), column.to_numpy(dtype=np.float64), rtol=1e-6, atol=0,
+                   equal_nan=True):
+        return downcast
+    return column
+
+
+def _optimize_column(name, column, category_ratio, numeric_columns):
+    if name in numeric_columns and _is_text(column):
+        column = _to_numeric(column)
+    elif _holds_numbers(column):
+        column = pd.to_numeric(column)
+    elif _is_text(column):
+        # The first rows rule out high-cardinality columns such as ids before the whole column is encoded
+        probe = column.iloc[:1000]
+        if len(column) and probe.nunique() <= category_ratio * len(probe):
+            categorical = column.astype('category')
+            if len(categorical.cat.categories) <= category_ratio * len(column):
+                return categorical
+        return column.copy()
+    return _downcast(column).copy()
+
+
+def optimize_dtypes(df, category_ratio=DEFAULT_CATEGORY_RATIO, numeric_columns=NUMERIC_COLUMNS):
+    """
+    Shrinks the memory of a DataFrame: the text columns named in `numeric_columns` and the numbers of numeric database
+    columns (e.g. Decimal values) are converted, numbers get the smallest dtype holding them, and text columns with few
+    distinct values become `category`. Other text columns stay text, even when their values are digits.
+    :param df: Required parameter, the DataFrame.
+    :param category_ratio: Optional parameter, the largest share of distinct values of a text column converted to
+    `category`, default is 0.5.
+    :param numeric_columns: Optional parameter, the names of the text columns converted to numbers,
+    default is ('TotalCharges',).
+    :return: A new DataFrame. Every column is copied, so none of them keeps the memory of `df` alive.
+    """
+    if not 0 <= category_ratio <= 1:
+        raise ValueError("category_ratio must be between 0 and 1")
+    return pd.DataFrame({name: _optimize_column(name, df[name], category_ratio, numeric_columns) for name in df.columns},
+                        columns=df.columns)
+
+
+def memory_usage(df):
+    # Bytes held by a DataFrame, including the Python objects of text columns
+    return int(df.memory_usage(deep=True).sum())
+
+
+def _kind(column):
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return 'category', column.cat.categories.dtype
+    if pd.api.types.is_bool_dtype(column.dtype):
+        return 'bool'
+    if pd.api.types.is_numeric_dtype(column.dtype):
+        return 'number'
+    return 'other'
+
+
+def _combine(chunks):
+    """
+    Concatenates optimized chunks. A column that is `category` in every chunk is combined with the union of the
+    categories, since pd.concat would otherwise fall back to object for categories that differ between chunks. A column
+    whose chunks were optimized into different kinds of dtype is combined from its values, as text when some chunks
+    hold numbers and others text, and optimize_dtypes then decides its dtype once over the whole table.
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+    combined = {}
+    for name in chunks[0].columns:
+        columns = [chunk[name] for chunk in chunks]
+        # Chunks where the column is entirely NULL tell nothing about its dtype
+        kinds = {_kind(column) for column in columns if column.notna().any()}
+        if len(kinds) > 1 and 'number' in kinds:
+            # Numbers in some chunks and text in others: the column is text
+            combined[name] = pd.concat([column.astype(str).where(column.notna()) for column in columns],
+                                       ignore_index=True)
+        elif len(kinds) > 1 or len({_kind(column) for column in columns}) > 1:
+            combined[name] = pd.concat([column.astype(object) for column in columns], ignore_index=True)
+        elif isinstance(columns[0].dtype, pd.CategoricalDtype):
+            combined[name] = pd.Series(union_categoricals(columns), name=name)
+        else:
+            combined[name] = pd.concat(columns, ignore_index=True)
+    return pd.DataFrame(combined, columns=chunks[0].columns)
+
+
+class LoadReport:
+    """
+    Size of a loaded table: rows, columns, bytes in memory and the number of category columns.
+    """
+
+    def __init__(self, df):
+        self.rows = len(df)
+        self.columns = len(df.columns)
+        self.memory_bytes = memory_usage(df)
+        self.category_columns = sum(isinstance(dtype, pd.CategoricalDtype) for dtype in df.dtypes)
+
+    def __str__(self):
+        return (f"{self.rows} rows x {self.columns} columns, {self.memory_bytes / 2 ** 20:.2f} MB in memory, "
+                f"{self.category_columns} category columns")
+
+
+def load_dataframe(sql_query, pool=None, chunk_size=DEFAULT_CHUNK_SIZE, category_ratio=DEFAULT_CATEGORY_RATIO,
+                   numeric_columns=NUMERIC_COLUMNS, timeout=None):
+    """
+    Loads the result of a query into a DataFrame chunk by chunk through a streaming cursor. Every chunk is optimized as
+    soon as it is read, so the full result never exists with Python-object columns.
+    :param sql_query: Required parameter, the SQL query.
+    :param pool: Optional parameter, the ConnectionPool, default is db.get_pool().
+    :param chunk_size: Optional parameter, the number of rows per chunk, default is 10000.
+    :param category_ratio: Optional parameter, see optimize_dtypes, default is 0.5.
+    :param numeric_columns: Optional parameter, see optimize_dtypes, default is ('TotalCharges',).
+    :param timeout: Optional parameter, the query timeout in seconds, default is the timeout of the session, see
+    sql_timeout.get_query_timeout. Raises sql_timeout.QueryTimeout when it is exceeded.
+    :return: The DataFrame and a LoadReport object.
+    """
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+    batches = stream_query(sql_query, pool=pool, batch_size=chunk_size, timeout=timeout)
+    try:
+        columns = next(batches)
+        chunks = []
+        for rows in batches:
+            chunk = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+            chunks.append(optimize_dtypes(chunk, category_ratio, numeric_columns))
+    finally:
+        batches.close()
+
+    if chunks:
+        # Columns whose dtype differed between chunks are optimized again over the whole table
+        df = optimize_dtypes(_combine(chunks), category_ratio, numeric_columns)
+    else:
+        df = pd.DataFrame(columns=columns)
+    return df, LoadReport(df)
+
+
+if __name__ == '__main__':
+    print("This file defines the chunked, dtype-optimized loading of SQL query results into DataFrames.")
@@ -0,0 +1,410 @@
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+import pymysql
+import pymysql.cursors
+from sql_timeout import QueryDeadline, get_query_timeout
+
+# Pool sizes and recycling delays, configurable through the environment
+DEFAULT_POOL_MIN_SIZE = int(os.getenv('MATEGEN_DB_POOL_MIN', 1))
+DEFAULT_POOL_MAX_SIZE = int(os.getenv('MATEGEN_DB_POOL_MAX', 10))
+DEFAULT_MAX_IDLE_SECONDS = float(os.getenv('MATEGEN_DB_POOL_MAX_IDLE', 300))
+DEFAULT_MAX_LIFETIME = float(os.getenv('MATEGEN_DB_POOL_MAX_LIFETIME', 3600))
+DEFAULT_CHECKOUT_TIMEOUT = float(os.getenv('MATEGEN_DB_POOL_TIMEOUT', 30))
+# Number of rows fetched at a time by stream_query
+DEFAULT_FETCH_SIZE = int(os.getenv('MATEGEN_DB_FETCH_SIZE', 1000))
+
+
+def mysql_config():
+    """
+    Reads the MySQL connection parameters from the environment: MYSQL_HOST (default localhost), MYSQL_PORT (3306),
+    MYSQL_USER (root), MYSQL_PW, MYSQL_DB (telco_db) and MYSQL_CHARSET (utf8).
+    :return: A dict of pymysql.connect parameters.
+    """
+    return {"host": os.getenv('MYSQL_HOST', 'localhost'),
+            "port": int(os.getenv('MYSQL_PORT', 3306)),
+            "user": os.getenv('MYSQL_USER', 'root'),
+            "passwd": os.getenv('MYSQL_PW'),
+            "db": os.getenv('MYSQL_DB', 'telco_db'),
+            "charset": os.getenv('MYSQL_CHARSET', 'utf8')}
+
+
+def mysql_connect(**overrides):
+    """
+    Opens a MySQL connection with the parameters of mysql_config().
+    :param overrides: Optional parameters replacing those of mysql_config().
+    :return: The pymysql connection.
+    """
+    config = mysql_config()
+    config.update(overrides)
+    return pymysql.connect(**config)
+
+
+def ping(connection):
+    """
+    Default health check of a pooled connection: a ping without reconnecting, or SELECT 1 for drivers without ping.
+    Raises an exception if the connection is no longer usable.
+    """
+    if hasattr(connection, 'ping'):
+        connection.ping(reconnect=False)
+        return
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    finally:
+        cursor.close()
+
+
+class _PooledConnection:
+    """
+    A connection owned by the pool, with the times used to recycle it.
+    """
+
+    __slots__ = ('connection', 'created', 'last_used')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = self.last_used = time.monotonic()
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of database connections shared by the SQL tools. It keeps between `min_size` and `max_size` connections,
+    checks a connection that has been idle for a while before handing it out, closes connections that stay idle too long
+    (down to `min_size`) or exceed their maximum lifetime, and makes callers wait when all connections are in use.
+    Connections are checked out for one query by default; pool.session() pins one connection to a block of code,
+    e.g. for queries relying on temporary tables or session variables.
+    """
+
+    def __init__(self, connect=mysql_connect, min_size=DEFAULT_POOL_MIN_SIZE, max_size=DEFAULT_POOL_MAX_SIZE,
+                 max_idle_seconds=DEFAULT_MAX_IDLE_SECONDS, max_lifetime=DEFAULT_MAX_LIFETIME,
+                 checkout_timeout=DEFAULT_CHECKOUT_TIMEOUT, health_check=ping, health_check_interval=30.0):
+        """
+        :param connect: Optional parameter, a callable without arguments opening a DB-API connection, default is mysql_connect.
+        :param min_size: Optional parameter, the number of connections kept open even when idle, default is 1.
+        :param max_size: Optional parameter, the maximum number of open connections, default is 10.
+        :param max_idle_seconds: Optional parameter, the idle time after which a connection above min_size is closed, default is 300.
+        :param max_lifetime: Optional parameter, the age after which a connection is replaced, default is 3600 seconds.
+        :param checkout_timeout: Optional parameter, how long to wait for a free connection before raising TimeoutError, default is 30 seconds.
+        :param health_check: Optional parameter, a callable raising an exception for a broken connection, or None, default is ping.
+        :param health_check_interval: Optional parameter, the idle time after which a connection is checked before reuse, default is 30 seconds.
+        """
+        if max_size < 1 or not 0 <= min_size <= max_size:
+            raise ValueError(f"Invalid pool sizes: min_size {min_size}, max_size {max_size}")
+        if checkout_timeout <= 0:
+            raise ValueError(f"Invalid checkout timeout: {checkout_timeout}")
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.max_lifetime = max_lifetime
+        self.checkout_timeout = checkout_timeout
+        self.health_check = health_check
+        self.health_check_interval = health_check_interval
+        self._idle = deque()  # Most recently used last, so warm connections are reused first
+        self._size = 0  # Open connections, idle or checked out
+        self._condition = threading.Condition()
+        self._session = contextvars.ContextVar(f'mategen_db_session_{id(self)}', default=None)
+        self._closed = False
+        # Counters
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def _open(self):
+        try:
+            pooled = _PooledConnection(self.connect())
+        except BaseException:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self.created += 1
+        return pooled
+
+    def _close(self, pooled):
+        try:
+            pooled.connection.close()
+        except Exception:
+            pass
+
+    def _expired(self, pooled, now):
+        return self.max_lifetime is not None and now - pooled.created > self.max_lifetime
+
+    def _healthy(self, pooled, now):
+        if self.health_check is None or now - pooled.last_used < self.health_check_interval:
+            return True
+        try:
+            self.health_check(pooled.connection)
+        except Exception:
+            return False
+        return True
+
+    # Method to close the connections idle for longer than max_idle_seconds, keeping at least min_size open
+    def prune(self):
+        now = time.monotonic()
+        to_close = []
+        with self._condition:
+            while self._idle and self._size > self.min_size and \
+                    now - self._idle[0].last_used > self.max_idle_seconds:
+                to_close.append(self._idle.popleft())
+                self._size -= 1
+            self.discarded += len(to_close)
+        for pooled in to_close:
+            self._close(pooled)
+
+    def acquire(self, timeout=None):
+        """
+        Checks out a connection, waiting for one to be released if the pool is at max_size.
+        :param timeout: Optional parameter, the maximum wait in seconds, default is the pool's checkout_timeout.
+        :return: A _PooledConnection to be passed back to release.
+        """
+        timeout = self.checkout_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        self.prune()
+        while True:
+            with self._condition:
+                if self._closed:
+                    raise RuntimeError("The connection pool is closed")
+                waited_from = None
+                while not self._idle and self._size >= self.max_size:
+                    if waited_from is None:
+                        waited_from = time.monotonic()
+                        self.waits += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.wait_seconds += time.monotonic() - waited_from
+                        raise TimeoutError(f"No database connection became free within {timeout} seconds "
+                                           f"({self.max_size} connections in use)")
+                    self._condition.wait(remaining)
+                if waited_from is not None:
+                    self.wait_seconds += time.monotonic() - waited_from
+                if self._idle:
+                    pooled = self._idle.pop()
+                else:
+                    pooled = None
+                    self._size += 1  # Reserve the slot before connecting outside the lock
+
+            if pooled is None:
+                return self._open()
+
+            now = time.monotonic()
+            if not self._expired(pooled, now) and self._healthy(pooled, now):
+                with self._condition:
+                    self.reused += 1
+                return pooled
+            # Broken or too old: drop it and try again
+            self._discard(pooled)
+
+    def _discard(self, pooled):
+        self._close(pooled)
+        with self._condition:
+            self._size -= 1
+            self.discarded += 1
+            self._condition.notify()
+
+    def release(self, pooled, discard=False):
+        """
+        Returns a connection to the pool. Its transaction is rolled back, so that the next user starts from a clean state
+        and does not read from a stale snapshot.
+        :param pooled: Required parameter, the object returned by acquire.
+        :param discard: Optional parameter, whether to close the connection instead of reusing it, default is False.
+        """
+        if not discard:
+            try:
+                pooled.connection.rollback()
+            except Exception:
+                discard = True
+        if discard or self._closed:
+            self._discard(pooled)
+            return
+        pooled.last_used = time.monotonic()
+        with self._condition:
+            self._idle.append(pooled)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Checks out a connection for the block, or uses the connection pinned by an enclosing session().
+        :param timeout: Optional parameter, the maximum wait for a free connection in seconds, default is the pool's checkout_timeout.
+        """
+        pinned = self._session.get()
+        if pinned is not None:
+            yield pinned.connection
+            return
+        pooled = self.acquire(timeout)
+        try:
+            yield pooled.connection
+        except BaseException:
+            self.release(pooled, discard=not self._usable(pooled))
+            raise
+        self.release(pooled)
+
+    @contextmanager
+    def session(self, timeout=None):
+        """
+        Pins one connection to the block: every pool.connection() inside it, in the same thread or task, uses that connection.
+        :param timeout: Optional parameter, the maximum wait for a free connection in seconds, default is the pool's checkout_timeout.
+        """
+        if self._session.get() is not None:
+            yield self._session.get().connection
+            return
+        pooled = self.acquire(timeout)
+        token = self._session.set(pooled)
+        try:
+            yield pooled.connection
+        except BaseException:
+            self._session.reset(token)
+            self.release(pooled, discard=not self._usable(pooled))
+            raise
+        self._session.reset(token)
+        self.release(pooled)
+
+    # After a failed query, keep the connection only if it still answers
+    def _usable(self, pooled):
+        if self.health_check is None:
+            return True
+        try:
+            self.health_check(pooled.connection)
+        except Exception:
+            return False
+        return True
+
+    def close(self):
+        """
+        Closes the idle connections; connections still checked out are closed when they are released.
+        """
+        with self._condition:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for pooled in idle:
+            self._close(pooled)
+
+    def stats(self):
+        """
+        :return: A dict with the open, idle and checked out connections, the connections created, reused and discarded,
+        and the number and total seconds of checkouts that had to wait.
+        """
+        with self._condition:
+            return {"size": self._size,
+                    "idle": len(self._idle),
+                    "in_use": self._size - len(self._idle),
+                    "created": self.created,
+                    "reused": self.reused,
+                    "discarded": self.discarded,
+                    "waits": self.waits,
+                    "wait_seconds": round(self.wait_seconds, 3)}
+
+
+def streaming_cursor(connection):
+    """
+    Opens a cursor that reads the result set from the server as it is fetched instead of buffering it:
+    an SSCursor for MySQL, and the default cursor for drivers that already stream (e.g. sqlite3).
+    :param connection: Required parameter, a DB-API connection.
+    :return: The cursor.
+    """
+    if isinstance(connection, pymysql.connections.Connection):
+        return connection.cursor(pymysql.cursors.SSCursor)
+    return connection.cursor()
+
+
+def stream_query(sql_query, pool=None, batch_size=DEFAULT_FETCH_SIZE, timeout=None):
+    """
+    Runs a query with a streaming cursor on a pooled connection. Yields the list of column names first, then the rows
+    in batches of at most `batch_size`, so the result set is never held in memory as a whole.
+    If the caller stops reading early, the connection is closed rather than draining the remaining rows from the server,
+    unless it is pinned by pool.session().
+    A query still running after its timeout is cancelled on the server and sql_timeout.QueryTimeout is raised.
+    :param sql_query: Required parameter, the SQL query.
+    :param pool: Optional parameter, the ConnectionPool, default is get_pool().
+    :param batch_size: Optional parameter, the number of rows fetched at a time, default is 1000.
+    :param timeout: Optional parameter, the timeout in seconds (0 for none), default is the timeout of the session,
+    see sql_timeout.get_query_timeout.
+    """
+    pool = pool if pool is not None else get_pool()
+    timeout = get_query_timeout(timeout)
+    pinned = pool._session.get()
+    pooled = pinned if pinned is not None else pool.acquire()
+    cursor = deadline = None
+    streaming = finished = timed_out = False
+    try:
+        cursor = streaming_cursor(pooled.connection)
+        if timeout is not None:
+            deadline = QueryDeadline(pooled.connection, pool.connect, sql_query, timeout)
+            deadline.start()
+        try:
+            cursor.execute(deadline.prepare() if deadline is not None else sql_query)
+            streaming = True
+            yield [column[0] for column in cursor.description or ()]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        except Exception as e:
+            query_timeout = deadline.timed_out(e) if deadline is not None else None
+            if query_timeout is None:
+                raise
+            timed_out = True
+            raise query_timeout from e
+        finished = True
+    finally:
+        if deadline is not None:
+            deadline.stop()
+        # A cancelled query may leave unread packets behind, so its connection is not reused
+        abandoned = (streaming and not finished or timed_out) and pinned is None
+        if cursor is not None and not abandoned:
+            try:
+                cursor.close()
+            except Exception:
+                abandoned = pinned is None
+        if pinned is None:
+            # A failed query leaves the connection usable unless the failure was the connection itself
+            pool.release(pooled, discard=abandoned or (not streaming and not pool._usable(pooled)))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process-wide pool used by the SQL tools, creating a pool of the backend chosen by the MATEGEN_SQL_BACKEND
+    environment variable on first use (MySQL by default, see sql_backend.get_backend).
+    :return: The shared ConnectionPool object.
+    """
+    global _pool
+    if _pool is None:
+        # Imported here because the backends are built on this module
+        from sql_backend import get_backend
+        backend = get_backend()
+        with _pool_lock:
+            if _pool is None:
+                _pool = backend.create_pool()
+    return _pool
+
+
+def set_pool(pool):
+    """
+    Replaces the pool used by the SQL tools, closing the previous one.
+    :param pool: Required parameter, a ConnectionPool object, or None to return to a pool of the default backend.
+    """
+    global _pool
+    with _pool_lock:
+        previous, _pool = _pool, pool
+    if previous is not None and previous is not pool:
+        previous.close()
+
+
+if __name__ == '__main__':
+    print("This file defines the database connection pool shared by the SQL tools.")
@@ -27,6 +27,8 @@ from bs4 import BeautifulSoup
 import dateutil.parser as parser
 
 import sys
+from llm_backend import chat_completion
+from response_cache import cached_chat_completion, is_valid_json_content
 
 sys.path.insert(0, './functions/untested functions')
 sys.path.insert(0, './functions/tested functions')
@@ -56,7 +58,7 @@ def check_code_run(messages, functions_list=None, model="gpt-4-0613", function_c
     """
 
     if functions_list is None:
-        response = openai.ChatCompletion.create(
+        response = chat_completion(
             model=model,
             messages=messages,
         )
@@ -68,7 +70,7 @@ def check_code_run(messages, functions_list=None, model="gpt-4-0613", function_c
     available_functions = {func.__name__: func for func in functions_list}
 
     # First call to the model
-    response = openai.ChatCompletion.create(
+    response = chat_completion(
         model=model,
         messages=messages,
         functions=functions,
@@ -99,7 +101,7 @@ def check_code_run(messages, functions_list=None, model="gpt-4-0613", function_c
             "content": function_response,
         })
 
-        second_response = openai.ChatCompletion.create(
+        second_response = chat_completion(
             model=model,
             messages=messages,
         )
@@ -165,14 +167,16 @@ def auto_functions(functions_list):
                 f"Now, based on this example, create a function object for the function '{function_name}' with description: {function_desc}."
             )
 
-            response = openai.ChatCompletion.create(
+            messages = [
+                {"role": "user", "name": "example_user", "content": user_msg1},
+                {"role": "assistant", "name": "example_assistant", "content": assistant_msg1},
+                {"role": "user", "name": "example_user", "content": user_prompt}
+            ]
+            response = cached_chat_completion(
+                lambda: chat_completion(model="gpt-4-0613", messages=messages),
                 model="gpt-4-0613",
-                messages=[
-                    {"role": "user", "name": "example_user", "content": user_msg1},
-                    {"role": "assistant", "name": "example_assistant", "content": assistant_msg1},
-                    {"role": "user", "name": "example_user", "content": user_prompt}
-                ]
-            )
+                messages=messages,
+                validate=is_valid_json_content)
             functions.append(json.loads(response.choices[0].message['content']))
         return functions
 
@@ -203,7 +207,7 @@ def run_conversation(messages, functions_list=None, model="gpt-4-0613", function
     """
 
     if functions_list is None:
-        response = openai.ChatCompletion.create(
+        response = chat_completion(
             model=model,
             messages=messages,
         )
@@ -212,7 +216,7 @@ def run_conversation(messages, functions_list=None, model="gpt-4-0613", function
     functions = auto_functions(functions_list)
     available_functions = {func.__name__: func for func in functions_list}
 
-    response = openai.ChatCompletion.create(
+    response = chat_completion(
         model=model,
         messages=messages,
         functions=functions,
@@ -234,7 +238,7 @@ def run_conversation(messages, functions_list=None, model="gpt-4-0613", function
             "content": function_response,
         })
 
-        second_response = openai.ChatCompletion.create(
+        second_response = chat_completion(
             model=model,
             messages=messages,
         )
@@ -383,24 +387,21 @@ def code_generate(req, few_shot='all', model='gpt-4-0613', g=globals(), detail=0
 
     few_shot_messages_CD.append({"role": "user", "content": req})
 
-    response = openai.ChatCompletion.create(
-        model=model,
-        messages=few_shot_messages_CD
-    )
+    response = cached_chat_completion(lambda: chat_completion(model=model, messages=few_shot_messages_CD),
+                                      model=model,
+                                      messages=few_shot_messages_CD)
     new_req_pi = response.choices[0].message['content']
 
     few_shot_messages_CM.append({"role": "user", "content": req + new_req_pi})
-    response = openai.ChatCompletion.create(
-        model=model,
-        messages=few_shot_messages_CM
-    )
+    response = cached_chat_completion(lambda: chat_completion(model=model, messages=few_shot_messages_CM),
+                                      model=model,
+                                      messages=few_shot_messages_CM)
     new_req_description = response.choices[0].message['content']
 
     few_shot_messages.append({"role": "user", "content": new_req_description})
-    response = openai.ChatCompletion.create(
-        model=model,
-        messages=few_shot_messages
-    )
+    response = cached_chat_completion(lambda: chat_completion(model=model, messages=few_shot_messages),
+                                      model=model,
+                                      messages=few_shot_messages)
     new_req_function = response.choices[0].message['content']
 
     function_name = extract_function_code(new_req_function, detail=detail, g=g)
@@ -441,7 +442,7 @@ def prompt_modified(function_name, system_content='inference_chain_modification.
     msg_str = json.dumps(msg)
     
     # Perform review
-    response = openai.ChatCompletion.create(
+    response = chat_completion(
                     model=model,
                     messages=[
                     {"role": "system", "content": md_content},
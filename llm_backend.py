@@ -0,0 +1,378 @@
+import json
+import math
+import time
+import random
+import asyncio
+import threading
+import openai
+from openai.util import convert_to_openai_object
+from tokenizer import count_tokens
+from response_cache import make_cache_key
+
+
+class LLMBackend:
+    """
+    Interface between MateGen and a Chat completion service. Every model call of the project goes through the current
+    backend, so the OpenAI API can be swapped for an offline stand-in when profiling or load-testing the agent loop.
+    Subclasses implement create, and acreate when they can wait without blocking the event loop.
+    """
+
+    def create(self, **kwargs):
+        """
+        Sends a Chat completion request.
+        :param kwargs: The parameters of openai.ChatCompletion.create (model, messages, functions, function_call, stream, ...).
+        :return: The ChatCompletion response, or an iterator of chunks when stream=True.
+        """
+        raise NotImplementedError
+
+    async def acreate(self, **kwargs):
+        """
+        Async version of create. By default create runs on a worker thread.
+        :return: The ChatCompletion response, or an async iterator of chunks when stream=True.
+        """
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, lambda: self.create(**kwargs))
+        if kwargs.get("stream"):
+            return _iterate_in_executor(response)
+        return response
+
+
+async def _iterate_in_executor(chunks):
+    loop = asyncio.get_running_loop()
+    iterator = iter(chunks)
+    sentinel = object()
+    while True:
+        chunk = await loop.run_in_executor(None, next, iterator, sentinel)
+        if chunk is sentinel:
+            return
+        yield chunk
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    The OpenAI API, through openai.ChatCompletion.
+    """
+
+    def create(self, **kwargs):
+        return openai.ChatCompletion.create(**kwargs)
+
+    async def acreate(self, **kwargs):
+        return await openai.ChatCompletion.acreate(**kwargs)
+
+
+class FixedLatency:
+    """
+    Always the same latency.
+    """
+
+    def __init__(self, seconds):
+        if seconds < 0:
+            raise ValueError(f"Invalid latency: {seconds}")
+        self.seconds = seconds
+
+    def sample(self, rng):
+        return self.seconds
+
+
+class UniformLatency:
+    """
+    Latency drawn uniformly between `low` and `high` seconds.
+    """
+
+    def __init__(self, low, high):
+        if not 0 <= low <= high:
+            raise ValueError(f"Invalid latency range: {low} - {high}")
+        self.low = low
+        self.high = high
+
+    def sample(self, rng):
+        return rng.uniform(self.low, self.high)
+
+
+class LogNormalLatency:
+    """
+    Long-tailed latency, the usual shape of API response times: the median is `median` seconds,
+    and `p99` seconds is exceeded by 1% of the calls.
+    """
+
+    def __init__(self, median, p99):
+        if not 0 < median <= p99:
+            raise ValueError(f"Invalid latency distribution: median {median}, p99 {p99}")
+        self.median = median
+        self.p99 = p99
+        # 2.326 is the 99th percentile of the standard normal distribution
+        self.sigma = math.log(p99 / median) / 2.326
+
+    def sample(self, rng):
+        return rng.lognormvariate(math.log(self.median), self.sigma)
+
+
+def text_message(content):
+    """
+    :param content: Required parameter, the answer text.
+    :return: An assistant message with text content, for ScriptedBackend scripts.
+    """
+    return {"role": "assistant", "content": content}
+
+
+def function_call_message(name, arguments):
+    """
+    :param name: Required parameter, the name of the function to call.
+    :param arguments: Required parameter, the arguments as a dict or a JSON string.
+    :return: An assistant message calling a function, for ScriptedBackend scripts.
+    """
+    if not isinstance(arguments, str):
+        arguments = json.dumps(arguments)
+    return {"role": "assistant", "content": None, "function_call": {"name": name, "arguments": arguments}}
+
+
+def tool_calls_message(calls):
+    """
+    :param calls: Required parameter, a list of (name, arguments) pairs, the arguments as a dict or a JSON string.
+    :return: An assistant message requesting several tool calls in one turn, for ScriptedBackend scripts.
+    """
+    tool_calls = []
+    for i, (name, arguments) in enumerate(calls):
+        if not isinstance(arguments, str):
+            arguments = json.dumps(arguments)
+        tool_calls.append({"id": f"call_{i}", "type": "function", "function": {"name": name, "arguments": arguments}})
+    return {"role": "assistant", "content": None, "tool_calls": tool_calls}
+
+
+class ScriptedBackend(LLMBackend):
+    """
+    Offline, deterministic stand-in for the OpenAI API. Answers come from a script and are delivered after a latency
+    drawn from a seeded distribution, with the same response and stream chunk shapes as the API, so the whole pipeline
+    can be run and benchmarked without network access or cost.
+    The script can be:
+    - a list of messages, served in order (the last one is repeated once the list is exhausted, or the list restarts if cycle=True);
+    - a callable receiving the request parameters and returning a message;
+    - a dict mapping response_cache.make_cache_key(model, messages, functions, function_call) to a message, as written by RecordingBackend.
+    """
+
+    def __init__(self, script, latency=None, tokens_per_second=None, seed=0, cycle=False):
+        """
+        :param script: Required parameter, the list, callable or dict producing the answers.
+        :param latency: Optional parameter, a latency model (FixedLatency, UniformLatency, LogNormalLatency) for the time to the
+        first token, default is no latency.
+        :param tokens_per_second: Optional parameter, the generation speed after the first token, default is None (instantaneous).
+        :param seed: Optional parameter, the seed of the latency sampling, default is 0.
+        :param cycle: Optional parameter, whether a list script restarts once exhausted, default is False.
+        """
+        if isinstance(script, (list, tuple)) and not script:
+            raise ValueError("The script must contain at least one message")
+        if tokens_per_second is not None and tokens_per_second <= 0:
+            raise ValueError(f"Invalid generation speed: {tokens_per_second}")
+        self.script = script
+        self.latency = latency if latency is not None else FixedLatency(0)
+        self.tokens_per_second = tokens_per_second
+        self.cycle = cycle
+        self._rng = random.Random(seed)
+        self._position = 0
+        self._lock = threading.Lock()
+        self.num_calls = 0
+
+    @classmethod
+    def from_recording(cls, path, **kwargs):
+        """
+        Creates a backend replaying the responses recorded by RecordingBackend.
+        :param path: Required parameter, the JSONL file written by RecordingBackend.
+        :param kwargs: Optional parameters passed to ScriptedBackend.
+        :return: The ScriptedBackend object.
+        """
+        recording = {}
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    recording[entry["key"]] = entry["message"]
+        return cls(recording, **kwargs)
+
+    def _next_message(self, kwargs):
+        if callable(self.script):
+            return self.script(kwargs)
+        if isinstance(self.script, dict):
+            key = make_cache_key(kwargs.get("model"), kwargs.get("messages"), kwargs.get("functions") or kwargs.get("tools"),
+                                 kwargs.get("function_call") or kwargs.get("tool_choice"))
+            if key not in self.script:
+                raise KeyError("No recorded response for this request")
+            return self.script[key]
+        with self._lock:
+            index = self._position % len(self.script) if self.cycle else min(self._position, len(self.script) - 1)
+            self._position += 1
+        return self.script[index]
+
+    def _prepare(self, kwargs):
+        message = dict(self._next_message(kwargs))
+        model = kwargs.get("model", "gpt-3.5-turbo")
+        with self._lock:
+            self.num_calls += 1
+            first_token_latency = self.latency.sample(self._rng)
+        prompt_tokens = sum(count_tokens(str(m.get("content") or ""), model) for m in kwargs.get("messages") or [])
+        function_calls = [message.get("function_call") or {}] + \
+            [tool_call["function"] for tool_call in message.get("tool_calls") or ()]
+        completion_text = (message.get("content") or "") + \
+            "".join((call.get("name") or "") + (call.get("arguments") or "") for call in function_calls)
+        completion_tokens = count_tokens(completion_text, model) if completion_text else 0
+        generation_time = completion_tokens / self.tokens_per_second if self.tokens_per_second else 0.0
+        return message, model, first_token_latency, generation_time, prompt_tokens, completion_tokens
+
+    def _response(self, message, model, prompt_tokens, completion_tokens):
+        return convert_to_openai_object({
+            "id": f"scripted-{self.num_calls}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": self._finish_reason(message)}],
+            "usage": {"prompt_tokens": prompt_tokens,
+                      "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens}})
+
+    @staticmethod
+    def _finish_reason(message):
+        if message.get("tool_calls"):
+            return "tool_calls"
+        return "function_call" if message.get("function_call") else "stop"
+
+    @classmethod
+    def _chunks(cls, message, model):
+        chunk = {"object": "chat.completion.chunk", "model": model}
+        yield dict(chunk, choices=[{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}])
+        function_call = message.get("function_call")
+        if function_call:
+            yield dict(chunk, choices=[{"index": 0, "delta": {"function_call": {"name": function_call["name"],
+                                                                                "arguments": ""}},
+                                        "finish_reason": None}])
+            arguments = function_call.get("arguments") or ""
+            for i in range(0, len(arguments), 16):
+                yield dict(chunk, choices=[{"index": 0, "delta": {"function_call": {"arguments": arguments[i:i + 16]}},
+                                            "finish_reason": None}])
+        elif message.get("tool_calls"):
+            for index, tool_call in enumerate(message["tool_calls"]):
+                function = tool_call["function"]
+                yield dict(chunk, choices=[{"index": 0, "delta": {"tool_calls": [
+                    {"index": index, "id": tool_call["id"], "type": "function",
+                     "function": {"name": function["name"], "arguments": ""}}]}, "finish_reason": None}])
+                arguments = function.get("arguments") or ""
+                for i in range(0, len(arguments), 16):
+                    yield dict(chunk, choices=[{"index": 0, "delta": {"tool_calls": [
+                        {"index": index, "function": {"arguments": arguments[i:i + 16]}}]}, "finish_reason": None}])
+        else:
+            # Split after each space, roughly one token per chunk like the API
+            words = (message.get("content") or "").split(" ")
+            for i, word in enumerate(words):
+                delta = word + " " if i < len(words) - 1 else word
+                yield dict(chunk, choices=[{"index": 0, "delta": {"content": delta}, "finish_reason": None}])
+        yield dict(chunk, choices=[{"index": 0, "delta": {}, "finish_reason": cls._finish_reason(message)}])
+
+    def create(self, **kwargs):
+        message, model, first_token_latency, generation_time, prompt_tokens, completion_tokens = self._prepare(kwargs)
+        if not kwargs.get("stream"):
+            time.sleep(first_token_latency + generation_time)
+            return self._response(message, model, prompt_tokens, completion_tokens)
+
+        def stream():
+            time.sleep(first_token_latency)
+            chunks = list(self._chunks(message, model))
+            delay = generation_time / len(chunks)
+            for chunk in chunks:
+                yield convert_to_openai_object(chunk)
+                if delay:
+                    time.sleep(delay)
+        return stream()
+
+    async def acreate(self, **kwargs):
+        message, model, first_token_latency, generation_time, prompt_tokens, completion_tokens = self._prepare(kwargs)
+        if not kwargs.get("stream"):
+            await asyncio.sleep(first_token_latency + generation_time)
+            return self._response(message, model, prompt_tokens, completion_tokens)
+
+        async def stream():
+            await asyncio.sleep(first_token_latency)
+            chunks = list(self._chunks(message, model))
+            delay = generation_time / len(chunks)
+            for chunk in chunks:
+                yield convert_to_openai_object(chunk)
+                if delay:
+                    await asyncio.sleep(delay)
+        return stream()
+
+
+class RecordingBackend(LLMBackend):
+    """
+    Wraps another backend and appends every (request, answer) pair to a JSONL file,
+    which ScriptedBackend.from_recording replays offline. Streamed requests are passed through without being recorded.
+    """
+
+    def __init__(self, backend, path):
+        """
+        :param backend: Required parameter, the LLMBackend answering the requests, usually OpenAIBackend().
+        :param path: Required parameter, the JSONL file the answers are appended to.
+        """
+        self.backend = backend
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _record(self, kwargs, response):
+        key = make_cache_key(kwargs.get("model"), kwargs.get("messages"), kwargs.get("functions") or kwargs.get("tools"),
+                             kwargs.get("function_call") or kwargs.get("tool_choice"))
+        entry = {"key": key, "message": response["choices"][0]["message"]}
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def create(self, **kwargs):
+        response = self.backend.create(**kwargs)
+        if not kwargs.get("stream"):
+            self._record(kwargs, response)
+        return response
+
+    async def acreate(self, **kwargs):
+        response = await self.backend.acreate(**kwargs)
+        if not kwargs.get("stream"):
+            self._record(kwargs, response)
+        return response
+
+
+_backend = None
+
+
+def set_backend(backend):
+    """
+    Sets the backend used by every model call of the process.
+    :param backend: Required parameter, an LLMBackend object, or None to return to the OpenAI API.
+    """
+    global _backend
+    if backend is not None and not isinstance(backend, LLMBackend):
+        raise ValueError(f"Invalid LLM backend: {backend!r}")
+    _backend = backend
+
+
+def get_backend():
+    """
+    :return: The current LLMBackend; OpenAIBackend() unless set_backend was called.
+    """
+    global _backend
+    if _backend is None:
+        _backend = OpenAIBackend()
+    return _backend
+
+
+def chat_completion(**kwargs):
+    """
+    Sends a Chat completion request through the current backend; takes the parameters of openai.ChatCompletion.create.
+    :return: The ChatCompletion response.
+    """
+    return get_backend().create(**kwargs)
+
+
+async def achat_completion(**kwargs):
+    """
+    Async version of chat_completion; takes the parameters of openai.ChatCompletion.acreate.
+    :return: The ChatCompletion response.
+    """
+    return await get_backend().acreate(**kwargs)
+
+
+if __name__ == '__main__':
+    print("This file defines the pluggable LLM backends: the OpenAI API and an offline scripted stand-in.")
@@ -0,0 +1,247 @@
+import json
+import threading
+from tokenizer import get_encoding, count_document_tokens
+
+
+class ModelProfile:
+    """
+    Describes the limits and the token accounting rules of a Chat model: the size of the context window, how many tokens
+    are reserved for the model's answer, and the fixed overhead the API adds to every message and to every request.
+    """
+
+    def __init__(self, name, context_window, max_output_tokens, tokens_per_message=3, tokens_per_name=1,
+                 reply_priming_tokens=3):
+        """
+        :param name: Required parameter, the model name or model name prefix the profile applies to.
+        :param context_window: Required parameter, the total number of tokens the model accepts (input plus output).
+        :param max_output_tokens: Required parameter, the number of tokens reserved for the model's answer.
+        :param tokens_per_message: Optional parameter, the overhead added to every message, default is 3.
+        :param tokens_per_name: Optional parameter, the overhead added when a message has a 'name' key, default is 1.
+        :param reply_priming_tokens: Optional parameter, the overhead added once per request to prime the answer, default is 3.
+        """
+        self.name = name
+        self.context_window = context_window
+        self.max_output_tokens = max_output_tokens
+        self.tokens_per_message = tokens_per_message
+        self.tokens_per_name = tokens_per_name
+        self.reply_priming_tokens = reply_priming_tokens
+
+    # Number of tokens the request itself (messages plus function schemas) may use
+    @property
+    def input_budget(self):
+        return self.context_window - self.max_output_tokens
+
+    def __repr__(self):
+        return (f"ModelProfile(name={self.name!r}, context_window={self.context_window}, "
+                f"max_output_tokens={self.max_output_tokens})")
+
+
+# Known models, keyed by name; a model matches the longest registered name it starts with
+MODEL_PROFILES = {}
+_resolved_profiles = {}
+_profiles_lock = threading.Lock()
+
+DEFAULT_PROFILE = ModelProfile('default', context_window=4096, max_output_tokens=1024)
+
+
+def register_model_profile(profile):
+    """
+    Adds or replaces a model profile.
+    :param profile: Required parameter, a ModelProfile object; its name is matched as a model name prefix.
+    """
+    with _profiles_lock:
+        MODEL_PROFILES[profile.name] = profile
+        _resolved_profiles.clear()
+
+
+for _profile in [
+    ModelProfile('gpt-3.5-turbo', context_window=4096, max_output_tokens=1024),
+    ModelProfile('gpt-3.5-turbo-0301', context_window=4096, max_output_tokens=1024, tokens_per_message=4, tokens_per_name=-1),
+    ModelProfile('gpt-3.5-turbo-16k', context_window=16385, max_output_tokens=4096),
+    ModelProfile('gpt-3.5-turbo-1106', context_window=16385, max_output_tokens=4096),
+    ModelProfile('gpt-3.5-turbo-0125', context_window=16385, max_output_tokens=4096),
+    ModelProfile('gpt-4', context_window=8192, max_output_tokens=1024),
+    ModelProfile('gpt-4-32k', context_window=32768, max_output_tokens=4096),
+    ModelProfile('gpt-4-1106', context_window=128000, max_output_tokens=4096),
+    ModelProfile('gpt-4-0125', context_window=128000, max_output_tokens=4096),
+    ModelProfile('gpt-4-turbo', context_window=128000, max_output_tokens=4096),
+    ModelProfile('gpt-4o', context_window=128000, max_output_tokens=4096),
+]:
+    register_model_profile(_profile)
+
+
+def get_model_profile(model):
+    """
+    Returns the profile of a model, matching the longest registered name the model name starts with
+    (e.g. 'gpt-3.5-turbo-16k-0613' uses the 'gpt-3.5-turbo-16k' profile).
+    :param model: Required parameter, the name of the model.
+    :return: The ModelProfile object, or DEFAULT_PROFILE for unknown models.
+    """
+    profile = _resolved_profiles.get(model)
+    if profile is None:
+        with _profiles_lock:
+            matches = [name for name in MODEL_PROFILES if model.startswith(name)]
+            profile = MODEL_PROFILES[max(matches, key=len)] if matches else DEFAULT_PROFILE
+            _resolved_profiles[model] = profile
+    return profile
+
+
+def count_message_tokens(message, model="gpt-3.5-turbo", document=False):
+    """
+    Counts the tokens one message takes in a request, including the per-message overhead added by the API.
+    :param message: Required parameter, a message dict (or Message record).
+    :param model: Optional parameter, the name of the model, default is 'gpt-3.5-turbo'.
+    :param document: Optional parameter, whether the content is a static document to be counted through the disk token cache, default is False.
+    :return: The number of tokens.
+    """
+    profile = get_model_profile(model)
+    encoding = get_encoding(model)
+
+    tokens = profile.tokens_per_message + len(encoding.encode(message["role"]))
+
+    content = message.get("content")
+    if content:
+        content = content if isinstance(content, str) else str(content)
+        tokens += count_document_tokens(content, model) if document else len(encoding.encode(content))
+
+    name = message.get("name")
+    if name:
+        tokens += len(encoding.encode(name)) + profile.tokens_per_name
+
+    function_call = message.get("function_call")
+    if function_call:
+        tokens += len(encoding.encode(function_call.get("name") or ""))
+        tokens += len(encoding.encode(function_call.get("arguments") or ""))
+        tokens += 3
+
+    # Parallel tool calls and the id linking a tool result to its call
+    for tool_call in message.get("tool_calls") or ():
+        function = tool_call.get("function") or {}
+        tokens += len(encoding.encode(function.get("name") or ""))
+        tokens += len(encoding.encode(function.get("arguments") or ""))
+        tokens += 3
+    tool_call_id = message.get("tool_call_id")
+    if tool_call_id:
+        tokens += len(encoding.encode(tool_call_id))
+
+    return tokens
+
+
+def _format_schema_type(schema, indent):
+    """
+    Renders a JSON schema type the way the API renders function parameters for the model.
+    """
+    if "enum" in schema:
+        return " | ".join(json.dumps(value) for value in schema["enum"])
+
+    schema_type = schema.get("type")
+    if schema_type == "object":
+        properties = schema.get("properties")
+        if not properties:
+            return "object"
+        return "{\n" + _format_object_properties(schema, indent + 1) + "\n" + "  " * indent + "}"
+    if schema_type == "array":
+        items = schema.get("items")
+        return f"{_format_schema_type(items, indent)}[]" if items else "any[]"
+    if schema_type in ("integer", "number"):
+        return "number"
+    if schema_type in ("string", "boolean", "null"):
+        return schema_type
+    return "any"
+
+
+def _format_object_properties(schema, indent):
+    required = set(schema.get("required", []))
+    lines = []
+    for name, property_schema in schema.get("properties", {}).items():
+        description = property_schema.get("description")
+        if description:
+            lines.append("  " * indent + f"// {description}")
+        optional = "" if name in required else "?"
+        lines.append("  " * indent + f"{name}{optional}: {_format_schema_type(property_schema, indent)},")
+    return "\n".join(lines)
+
+
+def format_function_definitions(functions):
+    """
+    Renders the `functions` parameter of a request into the text the API actually places in the model's context.
+    :param functions: Required parameter, the list of function descriptions sent to the Chat model.
+    :return: The rendered string.
+    """
+    lines = ["namespace functions {", ""]
+    for function in functions:
+        description = function.get("description")
+        if description:
+            lines.append(f"// {description}")
+        parameters = function.get("parameters") or {}
+        if parameters.get("properties"):
+            lines.append(f"type {function['name']} = (_: {{")
+            lines.append(_format_object_properties(parameters, 0))
+            lines.append("}) => any;")
+        else:
+            lines.append(f"type {function['name']} = () => any;")
+        lines.append("")
+    lines.append("} // namespace functions")
+    return "\n".join(lines)
+
+
+_functions_tokens_cache = {}
+
+
+def count_functions_tokens(functions, model="gpt-3.5-turbo"):
+    """
+    Counts the tokens the function schemas add to every request. The result is cached per schema list,
+    since AvailableFunctions sends the same schemas on every call.
+    :param functions: Required parameter, the list of function descriptions, may be None or empty.
+    :param model: Optional parameter, the name of the model, default is 'gpt-3.5-turbo'.
+    :return: The number of tokens.
+    """
+    if not functions:
+        return 0
+    key = (get_encoding(model).name, json.dumps(functions, sort_keys=True))
+    tokens = _functions_tokens_cache.get(key)
+    if tokens is None:
+        # The rendered definitions are wrapped in a system section, which adds a fixed overhead
+        tokens = len(get_encoding(model).encode(format_function_definitions(functions))) + 9
+        _functions_tokens_cache[key] = tokens
+    return tokens
+
+
+def request_overhead_tokens(functions=None, model="gpt-3.5-turbo"):
+    """
+    Counts the tokens a request adds on top of its messages: the reply priming and the function schemas.
+    :param functions: Optional parameter, the list of function descriptions sent with the request, default is None.
+    :param model: Optional parameter, the name of the model, default is 'gpt-3.5-turbo'.
+    :return: The number of tokens.
+    """
+    return get_model_profile(model).reply_priming_tokens + count_functions_tokens(functions, model)
+
+
+def estimate_request_tokens(messages, functions=None, model="gpt-3.5-turbo"):
+    """
+    Estimates the prompt size of a Chat request: every message with its overhead, the reply priming and the function schemas.
+    :param messages: Required parameter, a ChatMessages object or a list of message dicts.
+    :param functions: Optional parameter, the list of function descriptions sent with the request, default is None.
+    :param model: Optional parameter, the name of the model, default is 'gpt-3.5-turbo'.
+    :return: The number of prompt tokens.
+    """
+    if hasattr(messages, 'tokens_count'):
+        messages_tokens = messages.tokens_count + getattr(messages, 'suffix_tokens', 0)
+    else:
+        messages_tokens = sum(count_message_tokens(message, model) for message in messages)
+    return messages_tokens + request_overhead_tokens(functions, model)
+
+
+def get_tokens_threshold(model, functions=None):
+    """
+    Computes how many tokens the conversation messages may hold so that a request fits the model's context window
+    while leaving room for the answer.
+    :param model: Required parameter, the name of the model.
+    :param functions: Optional parameter, the list of function descriptions sent with every request, default is None.
+    :return: The token threshold to be used by ChatMessages.
+    """
+    return get_model_profile(model).input_budget - request_overhead_tokens(functions, model)
+
+
+if __name__ == '__main__':
+    print("This file defines the model profile registry and the request token estimator.")
@@ -0,0 +1,104 @@
+import asyncio
+
+# Choices a policy can make when reviewing a task decomposition
+APPROVE = '1'  # Execute the plan
+REVISE = '2'  # Send modification feedback and let the model decompose the task again
+NEW_QUESTION = '3'  # Replace the question and decompose it again
+EXIT = '4'  # End the conversation
+
+
+class ConversationPolicy:
+    """
+    Makes the decisions a user would otherwise type in: how to review a task decomposition and which question to ask next.
+    Subclasses override review_plan and next_question; the async versions run the sync ones by default.
+    """
+
+    def review_plan(self, text_answer_message, num_revisions):
+        """
+        Reviews a task decomposition proposed by the model.
+        :param text_answer_message: Required parameter, the message containing the proposed plan.
+        :param num_revisions: Required parameter, how many times the plan has already been revised in this session.
+        :return: One of APPROVE, REVISE, NEW_QUESTION or EXIT, and the feedback or new question for REVISE and NEW_QUESTION.
+        """
+        raise NotImplementedError
+
+    def next_question(self, messages):
+        """
+        Chooses the follow-up question of a multi-round conversation.
+        :param messages: Required parameter, the ChatMessages object of the conversation.
+        :return: The next question, or None to end the conversation.
+        """
+        raise NotImplementedError
+
+    async def areview_plan(self, text_answer_message, num_revisions):
+        return self.review_plan(text_answer_message, num_revisions)
+
+    async def anext_question(self, messages):
+        return self.next_question(messages)
+
+
+class InteractivePolicy(ConversationPolicy):
+    """
+    Asks the user through input(), as MateGen always did. The async versions read the input on a worker thread
+    so that other sessions of the event loop keep running.
+    """
+
+    def review_plan(self, text_answer_message, num_revisions):
+        choice = input("Would you like to execute the task according to this process (1),\
+        provide modification feedback on the current process (2),\
+        ask a new question (3),\
+        or exit the conversation (4)?")
+        content = None
+        if choice == REVISE:
+            content = input("Okay, enter your modification feedback for the model's result:")
+        elif choice == NEW_QUESTION:
+            content = input("Okay, please ask a new question:")
+        return choice, content
+
+    def next_question(self, messages):
+        user_input = input("Do you have any other questions? (Type 'exit' to finish) ")
+        return None if user_input.lower() == "exit" else user_input
+
+    async def areview_plan(self, text_answer_message, num_revisions):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.review_plan, text_answer_message, num_revisions)
+
+    async def anext_question(self, messages):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.next_question, messages)
+
+
+class AutoApprovePolicy(ConversationPolicy):
+    """
+    Headless policy for batch jobs and services: plans are approved without a human, optionally after up to
+    `max_revisions` rounds of fixed feedback, and multi-round conversations end after the first answer
+    unless follow-up questions are given.
+    """
+
+    def __init__(self, revision_feedback=None, max_revisions=0, follow_up_questions=None):
+        """
+        :param revision_feedback: Optional parameter, the feedback sent to the model before a plan is approved, default is None.
+        :param max_revisions: Optional parameter, how many times the feedback is sent before the plan is approved, default is 0.
+        :param follow_up_questions: Optional parameter, a list of follow-up questions asked in order, default is None.
+        """
+        if max_revisions < 0:
+            raise ValueError(f"Invalid maximum number of revisions: {max_revisions}")
+        if max_revisions and not revision_feedback:
+            raise ValueError("revision_feedback is required when max_revisions is greater than 0")
+        self.revision_feedback = revision_feedback
+        self.max_revisions = max_revisions
+        self.follow_up_questions = list(follow_up_questions or [])
+
+    def review_plan(self, text_answer_message, num_revisions):
+        if num_revisions < self.max_revisions:
+            print(f"Revising the plan automatically ({num_revisions + 1}/{self.max_revisions}).")
+            return REVISE, self.revision_feedback
+        print("Plan approved automatically.")
+        return APPROVE, None
+
+    def next_question(self, messages):
+        return self.follow_up_questions.pop(0) if self.follow_up_questions else None
+
+
+if __name__ == '__main__':
+    print("This file defines the policies that make the interactive choices of a conversation.")
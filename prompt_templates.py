@@ -0,0 +1,89 @@
+import threading
+from chatmessage import Message
+from model_profiles import count_message_tokens
+
+# Instructions appended to the question when the messages are rendered for the model, see ChatMessages.set_prompt_suffixes
+COT_SUFFIX = "Please think step by step to arrive at a conclusion."
+MARKDOWN_SUFFIX = "Please format all responses using markdown."
+
+
+class FewShotTemplate:
+    """
+    A few-shot prompt: a fixed block of example questions and answers followed by the current question, rewritten with
+    a question template. The block is compiled once per model into immutable Message records whose token counts are known,
+    so rendering it into a conversation shares those records and only encodes the rewritten question.
+    """
+
+    def __init__(self, examples, question_template="{question}"):
+        """
+        :param examples: Required parameter, a list of (user content, assistant content) pairs.
+        :param question_template: Optional parameter, the format of the final user message, with a {question} field,
+        default is "{question}".
+        """
+        if "{question}" not in question_template:
+            raise ValueError("The question template must contain a {question} field")
+        self.examples = tuple((user_content, assistant_content) for user_content, assistant_content in examples)
+        self.question_template = question_template
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    # Method to format a question the way the examples are formatted
+    def format_question(self, question):
+        return self.question_template.format(question=question)
+
+    def compile(self, model="gpt-3.5-turbo"):
+        """
+        Compiles the example block for a model, once.
+        :param model: Optional parameter, the name of the model whose tokenizer counts the messages, default is 'gpt-3.5-turbo'.
+        :return: A tuple of Message records with their token counts.
+        """
+        block = self._compiled.get(model)
+        if block is None:
+            with self._lock:
+                block = self._compiled.get(model)
+                if block is None:
+                    block = []
+                    for user_content, assistant_content in self.examples:
+                        for message in ({"role": "user", "content": self.format_question(user_content)},
+                                        {"role": "assistant", "content": assistant_content}):
+                            block.append(Message.freeze(message, tokens=count_message_tokens(message, model)))
+                    block = tuple(block)
+                    self._compiled[model] = block
+        return block
+
+    # Method to get the number of tokens the example block adds to a request
+    def tokens(self, model="gpt-3.5-turbo"):
+        return sum(message.tokens for message in self.compile(model))
+
+    def render(self, messages):
+        """
+        Builds the few-shot request for the last question of a conversation: a copy of `messages` where the question is
+        replaced by the example block and the rewritten question, spliced in one step.
+        :param messages: Required parameter, a ChatMessages object whose last message is the question.
+        :return: The new ChatMessages object; `messages` is not modified.
+        """
+        question_message = messages.history_messages[-1].to_dict()
+        question_message["content"] = self.format_question(question_message["content"])
+
+        rendered = messages.copy()
+        rendered.messages_pop(manual=True, index=-1)
+        rendered.messages_extend(self.compile(rendered.model) + (question_message,))
+        return rendered
+
+
+def prompt_suffixes(enable_COT=True, enable_md_output=True):
+    """
+    :param enable_COT: Optional parameter, whether to ask for step by step reasoning, default is True.
+    :param enable_md_output: Optional parameter, whether to ask for Markdown output, default is True.
+    :return: The tuple of suffixes, in the order they are appended.
+    """
+    suffixes = []
+    if enable_COT:
+        suffixes.append(COT_SUFFIX)
+    if enable_md_output:
+        suffixes.append(MARKDOWN_SUFFIX)
+    return tuple(suffixes)
+
+
+if __name__ == '__main__':
+    print("This file defines the precompiled few-shot prompt templates and the render-time prompt suffixes.")
@@ -0,0 +1,272 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from openai.error import APIConnectionError, APIError, RateLimitError, ServiceUnavailableError, Timeout, TryAgain
+
+# Errors worth retrying; anything else (bad request, authentication, ...) is raised immediately
+RETRYABLE_ERRORS = (APIConnectionError, RateLimitError, ServiceUnavailableError, Timeout, TryAgain, APIError)
+
+DEFAULT_REQUESTS_PER_MINUTE = int(os.getenv('MATEGEN_DEFAULT_RPM', 3500))
+DEFAULT_TOKENS_PER_MINUTE = int(os.getenv('MATEGEN_DEFAULT_TPM', 90000))
+
+
+class TokenBucket:
+    """
+    A token bucket refilled continuously at `capacity` units per minute. Reservations may drive the level below zero;
+    the caller then waits until the debt has been refilled, which keeps reservations strictly first come, first served.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    # Method to take `amount` units and return how many seconds the caller must wait before using them
+    def reserve(self, amount, now):
+        self._refill(now)
+        # A single request larger than the whole bucket can never be covered; let it through once the bucket is full
+        self.level -= min(amount, self.capacity)
+        return 0.0 if self.level >= 0 else -self.level * 60.0 / self.capacity
+
+    # Method to give back units that were reserved but not used
+    def refund(self, amount, now):
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+    # Method to empty the bucket for `seconds`, e.g. after the server answered with Retry-After
+    def block(self, seconds, now):
+        self._refill(now)
+        self.level = min(self.level, -seconds * self.capacity / 60.0)
+
+
+class RateLimiter:
+    """
+    Client-side requests-per-minute and tokens-per-minute limiter for one model, shared by all threads and async tasks
+    of the process. Each request reserves one request and its estimated tokens before it is sent, so the process
+    throttles itself instead of hitting the server's rate limit.
+    """
+
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._lock = threading.Lock()
+        # Metrics
+        self.num_requests = 0
+        self.num_throttled = 0  # Requests that had to wait for the limiter
+        self.total_wait = 0.0  # Seconds spent waiting for the limiter
+        self.max_wait = 0.0
+        self.num_rate_limit_errors = 0  # RateLimitError answers received despite the limiter
+        self.num_retries = 0
+
+    def _reserve(self, tokens):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self.requests.reserve(1, now), self.tokens.reserve(tokens, now))
+            self.num_requests += 1
+            if wait > 0:
+                self.num_throttled += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            return wait
+
+    def acquire(self, tokens=0):
+        """
+        Blocks until a request with `tokens` estimated tokens may be sent.
+        :param tokens: Optional parameter, the estimated number of tokens of the request, default is 0.
+        :return: The number of seconds waited.
+        """
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens=0):
+        """
+        Async version of acquire; waits without blocking the event loop.
+        """
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    # Method to correct the token reservation once the response reports the real usage
+    def record_usage(self, estimated_tokens, actual_tokens):
+        with self._lock:
+            now = time.monotonic()
+            if actual_tokens < estimated_tokens:
+                self.tokens.refund(estimated_tokens - actual_tokens, now)
+            elif actual_tokens > estimated_tokens:
+                self.tokens.reserve(actual_tokens - estimated_tokens, now)
+
+    # Method to pause every caller of this model for `seconds`, e.g. after a RateLimitError
+    def pause(self, seconds):
+        with self._lock:
+            now = time.monotonic()
+            self.requests.block(seconds, now)
+            self.tokens.block(seconds, now)
+
+    def metrics(self):
+        """
+        :return: A dict with the request, throttle, wait time, rate limit error and retry counters.
+        """
+        with self._lock:
+            return {"requests": self.num_requests,
+                    "throttled": self.num_throttled,
+                    "total_wait_seconds": round(self.total_wait, 3),
+                    "max_wait_seconds": round(self.max_wait, 3),
+                    "rate_limit_errors": self.num_rate_limit_errors,
+                    "retries": self.num_retries}
+
+
+_rate_limiters = {}
+_rate_limits = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def set_rate_limit(model, requests_per_minute, tokens_per_minute):
+    """
+    Sets the RPM and TPM budgets of a model, e.g. to match the limits of the organization's OpenAI tier.
+    :param model: Required parameter, the name of the model.
+    :param requests_per_minute: Required parameter, the requests-per-minute budget.
+    :param tokens_per_minute: Required parameter, the tokens-per-minute budget.
+    """
+    with _rate_limiters_lock:
+        _rate_limits[model] = (requests_per_minute, tokens_per_minute)
+        _rate_limiters.pop(model, None)
+
+
+def get_rate_limiter(model):
+    """
+    Returns the RateLimiter shared by all callers of a model, creating it on first use.
+    :param model: Required parameter, the name of the model.
+    :return: The RateLimiter object.
+    """
+    limiter = _rate_limiters.get(model)
+    if limiter is None:
+        with _rate_limiters_lock:
+            limiter = _rate_limiters.get(model)
+            if limiter is None:
+                limiter = RateLimiter(*_rate_limits.get(model, (DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE)))
+                _rate_limiters[model] = limiter
+    return limiter
+
+
+def rate_limit_metrics():
+    """
+    :return: A dict mapping each model used so far to the metrics of its RateLimiter.
+    """
+    return {model: limiter.metrics() for model, limiter in list(_rate_limiters.items())}
+
+
+def get_backoff_delay(attempt, base=1.0, cap=60.0):
+    """
+    Computes the delay before a retry with full-jitter exponential backoff.
+    :param attempt: Required parameter, the number of the failed attempt, starting at 0.
+    :param base: Optional parameter, the delay scale in seconds, default is 1.
+    :param cap: Optional parameter, the maximum delay in seconds, default is 60.
+    :return: The delay in seconds.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def get_retry_after(error):
+    """
+    Reads the delay requested by the server from the Retry-After headers of an OpenAI error.
+    :param error: Required parameter, the OpenAIError raised by the request.
+    :return: The delay in seconds, or None if the server did not send one.
+    """
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms') is not None:
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after') is not None:
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def _get_total_tokens(response):
+    try:
+        return response["usage"]["total_tokens"]
+    except (KeyError, TypeError):
+        return None
+
+
+def _handle_retryable_error(limiter, error, attempt, max_retries, cap):
+    if attempt >= max_retries:
+        raise error
+    retry_after = get_retry_after(error)
+    delay = min(retry_after, cap) if retry_after is not None else get_backoff_delay(attempt, cap=cap)
+    with limiter._lock:
+        limiter.num_retries += 1
+        if isinstance(error, RateLimitError):
+            limiter.num_rate_limit_errors += 1
+    if isinstance(error, RateLimitError):
+        # Every session of the model backs off together, instead of each one hammering the server
+        limiter.pause(delay)
+    print(f"Encountered an API issue ({type(error).__name__}: {error}). Retrying in {delay:.1f} seconds...")
+    return delay
+
+
+def call_with_retries(request, model, estimated_tokens=0, max_retries=8, cap=60.0):
+    """
+    Sends a request through the model's RateLimiter, retrying retryable errors with jittered exponential backoff
+    (or the server's Retry-After delay) instead of a fixed pause.
+    :param request: Required parameter, a callable without arguments that sends the request and returns the response.
+    :param model: Required parameter, the name of the model.
+    :param estimated_tokens: Optional parameter, the estimated number of tokens of the request, default is 0.
+    :param max_retries: Optional parameter, the maximum number of retries before the error is raised, default is 8.
+    :param cap: Optional parameter, the maximum delay between two attempts in seconds, default is 60.
+    :return: The response returned by `request`.
+    """
+    limiter = get_rate_limiter(model)
+    attempt = 0
+    while True:
+        limiter.acquire(estimated_tokens)
+        try:
+            response = request()
+        except RETRYABLE_ERRORS as e:
+            time.sleep(_handle_retryable_error(limiter, e, attempt, max_retries, cap))
+            attempt += 1
+            continue
+        total_tokens = _get_total_tokens(response)
+        if total_tokens is not None:
+            limiter.record_usage(estimated_tokens, total_tokens)
+        return response
+
+
+async def acall_with_retries(request, model, estimated_tokens=0, max_retries=8, cap=60.0):
+    """
+    Async version of call_with_retries.
+    :param request: Required parameter, a callable without arguments returning an awaitable that sends the request.
+    :param model: Required parameter, the name of the model.
+    :param estimated_tokens: Optional parameter, the estimated number of tokens of the request, default is 0.
+    :param max_retries: Optional parameter, the maximum number of retries before the error is raised, default is 8.
+    :param cap: Optional parameter, the maximum delay between two attempts in seconds, default is 60.
+    :return: The response returned by `request`.
+    """
+    limiter = get_rate_limiter(model)
+    attempt = 0
+    while True:
+        await limiter.acquire_async(estimated_tokens)
+        try:
+            response = await request()
+        except RETRYABLE_ERRORS as e:
+            await asyncio.sleep(_handle_retryable_error(limiter, e, attempt, max_retries, cap))
+            attempt += 1
+            continue
+        total_tokens = _get_total_tokens(response)
+        if total_tokens is not None:
+            limiter.record_usage(estimated_tokens, total_tokens)
+        return response
+
+
+if __name__ == '__main__':
+    print("This file defines the client-side rate limiter and the retry policy for OpenAI requests.")
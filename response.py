@@ -1,17 +1,38 @@
 from planning import *
-import openai
+import os
 import time
 import json
+from concurrent.futures import ThreadPoolExecutor
 from IPython.display import display, Code, Markdown
-from openai.error import APIConnectionError
 from gptLearning import *
+from model_profiles import get_model_profile, request_overhead_tokens, estimate_request_tokens
+from llm_backend import chat_completion
+from rate_limiter import call_with_retries, get_rate_limiter
+from agent_loop import CALL_MODEL, FUNCTION_CALL, TEXT_ANSWER, DONE, AgentRun, count_completion_tokens, \
+    message_function_calls, parse_function_arguments, apply_review_choice
+from policies import InteractivePolicy, REVISE
+from router import route_session
+from sql_timeout import with_query_timeout
+from streaming import consume_stream, MarkdownStreamRenderer, render_message
+from response_cache import cached_chat_completion, get_response_cache, make_cache_key, response_cache_enabled, \
+    is_valid_chat_response
+
+
+def new_namespace():
+    """
+    Creates the namespace of a session, in which its external functions run: the DataFrames of extract_data and the
+    variables of python_inter live there, apart from those of the other sessions of the process.
+    :return: A dict holding the names of this module (pandas, numpy...), so that the code of the model can use them without importing them.
+    """
+    return {name: value for name, value in globals().items() if not name.startswith('_')}
 
 
-def function_to_call(available_functions, function_call_message):
+def function_to_call(available_functions, function_call_message, namespace=None):
     """
     Based on a function call message `function_call_message`, return a message with the function's execution result `function_response_messages`.
     :param available_functions: Required parameter, an AvailableFunctions object that describes the basic information of the current external functions.
     :param function_call_message: Required parameter, a message representing an external function call.
+    :param namespace: Optional parameter, the namespace of the session passed to the function as `g`, default is None (the globals of this module).
     :return: `function_response_messages`, a message consisting of the external function's execution result.
     """
 
@@ -27,8 +48,8 @@ def function_to_call(available_functions, function_call_message):
 
     # Pass the parameters to the external function and run it
     try:
-        # Add the global variables from the current operation space to the external function
-        function_args['g'] = globals()
+        # Add the variables of the session to the external function
+        function_args['g'] = namespace if namespace is not None else globals()
 
         # Run the external function
         function_response = function_to_call(**function_args)
@@ -49,150 +70,85 @@ def function_to_call(available_functions, function_call_message):
 
     return function_response_messages
 
-def get_gpt_response(model,
-                     messages,
-                     available_functions=None):
-    """
-    Responsible for calling the Chat model and obtaining the model's response function, and it allows for a temporary pause of 1 minute if a Rate limit issue occurs when calling the GPT model.
-    Additionally, for unclear questions, it will prompt the user to modify the input prompt to obtain better model results.
-    :param model: Required parameter indicating the name of the large model to be called.
-    :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
-    :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.
-    Defaults to None, indicating no external functions.
-    :return: Returns the response message from the model.
-    """
-
-    # To account for potential communication errors, loop to call the Chat model
-    while True:
-        try:
-            # If no external functions exist
-            if available_functions is None:
-                response = openai.ChatCompletion.create(
-                    model=model,
-                    messages=messages.messages)
-
-            # If external functions exist, obtain functions and function_call parameters from the AvailableFunctions object
-            else:
-                response = openai.ChatCompletion.create(
-                    model=model,
-                    messages=messages.messages,
-                    functions=available_functions.functions,
-                    function_call=available_functions.function_call
-                )
-            break  # Exit the loop if response is successfully obtained
-
-        except APIConnectionError as e:
-            # Print the core error information
-            print(f"Encountered a connection issue: {str(e)}")
-            print("Due to rate limit, pausing for 1 minute and will continue running after 1 minute...")
-            time.sleep(60)  # Wait for 1 minute
-            print("Waited 60 seconds, starting a new round of questions and answers...")
-
-    return response["choices"][0]["message"]
+_tool_executor = None
 
 
-def get_chat_response(model,
-                      messages,
-                      available_functions=None,
-                      delete_some_messages=False,
-                      is_task_decomposition=False):
+def get_tool_executor():
     """
-    Responsible for executing a complete conversation session. Note that a conversation may involve multiple calls to the large model,
-    and this function serves as the main function to complete one conversation session.
-    The last message in the input messages must be a message that can initiate a conversation.
-    This function calls get_gpt_response to obtain the model's output results and then processes the output based on whether it is text or code results,
-    by flexibly calling different functions for post-processing.
-    :param model: Required parameter indicating the name of the large model to be called.
-    :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
-    :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.
-    Defaults to None, indicating no external functions.
-    :param delete_some_messages: Optional parameter indicating whether to delete several intermediate messages when concatenating messages, default is False.
-    :param is_task_decomposition: Optional parameter indicating whether the current task is task decomposition review, default is False.
-    :return: Messages concatenating the final results of this Q&A session.
+    Returns the thread pool used to run external functions (SQL, Python code, plots), both the parallel tool calls
+    of one model turn and the function calls of async sessions. Its size can be set with the MATEGEN_TOOL_WORKERS environment variable.
+    :return: The shared ThreadPoolExecutor object.
     """
+    global _tool_executor
+    if _tool_executor is None:
+        _tool_executor = ThreadPoolExecutor(max_workers=int(os.getenv('MATEGEN_TOOL_WORKERS', 8)),
+                                            thread_name_prefix='mategen-tool')
+    return _tool_executor
 
-    # Only when modifying the complex task decomposition result will is_task_decomposition=True occur
-    # When is_task_decomposition=True, response_message will not be recreated
-    if not is_task_decomposition:
-        # First obtain the result of a single large model call
-        # At this point, response_message is the message returned by the large model call
-        response_message = get_gpt_response(model=model,
-                                            messages=messages,
-                                            available_functions=available_functions)
-
-    # Complex condition check, if is_task_decomposition = True,
-    # or if enhanced mode is enabled and the task involves function response
-    # (Note that when is_task_decomposition = True, there is no response_message object)
-    if is_task_decomposition:
-        # Set is_task_decomposition to True, indicating that the current task is task decomposition
-        is_task_decomposition = True
-        # In task decomposition, the task decomposition prompt is named text_response_messages
-        task_decomp_few_shot = add_task_decomposition_prompt(messages)
-        # print("Performing task decomposition, please wait...")
-        # Also update response_message; now response_message is the response after task decomposition
-        response_message = get_gpt_response(model=model,
-                                            messages=task_decomp_few_shot,
-                                            available_functions=available_functions)
 
-    # If the current call is generated by modifying conversation requirements, delete several messages from the original messages
-    # Note that deleting intermediate messages must be done after creating the new response_message
-    if delete_some_messages:
-        for i in range(delete_some_messages):
-            messages.messages_pop(manual=True, index=-1)
-
-    # If it is a text response task
-    if not response_message.get("function_call"):
-        text_answer_message = response_message
-        messages = is_text_response_valid(model=model,
-                                          messages=messages,
-                                          text_answer_message=text_answer_message,
-                                          available_functions=available_functions,
-                                          delete_some_messages=delete_some_messages,
-                                          is_task_decomposition=is_task_decomposition)
+def tool_call_to_call(available_functions, tool_call, namespace=None):
+    """
+    Runs one of the parallel tool calls of a model turn.
+    :param available_functions: Required parameter, an AvailableFunctions object that describes the basic information of the current external functions.
+    :param tool_call: Required parameter, an element of the `tool_calls` of the model's message.
+    :param namespace: Optional parameter, the namespace of the session passed to the function as `g`, default is None (the globals of this module).
+    :return: The `tool` message holding the function's execution result, linked to the call by its id.
+    """
+    function_response_message = function_to_call(available_functions=available_functions,
+                                                 function_call_message={"function_call": tool_call["function"]},
+                                                 namespace=namespace)
+    return {"role": "tool",
+            "tool_call_id": tool_call["id"],
+            "name": function_response_message["name"],
+            "content": function_response_message["content"]}
 
-    # If it is a function response task
-    elif response_message.get("function_call"):
-        function_call_message = response_message
-        messages = is_code_response_valid(model=model,
-                                          messages=messages,
-                                          function_call_message=function_call_message,
-                                          available_functions=available_functions,
-                                          delete_some_messages=delete_some_messages)
 
-    return messages
+def tool_call_batches(available_functions, tool_calls):
+    """
+    Splits the tool calls of one model turn into batches run one after the other: consecutive calls of thread-safe
+    functions (see AvailableFunctions.is_thread_safe) share a batch and run concurrently, any other call, such as
+    python_inter or fig_inter, is a batch of its own.
+    :param available_functions: Required parameter, an AvailableFunctions object that describes the basic information of the current external functions.
+    :param tool_calls: Required parameter, the `tool_calls` of the model's message.
+    :return: The list of batches, each a list of tool calls, in the order of `tool_calls`.
+    """
+    batches = []
+    concurrent = False
+    for tool_call in tool_calls:
+        thread_safe = available_functions.is_thread_safe(tool_call["function"]["name"])
+        if thread_safe and concurrent:
+            batches[-1].append(tool_call)
+        else:
+            batches.append([tool_call])
+        concurrent = thread_safe
+    return batches
 
 
-def is_code_response_valid(model,
-                           messages,
-                           function_call_message,
-                           available_functions=None,
-                           delete_some_messages=False):
+def tool_calls_to_call(available_functions, tool_calls, namespace=None):
     """
-    Responsible for executing an external function call completely. The last message in the input `messages` must be a message containing a function call.
-    The function's final task is to pass the code from the function call message to the external function and complete the code execution, supporting both interactive and automated code execution modes.
-    :param model: Required parameter indicating the name of the large model to be called.
-    :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
-    :param function_call_message: Required parameter representing a message containing a function call created by the upper-level function.
-    :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.
-    Defaults to None, indicating no external functions.
-    :param delete_some_messages: Optional parameter indicating whether to delete several intermediate messages when concatenating messages, default is False.
-    :return: Message containing the latest result from the large model's response.
+    Runs the tool calls of one model turn, the independent calls of thread-safe functions concurrently on the tool thread pool.
+    :param available_functions: Required parameter, an AvailableFunctions object that describes the basic information of the current external functions.
+    :param tool_calls: Required parameter, the `tool_calls` of the model's message.
+    :param namespace: Optional parameter, the namespace of the session passed to the functions as `g`, default is None (the globals of this module).
+    :return: The list of `tool` result messages, in the order of `tool_calls` whatever order the functions finish in.
     """
+    # The tool threads run under the query timeout of the calling session
+    call = with_query_timeout(tool_call_to_call)
+    function_response_messages = []
+    for batch in tool_call_batches(available_functions, tool_calls):
+        if len(batch) == 1:
+            function_response_messages.append(tool_call_to_call(available_functions, batch[0], namespace))
+        else:
+            function_response_messages.extend(get_tool_executor().map(
+                lambda tool_call: call(available_functions, tool_call, namespace), batch))
+    return function_response_messages
 
-    # Prepare for printing and modifying code (adding image creation code for the family part)
-    # Create a JSON string message object
-    code_json_str = function_call_message["function_call"]["arguments"]
-    # Convert JSON to a dictionary
-    try:
-        code_dict = json.loads(code_json_str)
-    except Exception as e:
-        print("JSON parsing error, recreating code...")
-        messages = get_chat_response(model=model,
-                                     messages=messages,
-                                     available_functions=available_functions,
-                                     delete_some_messages=delete_some_messages)
 
-        return messages
+def display_function_code(code_dict):
+    """
+    Prints the code of a function call in Markdown before it is executed.
+    :param code_dict: Required parameter, the parsed arguments of the function call message.
+    """
 
     # Create a helper function convert_to_markdown to assist in printing code results
     def convert_to_markdown(code, language):
@@ -216,140 +172,317 @@ def is_code_response_valid(model,
 
     display(Markdown(markdown_code))
 
-    function_response_message = function_to_call(available_functions=available_functions,
-                                                 function_call_message=function_call_message)
 
-    messages = check_get_final_function_response(model=model,
-                                                 messages=messages,
-                                                 function_call_message=function_call_message,
-                                                 function_response_message=function_response_message,
-                                                 available_functions=available_functions,
-                                                 delete_some_messages=delete_some_messages)
+def function_parameters(available_functions):
+    """
+    Builds the request parameters describing the external functions: `functions` and `function_call`,
+    or `tools` and `tool_choice` when the model may call several functions in one turn.
+    :param available_functions: Required parameter, an AvailableFunctions object, or None.
+    :return: A dict of request parameters.
+    """
+    if available_functions is None:
+        return {}
+    if getattr(available_functions, "parallel_tool_calls", False):
+        return {"tools": available_functions.tools, "tool_choice": available_functions.tool_choice}
+    return {"functions": available_functions.functions, "function_call": available_functions.function_call}
+
 
-    return messages
+def function_cache_parameters(request_kwargs):
+    """
+    :param request_kwargs: Required parameter, the parameters of a Chat request.
+    :return: The function descriptions and the call rule of the request, whichever format it uses, for the response cache key.
+    """
+    if "tools" in request_kwargs:
+        return request_kwargs["tools"], request_kwargs.get("tool_choice")
+    return request_kwargs.get("functions"), request_kwargs.get("function_call")
 
 
-def check_get_final_function_response(model,
-                                      messages,
-                                      function_call_message,
-                                      function_response_message,
-                                      available_functions=None,
-                                      delete_some_messages=False):
+def get_gpt_response(model,
+                     messages,
+                     available_functions=None,
+                     stream=False):
     """
-    Responsible for reviewing the results of external function execution.
-    If the function_response_message does not contain any error information,
-    it will be appended to the message and passed to the get_chat_response function to obtain the next round of conversation results.
-    If error information is present in the function_response_message, automatic debug mode will be enabled.
+    Responsible for calling the Chat model and obtaining the model's response function. Requests go through the model's shared rate limiter,
+    and connection or rate limit errors are retried with jittered exponential backoff.
+    Additionally, for unclear questions, it will prompt the user to modify the input prompt to obtain better model results.
     :param model: Required parameter indicating the name of the large model to be called.
     :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
-    :param function_call_message: Required parameter representing a message containing a function call created by the upper-level function.
-    :param function_response_message: Required parameter representing a message containing the result of the external function's execution created by the upper-level function.
     :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.
     Defaults to None, indicating no external functions.
-    :param delete_some_messages: Optional parameter indicating whether to delete several intermediate messages when concatenating messages, default is False.
-    :return: Message containing the latest result from the large model's response.
+    :param stream: Optional parameter indicating whether to stream the response, rendering the text as it arrives, default is False.
+    :return: Returns the response message from the model.
     """
 
-    fun_res_content = function_response_message["content"]
+    # Make sure the request fits the model's context window (messages, function schemas and room for the answer),
+    # so that an oversized conversation is trimmed locally instead of failing after a full round trip
+    functions = available_functions.functions if available_functions is not None else None
+    messages.fit(get_model_profile(model).input_budget - request_overhead_tokens(functions, model))
+
+    api_messages = messages.to_api_messages()
+    request_kwargs = {"model": model}
+    # If external functions exist, obtain functions and function_call parameters from the AvailableFunctions object
+    request_kwargs.update(function_parameters(available_functions))
+    if stream:
+        request_kwargs["stream"] = True
+
+    # Time of the last attempt, from which the time to first token of a streamed response is measured
+    sent_at = []
+
+    def request():
+        sent_at.append(time.perf_counter())
+        return chat_completion(messages=api_messages, **request_kwargs)
+
+    # The shared rate limiter throttles the request ahead of time from its estimated size,
+    # and connection or rate limit errors are retried with jittered exponential backoff
+    estimated_tokens = estimate_request_tokens(messages, functions, model)
+
+    def limited_request():
+        return call_with_retries(request, model=model, estimated_tokens=estimated_tokens)
+
+    if stream:
+        cache_key = make_cache_key(model, api_messages, *function_cache_parameters(request_kwargs)) \
+            if response_cache_enabled() else None
+        cached_response = get_response_cache().lookup(cache_key) if cache_key else None
+        if cached_response is not None:
+            response_message = cached_response["choices"][0]["message"]
+            render_message(response_message)
+            return response_message
+
+        response_message, stats = consume_stream(limited_request(), model, renderer=MarkdownStreamRenderer(),
+                                                 start=sent_at[-1])
+        # Streamed responses do not report their usage, so the generated tokens are counted locally
+        get_rate_limiter(model).record_usage(estimated_tokens, estimated_tokens + stats.completion_tokens)
+        response = {"choices": [{"message": response_message}]}
+        if cache_key and is_valid_chat_response(response):
+            get_response_cache().put(cache_key, response, stats.total_time)
+        return response_message
+
+    # Identical requests are answered from the response cache, and concurrent ones share a single upstream call
+    cache_functions, cache_function_call = function_cache_parameters(request_kwargs)
+    response = cached_chat_completion(limited_request,
+                                      model=model,
+                                      messages=api_messages,
+                                      functions=cache_functions,
+                                      function_call=cache_function_call,
+                                      validate=is_valid_chat_response)
 
-    # If function_response contains errors
-    if "error" in fun_res_content:
-        print(fun_res_content)
+    return response["choices"][0]["message"]
 
-        msg_debug = messages.copy()
-        msg_debug.messages_append(function_call_message)
-        msg_debug.messages_append(function_response_message)
 
-        messages = msg_debug.copy()
+def model_step(model,
+               messages,
+               step,
+               available_functions=None,
+               delete_some_messages=False,
+               is_task_decomposition=False,
+               stream=False):
+    """
+    Runs the model call step of the conversation driver.
+    :param model: Required parameter indicating the name of the large model to be called.
+    :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
+    :param step: Required parameter, the StepRecord of the step, filled with the model latency and tokens.
+    :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.
+    Defaults to None, indicating no external functions.
+    :param delete_some_messages: Optional parameter indicating how many messages to delete from the end of `messages` once the response is created, default is False.
+    :param is_task_decomposition: Optional parameter indicating whether the model should decompose the task with the few-shot prompt, default is False.
+    :param stream: Optional parameter indicating whether to stream the model's response, default is False.
+    :return: The response message from the model.
+    """
 
-    # If function message does not contain error information
+    # The few-shot decomposition prompt is built for this call only and released right after it
+    request_messages = add_task_decomposition_prompt(messages) if is_task_decomposition else messages
+
+    start = time.perf_counter()
+    response_message = get_gpt_response(model=model,
+                                        messages=request_messages,
+                                        available_functions=available_functions,
+                                        stream=stream)
+    step.llm_seconds = time.perf_counter() - start
+    step.prompt_tokens = estimate_request_tokens(request_messages,
+                                                 available_functions.functions if available_functions else None,
+                                                 model)
+    step.completion_tokens = count_completion_tokens(response_message, model)
+
+    # If the current call is generated by modifying conversation requirements, delete several messages from the original messages
+    # Note that deleting intermediate messages must be done after creating the new response_message
+    if delete_some_messages:
+        for i in range(delete_some_messages):
+            messages.messages_pop(manual=True, index=-1)
+
+    return response_message
+
+
+def function_call_step(messages,
+                       function_call_message,
+                       step,
+                       available_functions=None,
+                       namespace=None):
+    """
+    Runs the function call step of the conversation driver: prints the code written by the model, executes it and
+    appends the call and its result to `messages`. When the model asked for several tool calls in one turn,
+    the calls of thread-safe functions run concurrently, and the results are appended in the order of the calls.
+    :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
+    :param function_call_message: Required parameter, the message containing the function call or the tool calls.
+    :param step: Required parameter, the StepRecord of the step, filled with the function latency.
+    :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.
+    :param namespace: Optional parameter, the namespace of the session in which the functions run, default is None (the globals of this module).
+    :return: The next state: CALL_MODEL to let the model read the results or rewrite invalid code, DONE if a function failed.
+    """
+
+    code_dicts = [parse_function_arguments({"function_call": function_call})
+                  for function_call in message_function_calls(function_call_message)]
+    if any(code_dict is None for code_dict in code_dicts):
+        print("JSON parsing error, recreating code...")
+        return CALL_MODEL
+
+    for code_dict in code_dicts:
+        display_function_code(code_dict)
+
+    start = time.perf_counter()
+    if function_call_message.get("tool_calls"):
+        function_response_messages = tool_calls_to_call(available_functions=available_functions,
+                                                        tool_calls=function_call_message["tool_calls"],
+                                                        namespace=namespace)
     else:
-        print("External function execution complete. Parsing the results...")
-        messages.messages_append(function_call_message)
+        function_response_messages = [function_to_call(available_functions=available_functions,
+                                                       function_call_message=function_call_message,
+                                                       namespace=namespace)]
+    step.tool_seconds = time.perf_counter() - start
+
+    messages.messages_append(function_call_message)
+    for function_response_message in function_response_messages:
         messages.messages_append(function_response_message)
-        messages = get_chat_response(model=model,
-                                     messages=messages,
-                                     available_functions=available_functions,
-                                     delete_some_messages=delete_some_messages)
 
-    return messages
+    # If function_response contains errors, stop so that the error can be inspected
+    errors = [message["content"] for message in function_response_messages if "error" in message["content"]]
+    if errors:
+        for error in errors:
+            print(error)
+        return DONE
+
+    print("External function execution complete. Parsing the results...")
+    return CALL_MODEL
+
+
+def text_answer_step(messages,
+                     text_answer_message,
+                     run,
+                     is_task_decomposition=False,
+                     stream=False,
+                     policy=None):
+    """
+    Runs the text answer step of the conversation driver. A normal answer is shown and saved to `messages`;
+    a task decomposition is shown for review, and the policy decides whether to execute it, modify it, ask a new question or exit.
+    :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
+    :param text_answer_message: Required parameter, the message containing the text answer.
+    :param run: Required parameter, the AgentRun of the session, which counts the revisions of the plan.
+    :param is_task_decomposition: Optional parameter indicating whether the answer is a task decomposition to be reviewed, default is False.
+    :param stream: Optional parameter indicating whether the answer was streamed and is already rendered, default is False.
+    :param policy: Optional parameter, the ConversationPolicy reviewing the plan, default is InteractivePolicy() (asks the user).
+    :return: The next state, whether the next model call is a task decomposition, and how many messages to delete after it.
+    """
+
+    if not stream:
+        print("Model's Answer:\n")
+        display(Markdown(text_answer_message["content"]))
+
+    if not is_task_decomposition:
+        messages.messages_append(text_answer_message)
+        return DONE, False, False
+
+    policy = policy if policy is not None else InteractivePolicy()
+    choice, new_user_content = policy.review_plan(text_answer_message, run.num_revisions)
+    if choice == REVISE:
+        run.num_revisions += 1
+
+    return apply_review_choice(messages, text_answer_message, choice, new_user_content)
 
 
-def is_text_response_valid(model,
-                           messages,
-                           text_answer_message,
-                           available_functions=None,
-                           delete_some_messages=False,
-                           is_task_decomposition=False):
+def get_chat_response(model,
+                      messages,
+                      available_functions=None,
+                      delete_some_messages=False,
+                      is_task_decomposition=False,
+                      stream=False,
+                      budget=None,
+                      run=None,
+                      policy=None,
+                      router=None,
+                      namespace=None):
     """
-    Responsible for reviewing the creation of text content. The running mode can be either fast mode or manual review mode.
-    In fast mode, the model quickly creates text and saves it to the msg object.
-    In manual review mode, human confirmation is required before the function saves the text content created by the large model.
-    During this process, the model can also be instructed to modify the text based on user input.
-    :param model: Required parameter, indicating the name of the large model being called.
+    Responsible for executing a complete conversation session. Note that a conversation may involve multiple calls to the large model,
+    and this function serves as the main function to complete one conversation session.
+    The last message in the input messages must be a message that can initiate a conversation.
+    The session is driven by a loop over explicit states: calling the model, executing a function call, and showing
+    (and, for a task decomposition, reviewing) a text answer. The loop stops when the answer is final or the step budget runs out,
+    and each step records its model latency, function latency and tokens.
+    :param model: Required parameter indicating the name of the large model to be called.
     :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
-    :param text_answer_message: Required parameter, representing a message containing text content created by the upper-level function.
     :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.
     Defaults to None, indicating no external functions.
     :param delete_some_messages: Optional parameter indicating whether to delete several intermediate messages when concatenating messages, default is False.
-    :param is_task_decomposition: Optional parameter indicating whether the current task is a review of task decomposition results, default is False.
-    :return: Message containing the latest result from the large model's response.
+    :param is_task_decomposition: Optional parameter indicating whether the current task is task decomposition review, default is False.
+    :param stream: Optional parameter indicating whether to stream the model's responses, default is False.
+    :param budget: Optional parameter, a StepBudget object limiting the steps, tokens and wall time of the session, default is StepBudget().
+    :param run: Optional parameter, an AgentRun object receiving the step trace of the session, default is a new one.
+    :param policy: Optional parameter, the ConversationPolicy making the review choices, default is InteractivePolicy() (asks the user).
+    Pass an AutoApprovePolicy to run the session headless.
+    :param router: Optional parameter, a QuestionRouter deciding before any model call whether the question is decomposed first;
+    the external functions are offered either way, default is None (no routing).
+    :param namespace: Optional parameter, the namespace in which the external functions run, e.g. MateGen.namespace to keep
+    the DataFrames and variables across questions, default is a new one (see new_namespace()).
+    :return: Messages concatenating the final results of this Q&A session.
     """
 
-    answer_content = text_answer_message["content"]
-
-    print("Model's Answer:\n")
-    display(Markdown(answer_content))
-
-    user_input = None
-
-    # If task decomposition
-    if is_task_decomposition:
-        user_input = input("Would you like to execute the task according to this process (1),\
-        provide modification feedback on the current process (2),\
-        ask a new question (3),\
-        or exit the conversation (4)?")
-        if user_input == '1':
-            messages.messages_append(text_answer_message)
-            print("Okay, proceeding to execute the process step by step.")
-            messages.messages_append({"role": "user", "content": "Very well, please execute the process step by step."})
-            is_task_decomposition = False
-            messages = get_chat_response(model=model,
-                                         messages=messages,
-                                         available_functions=available_functions,
-                                         delete_some_messages=delete_some_messages,
-                                         is_task_decomposition=is_task_decomposition)
-
-    if user_input is not None:
-        if user_input == '1':
-            pass
-        elif user_input == '2':
-            new_user_content = input("Okay, enter your modification feedback for the model's result:")
-            print("Okay, making modifications.")
-            messages.messages_append(text_answer_message)
-            messages.messages_append({"role": "user", "content": new_user_content})
-
-            messages = get_chat_response(model=model,
-                                         messages=messages,
-                                         available_functions=available_functions,
-                                         delete_some_messages=2,
-                                         is_task_decomposition=is_task_decomposition)
-
-        elif user_input == '3':
-            new_user_content = input("Okay, please ask a new question:")
-            messages.messages[-1]["content"] = new_user_content
-            messages = get_chat_response(model=model,
-                                         messages=messages,
-                                         available_functions=available_functions,
-                                         delete_some_messages=delete_some_messages,
-                                         is_task_decomposition=is_task_decomposition)
+    run = run if run is not None else AgentRun(budget)
+    namespace = namespace if namespace is not None else new_namespace()
+    # Only multi-step questions pay for the task decomposition round trip
+    if router is not None and not is_task_decomposition:
+        is_task_decomposition, available_functions = route_session(router, messages, available_functions, run)
+    state = CALL_MODEL
+    response_message = None
 
-        else:
-            print("Okay, exiting the current conversation.")
+    while state != DONE:
+        stop_reason = run.check_budget()
+        if stop_reason is not None:
+            run.stop(stop_reason)
+            break
 
-    else:
-        messages.messages_append(text_answer_message)
+        step = run.start_step(state)
 
+        if state == CALL_MODEL:
+            response_message = model_step(model=model,
+                                          messages=messages,
+                                          step=step,
+                                          available_functions=available_functions,
+                                          delete_some_messages=delete_some_messages,
+                                          is_task_decomposition=is_task_decomposition,
+                                          stream=stream)
+            if router is not None and is_task_decomposition:
+                router.record_decomposition(step.llm_seconds)
+            delete_some_messages = False
+            state = FUNCTION_CALL if message_function_calls(response_message) else TEXT_ANSWER
+
+        elif state == FUNCTION_CALL:
+            state = function_call_step(messages=messages,
+                                       function_call_message=response_message,
+                                       step=step,
+                                       available_functions=available_functions,
+                                       namespace=namespace)
+            response_message = None
+
+        elif state == TEXT_ANSWER:
+            state, is_task_decomposition, delete_some_messages = text_answer_step(messages=messages,
+                                                                                  text_answer_message=response_message,
+                                                                                  run=run,
+                                                                                  is_task_decomposition=is_task_decomposition,
+                                                                                  stream=stream,
+                                                                                  policy=policy)
+            response_message = None
+
+        run.end_step(step)
+
+    run.finish()
     return messages
 
 
@@ -0,0 +1,361 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from openai.util import convert_to_openai_object
+
+# Default lifetime of a cached response in seconds
+DEFAULT_TTL = float(os.getenv('MATEGEN_RESPONSE_CACHE_TTL', 24 * 3600))
+# Default maximum number of cached responses; the least recently used ones are evicted first
+DEFAULT_MAX_ENTRIES = int(os.getenv('MATEGEN_RESPONSE_CACHE_MAX_ENTRIES', 10000))
+
+
+def make_cache_key(model, messages, functions=None, function_call=None):
+    """
+    Computes the canonical hash of a Chat request. Dict keys are sorted and whitespace is fixed,
+    so equal requests built in a different order share the same key.
+    :param model: Required parameter, the name of the model.
+    :param messages: Required parameter, the list of message dicts sent to the model.
+    :param functions: Optional parameter, the list of function descriptions (or the tools parameter), default is None.
+    :param function_call: Optional parameter, the function_call parameter (or the tool_choice parameter) of the request, default is None.
+    :return: The hex SHA-256 key.
+    """
+    request = {"model": model, "messages": messages, "functions": functions or None, "function_call": function_call}
+    canonical = json.dumps(request, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class _InFlight:
+    """
+    An upstream call other threads with the same key are waiting for.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+        self.latency = 0.0
+
+
+class ResponseCache:
+    """
+    Disk-backed cache of Chat responses, keyed by the canonical hash of the request. Entries live in a SQLite database
+    (in WAL mode, so several worker processes can share it), expire after a TTL and are evicted least recently used first
+    once the cache holds more than `max_entries` responses.
+    Identical requests made at the same time by several sessions of the process collapse into one upstream call.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        :param path: Optional parameter, the SQLite database file. Defaults to the MATEGEN_RESPONSE_CACHE_PATH environment variable,
+        or ~/.cache/mategen/responses.sqlite3.
+        :param ttl: Optional parameter, the number of seconds a response stays valid, default is 24 hours.
+        :param max_entries: Optional parameter, the maximum number of cached responses, default is 10000.
+        """
+        if ttl <= 0:
+            raise ValueError(f"Invalid cache TTL: {ttl}")
+        if max_entries < 1:
+            raise ValueError(f"Invalid maximum number of cache entries: {max_entries}")
+        if path is None:
+            path = os.getenv('MATEGEN_RESPONSE_CACHE_PATH', os.path.join('~', '.cache', 'mategen', 'responses.sqlite3'))
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._async_inflight = {}
+        self._puts_since_eviction = 0
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0  # Requests answered by joining an identical in-flight call
+        self.latency_saved = 0.0  # Seconds of upstream latency avoided by hits and shared calls
+        self._create_table()
+
+    # SQLite connections cannot be shared between threads, so each thread opens its own
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _create_table(self):
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, created REAL NOT NULL, "
+            "last_used REAL NOT NULL, latency REAL NOT NULL)")
+        self._connection().execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    def get(self, key):
+        """
+        Looks up a cached response.
+        :param key: Required parameter, the key returned by make_cache_key.
+        :return: The cached response and the latency of the upstream call that produced it, or (None, 0.0) on a miss.
+        """
+        now = time.time()
+        try:
+            connection = self._connection()
+            row = connection.execute("SELECT response, created, latency FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, 0.0
+            response, created, latency = row
+            if now - created > self.ttl:
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None, 0.0
+            connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        except sqlite3.Error:
+            # The cache is an optimization only; a locked or broken database behaves like a miss
+            return None, 0.0
+        return convert_to_openai_object(json.loads(response)), latency
+
+    def put(self, key, response, latency=0.0):
+        """
+        Stores a response.
+        :param key: Required parameter, the key returned by make_cache_key.
+        :param response: Required parameter, the ChatCompletion response (or any JSON-serializable dict).
+        :param latency: Optional parameter, the seconds the upstream call took, counted as saved on later hits, default is 0.
+        """
+        now = time.time()
+        try:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO responses (key, response, created, last_used, latency) VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(response), now, now, latency))
+        except sqlite3.Error:
+            return
+        with self._lock:
+            self._puts_since_eviction += 1
+            # Counting the table on every put would cost more than the put, so eviction runs every few puts
+            evict = self._puts_since_eviction >= max(1, self.max_entries // 100)
+            if evict:
+                self._puts_since_eviction = 0
+        if evict:
+            self.evict()
+
+    # Method to drop the expired entries and the least recently used entries above max_entries
+    def evict(self):
+        try:
+            connection = self._connection()
+            connection.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+            connection.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        try:
+            self._connection().execute("DELETE FROM responses")
+        except sqlite3.Error:
+            pass
+
+    def lookup(self, key):
+        """
+        Looks up a cached response and counts the hit or miss, for callers that make the upstream call themselves
+        (e.g. streamed requests, which cannot be shared while they are being read).
+        :param key: Required parameter, the key returned by make_cache_key.
+        :return: The cached response, or None.
+        """
+        response, latency = self.get(key)
+        if response is None:
+            with self._lock:
+                self.misses += 1
+        else:
+            self._record_hit(latency)
+        return response
+
+    def _record_hit(self, latency, shared=False):
+        with self._lock:
+            if shared:
+                self.shared += 1
+            else:
+                self.hits += 1
+            self.latency_saved += latency
+
+    def get_or_create(self, key, create, validate=None):
+        """
+        Returns the cached response of a request, or calls `create` once for all the threads asking for it at the same time.
+        :param key: Required parameter, the key returned by make_cache_key.
+        :param create: Required parameter, a callable without arguments that makes the upstream call.
+        :param validate: Optional parameter, a callable returning whether a response may be cached, default is None (always).
+        Invalid responses (e.g. function call arguments that are not valid JSON) are returned but not stored,
+        so that asking again reaches the model instead of replaying the same mistake.
+        :return: The response.
+        """
+        response, latency = self.get(key)
+        if response is not None:
+            self._record_hit(latency)
+            return response
+
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = _InFlight()
+                self._inflight[key] = call
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            self._record_hit(call.latency, shared=True)
+            return call.response
+
+        start = time.perf_counter()
+        try:
+            response = create()
+            call.latency = time.perf_counter() - start
+            call.response = response
+            with self._lock:
+                self.misses += 1
+            if validate is None or validate(response):
+                self.put(key, response, call.latency)
+            return response
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            call.event.set()
+
+    async def aget_or_create(self, key, create, validate=None):
+        """
+        Async version of get_or_create; `create` returns an awaitable, and identical requests of the event loop share one call.
+        """
+        response, latency = self.get(key)
+        if response is not None:
+            self._record_hit(latency)
+            return response
+
+        loop = asyncio.get_running_loop()
+        future = self._async_inflight.get((loop, key))
+        if future is not None:
+            response, latency = await asyncio.shield(future)
+            self._record_hit(latency, shared=True)
+            return response
+
+        future = loop.create_future()
+        self._async_inflight[(loop, key)] = future
+        start = time.perf_counter()
+        try:
+            response = await create()
+            latency = time.perf_counter() - start
+            with self._lock:
+                self.misses += 1
+            if validate is None or validate(response):
+                self.put(key, response, latency)
+            future.set_result((response, latency))
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting for it
+            future.exception()
+            raise
+        finally:
+            self._async_inflight.pop((loop, key), None)
+
+    def stats(self):
+        """
+        :return: A dict with the hit, shared call and miss counters, the hit rate and the seconds of upstream latency saved.
+        """
+        with self._lock:
+            lookups = self.hits + self.shared + self.misses
+            return {"hits": self.hits,
+                    "shared": self.shared,
+                    "misses": self.misses,
+                    "hit_rate": (self.hits + self.shared) / lookups if lookups else 0.0,
+                    "latency_saved_seconds": round(self.latency_saved, 3)}
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def response_cache_enabled():
+    """
+    :return: Whether Chat responses are cached; set the MATEGEN_RESPONSE_CACHE environment variable to 0 to disable the cache.
+    """
+    return os.getenv('MATEGEN_RESPONSE_CACHE', '1') != '0'
+
+
+def get_response_cache():
+    """
+    Returns the process-wide ResponseCache, creating it on first use.
+    :return: The shared ResponseCache object.
+    """
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                _response_cache = ResponseCache()
+    return _response_cache
+
+
+def cached_chat_completion(create, model, messages, functions=None, function_call=None, validate=None):
+    """
+    Answers a Chat request from the shared ResponseCache, calling `create` only on a miss.
+    :param create: Required parameter, a callable without arguments that makes the upstream call.
+    :param model: Required parameter, the name of the model.
+    :param messages: Required parameter, the list of message dicts of the request.
+    :param functions: Optional parameter, the list of function descriptions of the request, default is None.
+    :param function_call: Optional parameter, the function_call parameter of the request, default is None.
+    :param validate: Optional parameter, a callable returning whether a response may be cached, default is None (always).
+    :return: The response.
+    """
+    if not response_cache_enabled():
+        return create()
+    key = make_cache_key(model, messages, functions, function_call)
+    return get_response_cache().get_or_create(key, create, validate)
+
+
+async def acached_chat_completion(create, model, messages, functions=None, function_call=None, validate=None):
+    """
+    Async version of cached_chat_completion; `create` returns an awaitable.
+    """
+    if not response_cache_enabled():
+        return await create()
+    key = make_cache_key(model, messages, functions, function_call)
+    return await get_response_cache().aget_or_create(key, create, validate)
+
+
+def is_valid_chat_response(response):
+    """
+    Checks that a Chat response is worth caching: every function call must carry JSON arguments.
+    :param response: Required parameter, the ChatCompletion response.
+    :return: True if the response may be cached.
+    """
+    message = response["choices"][0]["message"]
+    function_calls = [tool_call["function"] for tool_call in message.get("tool_calls") or []]
+    if message.get("function_call"):
+        function_calls.append(message["function_call"])
+    for function_call in function_calls:
+        try:
+            json.loads(function_call.get("arguments") or "")
+        except ValueError:
+            return False
+    return True
+
+
+def is_valid_json_content(response):
+    """
+    Checks that the content of a Chat response is valid JSON, for requests that ask the model for a JSON object.
+    :param response: Required parameter, the ChatCompletion response.
+    :return: True if the response may be cached.
+    """
+    try:
+        json.loads(response["choices"][0]["message"]["content"] or "")
+    except (ValueError, TypeError):
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    print("This file defines the disk-backed Chat response cache with single-flight de-duplication.")
@@ -0,0 +1,382 @@
+import os
+import re
+import json
+import math
+import time
+import threading
+from collections import Counter
+
+# Routes of a question
+DIRECT = 'direct'  # Answered by the model from its own knowledge; the functions stay available in case it needs data
+SINGLE_TOOL = 'single_tool'  # One lookup or computation; the model calls a function directly
+MULTI_STEP = 'multi_step'  # An analysis in several steps, worth a task decomposition first
+ROUTES = (DIRECT, SINGLE_TOOL, MULTI_STEP)
+
+# Latency assumed for one decomposition call until a real one has been measured
+DEFAULT_DECOMPOSITION_SECONDS = float(os.getenv('MATEGEN_DECOMPOSITION_SECONDS', 3.0))
+
+# Tables of telco_db; naming one means the question needs the database
+TABLE_NAMES = ('user_demographics', 'user_services', 'user_payments', 'user_churn')
+
+# References to the data itself (its columns, its customers, a measure over them); a question making one is never
+# routed as direct, whatever its wording
+DATA_PATTERNS = [re.compile(p) for p in (
+    r'\b(customerid|gender|seniorcitizen|partner|dependents|tenure|phoneservice|multiplelines|internetservice|'
+    r'onlinesecurity|onlinebackup|deviceprotection|techsupport|streamingtv|streamingmovies|contract|paperlessbilling|'
+    r'paymentmethod|monthlycharges|totalcharges)\b',
+    r'\b(customers?|users?|subscribers?|clients?|churned|churners|senior citizens?)\b',
+    r'\b(our|the|this|my) (data|dataset|database|tables?|records?)\b',
+    r'\b(rate|revenue|total|average|percentage|share|proportion|distribution|number) (of|among|by|for|from|in)\b',
+)]
+
+# High-precision rules, checked in order before the classifier
+MULTI_STEP_PATTERNS = [re.compile(p) for p in (
+    r'\b(analy[sz]e|analysis|approach|strategy|plan|design|model(l)?ing|predict\w*|impute|imputation|'
+    r'feature engineering|train\w*|evaluate|correlat\w*|compare|comparison|investigate|insights?|factors|reduce|improve)\b',
+    r'\b(suitable|best|appropriate|right) (method|way)s?\b',
+    r'\bexplain why\b',
+    r'\bstep(s| by step)\b',
+    r'\b(and then|after that|followed by)\b',
+)]
+SINGLE_TOOL_PATTERNS = [re.compile(p) for p in (
+    r'\b(how many|count|number of) (records|rows|users|customers|columns|missing)\b',
+    r'\b(show|list|display|print|view|get|fetch|query|select)\b.*\b(records?|rows?|columns?|table)\b',
+    r'\b(\d+(st|nd|rd|th)|first|last|top \d+) (record|row|records|rows)\b',
+    r'\b(average|mean|sum|max(imum)?|min(imum)?|median|total) (\w+ )?(of|in)\b',
+    r'\b(most|least) (common|frequent)\b',
+)]
+DIRECT_PATTERNS = [re.compile(p) for p in (
+    r'^(what is|what are|who is|who are|explain|introduce|define|tell me about|please introduce)\b',
+)]
+
+# Labelled questions the classifier starts from; more can be learned from the question logs with QuestionRouter.train
+SEED_EXAMPLES = [
+    ("What is Google Cloud Email?", DIRECT),
+    ("Please introduce OpenAI.", DIRECT),
+    ("What is a churn rate?", DIRECT),
+    ("Explain the difference between DSL and fiber optic internet.", DIRECT),
+    ("What does a data dictionary contain?", DIRECT),
+    ("Who developed the Python pandas library?", DIRECT),
+    ("Tell me about logistic regression.", DIRECT),
+    ("What is the meaning of a primary key in a database?", DIRECT),
+    ("Can you explain what SQL joins are?", DIRECT),
+    ("What is the 10th record in user_demographics?", SINGLE_TOOL),
+    ("How many records are there in the user_demographics table?", SINGLE_TOOL),
+    ("Please help me check how many records there are in the user_payments table.", SINGLE_TOOL),
+    ("Show the first 5 rows of user_services.", SINGLE_TOOL),
+    ("What is the average MonthlyCharges in user_payments?", SINGLE_TOOL),
+    ("How many customers have churned?", SINGLE_TOOL),
+    ("List the columns of the user_churn table.", SINGLE_TOOL),
+    ("Count the senior citizens in user_demographics.", SINGLE_TOOL),
+    ("What is the maximum TotalCharges value?", SINGLE_TOOL),
+    ("Load the user_payments table into a DataFrame.", SINGLE_TOOL),
+    ("Plot the distribution of tenure.", SINGLE_TOOL),
+    ("How many users have fiber optic internet service?", SINGLE_TOOL),
+    ("I want to check if there are missing values in the user_payments table in the database.", MULTI_STEP),
+    ("I want to find a suitable method for imputing missing values in the user_payments dataset.", MULTI_STEP),
+    ("Analyze these four tables in the telco_db database and help me outline a basic data analysis approach.", MULTI_STEP),
+    ("Build a model to predict which customers will churn.", MULTI_STEP),
+    ("Compare the churn rate of customers with and without tech support, then explain the difference.", MULTI_STEP),
+    ("Find the factors that influence churn and suggest a retention strategy.", MULTI_STEP),
+    ("Clean the user_payments data, merge it with user_churn and evaluate a logistic regression.", MULTI_STEP),
+    ("Investigate the correlation between contract type and churn.", MULTI_STEP),
+    ("Do feature engineering on the telco data and train a classifier.", MULTI_STEP),
+    ("Help me design a data analysis plan for customer retention.", MULTI_STEP),
+]
+
+
+def refers_to_data(text):
+    """
+    :param text: Required parameter, the lowercase question text.
+    :return: Whether the question refers to the telco data: a table, a column, the customers or a measure over them.
+    """
+    return any(name in text for name in TABLE_NAMES) or any(pattern.search(text) for pattern in DATA_PATTERNS)
+
+
+def tokenize(question):
+    """
+    :param question: Required parameter, the question text.
+    :return: The lowercase words of the question and their bigrams, the features of the classifier.
+    """
+    words = re.findall(r'[a-z_]+|\d+', question.lower())
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class NaiveBayesClassifier:
+    """
+    Multinomial naive Bayes over the words and bigrams of a question, with Laplace smoothing.
+    Small enough to train on the question logs in milliseconds and to classify a question in microseconds.
+    """
+
+    def __init__(self, alpha=1.0):
+        """
+        :param alpha: Optional parameter, the Laplace smoothing constant, default is 1.0.
+        """
+        if alpha <= 0:
+            raise ValueError(f"Invalid smoothing constant: {alpha}")
+        self.alpha = alpha
+        self.class_counts = Counter()
+        self.feature_counts = {}
+        self.feature_totals = Counter()
+        self.vocabulary = set()
+
+    def fit(self, questions, labels):
+        """
+        Adds labelled questions to the model; calling it again continues the training.
+        :param questions: Required parameter, an iterable of questions.
+        :param labels: Required parameter, an iterable of routes, one per question.
+        :return: The classifier.
+        """
+        for question, label in zip(questions, labels):
+            features = tokenize(question)
+            self.class_counts[label] += 1
+            self.feature_counts.setdefault(label, Counter()).update(features)
+            self.feature_totals[label] += len(features)
+            self.vocabulary.update(features)
+        return self
+
+    def predict_proba(self, question):
+        """
+        :param question: Required parameter, the question text.
+        :return: A dict mapping each known route to its probability.
+        """
+        if not self.class_counts:
+            return {}
+        features = tokenize(question)
+        num_questions = sum(self.class_counts.values())
+        vocabulary_size = len(self.vocabulary) + 1
+        log_scores = {}
+        for label, count in self.class_counts.items():
+            counts = self.feature_counts[label]
+            denominator = math.log(self.feature_totals[label] + self.alpha * vocabulary_size)
+            log_scores[label] = math.log(count / num_questions) + sum(
+                math.log(counts[feature] + self.alpha) - denominator for feature in features)
+        top = max(log_scores.values())
+        scores = {label: math.exp(score - top) for label, score in log_scores.items()}
+        total = sum(scores.values())
+        return {label: score / total for label, score in scores.items()}
+
+    def to_dict(self):
+        return {"alpha": self.alpha,
+                "class_counts": dict(self.class_counts),
+                "feature_counts": {label: dict(counts) for label, counts in self.feature_counts.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        classifier = cls(alpha=data.get("alpha", 1.0))
+        classifier.class_counts = Counter(data["class_counts"])
+        for label, counts in data["feature_counts"].items():
+            classifier.feature_counts[label] = Counter(counts)
+            classifier.feature_totals[label] = sum(counts.values())
+            classifier.vocabulary.update(counts)
+        return classifier
+
+
+class RouteDecision:
+    """
+    The route chosen for a question, with the confidence of the choice and what made it ('rule', 'classifier' or 'fallback').
+    """
+
+    __slots__ = ('route', 'confidence', 'source', 'seconds')
+
+    def __init__(self, route, confidence, source, seconds=0.0):
+        self.route = route
+        self.confidence = confidence
+        self.source = source
+        self.seconds = seconds  # Time spent routing
+
+    @property
+    def needs_decomposition(self):
+        return self.route == MULTI_STEP
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"RouteDecision({self.to_dict()})"
+
+
+class QuestionRouter:
+    """
+    Local, CPU-only router deciding how a question is answered before any model call: directly, with a direct function
+    call, or through a task decomposition; the external functions are offered on every route. High-precision rules are checked first, then a naive Bayes
+    classifier trained on labelled questions; when the classifier is not confident the question is decomposed, as it was
+    before the router existed. Only multi-step questions pay for the decomposition round trip, and the router keeps
+    count of the round trips and the latency it saved.
+    """
+
+    def __init__(self, classifier=None, min_confidence=0.6, use_rules=True):
+        """
+        :param classifier: Optional parameter, a trained NaiveBayesClassifier, default is one trained on SEED_EXAMPLES.
+        :param min_confidence: Optional parameter, the probability below which the classifier's choice is not trusted and
+        the question is decomposed, default is 0.6.
+        :param use_rules: Optional parameter, whether the rules are checked before the classifier, default is True.
+        """
+        if not 0 <= min_confidence <= 1:
+            raise ValueError(f"Invalid minimum confidence: {min_confidence}")
+        if classifier is None:
+            classifier = NaiveBayesClassifier().fit(*zip(*SEED_EXAMPLES))
+        self.classifier = classifier
+        self.min_confidence = min_confidence
+        self.use_rules = use_rules
+        self._lock = threading.Lock()
+        # Counters
+        self.route_counts = Counter()
+        self.source_counts = Counter()
+        self.routing_seconds = 0.0
+        self.decomposition_calls = 0
+        self.decomposition_seconds = 0.0
+
+    @classmethod
+    def from_log(cls, path, **kwargs):
+        """
+        Creates a router whose classifier is trained on the seed examples and a question log.
+        :param path: Required parameter, a JSONL file with one {"question": ..., "route": ...} object per line.
+        :param kwargs: Optional parameters passed to QuestionRouter.
+        :return: The QuestionRouter object.
+        """
+        router = cls(**kwargs)
+        router.train_from_log(path)
+        return router
+
+    def train(self, questions, routes):
+        """
+        Trains the classifier further on labelled questions.
+        :param questions: Required parameter, a list of questions.
+        :param routes: Required parameter, a list of routes (DIRECT, SINGLE_TOOL or MULTI_STEP), one per question.
+        """
+        questions, routes = list(questions), list(routes)
+        if len(questions) != len(routes):
+            raise ValueError("questions and routes must have the same length")
+        for route in routes:
+            if route not in ROUTES:
+                raise ValueError(f"Invalid route: {route}")
+        with self._lock:
+            self.classifier.fit(questions, routes)
+
+    def train_from_log(self, path):
+        """
+        :param path: Required parameter, a JSONL file with one {"question": ..., "route": ...} object per line.
+        """
+        questions, routes = [], []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    questions.append(entry["question"])
+                    routes.append(entry["route"])
+        self.train(questions, routes)
+
+    def _rule_route(self, question):
+        text = question.strip().lower()
+        if any(pattern.search(text) for pattern in MULTI_STEP_PATTERNS):
+            return MULTI_STEP
+        if any(pattern.search(text) for pattern in SINGLE_TOOL_PATTERNS):
+            return SINGLE_TOOL
+        # A definition question that does not refer to the data is answered from the model's knowledge
+        if any(pattern.search(text) for pattern in DIRECT_PATTERNS) and not refers_to_data(text):
+            return DIRECT
+        return None
+
+    def route(self, question):
+        """
+        Chooses the route of a question and counts it.
+        :param question: Required parameter, the question text.
+        :return: A RouteDecision object.
+        """
+        start = time.perf_counter()
+        route = self._rule_route(question) if self.use_rules else None
+        if route is not None:
+            decision = RouteDecision(route, 1.0, 'rule')
+        else:
+            with self._lock:
+                probabilities = self.classifier.predict_proba(question)
+            if DIRECT in probabilities and refers_to_data(question.lower()):
+                # A question about the data is not direct: the other routes share the probability
+                direct = probabilities.pop(DIRECT)
+                probabilities = {label: probability / (1 - direct) if direct < 1 else 0.0
+                                 for label, probability in probabilities.items()}
+            route, confidence = max(probabilities.items(), key=lambda item: item[1]) if probabilities else (None, 0.0)
+            if route is not None and confidence >= self.min_confidence:
+                decision = RouteDecision(route, confidence, 'classifier')
+            else:
+                decision = RouteDecision(MULTI_STEP, confidence, 'fallback')
+        decision.seconds = time.perf_counter() - start
+
+        with self._lock:
+            self.route_counts[decision.route] += 1
+            self.source_counts[decision.source] += 1
+            self.routing_seconds += decision.seconds
+        return decision
+
+    # Method to record the latency of a decomposition call, from which the latency saved by skipping one is estimated
+    def record_decomposition(self, seconds):
+        with self._lock:
+            self.decomposition_calls += 1
+            self.decomposition_seconds += seconds
+
+    @property
+    def mean_decomposition_seconds(self):
+        if not self.decomposition_calls:
+            return DEFAULT_DECOMPOSITION_SECONDS
+        return self.decomposition_seconds / self.decomposition_calls
+
+    def report(self):
+        """
+        :return: A dict with the number of questions per route and per decision source, the decomposition round trips skipped,
+        the estimated latency saved (skipped round trips times the mean measured decomposition latency) and the time spent routing.
+        """
+        with self._lock:
+            num_questions = sum(self.route_counts.values())
+            skipped = self.route_counts[DIRECT] + self.route_counts[SINGLE_TOOL]
+            mean_decomposition_seconds = self.mean_decomposition_seconds
+            return {"questions": num_questions,
+                    "routes": {route: self.route_counts[route] for route in ROUTES},
+                    "sources": dict(self.source_counts),
+                    "round_trips_saved": skipped,
+                    "mean_decomposition_seconds": round(mean_decomposition_seconds, 3),
+                    "latency_saved_seconds": round(skipped * mean_decomposition_seconds, 3),
+                    "routing_seconds": round(self.routing_seconds, 6)}
+
+    def save(self, path):
+        """
+        Saves the trained classifier to a JSON file.
+        :param path: Required parameter, the file path.
+        """
+        with self._lock:
+            data = self.classifier.to_dict()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """
+        Creates a router from a classifier saved with save.
+        :param path: Required parameter, the JSON file written by save.
+        :param kwargs: Optional parameters passed to QuestionRouter.
+        :return: The QuestionRouter object.
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            classifier = NaiveBayesClassifier.from_dict(json.load(f))
+        return cls(classifier=classifier, **kwargs)
+
+
+def route_session(router, messages, available_functions, run=None):
+    """
+    Routes the question that opens a conversation session.
+    :param router: Required parameter, a QuestionRouter object.
+    :param messages: Required parameter, the ChatMessages object whose last message is the question.
+    :param available_functions: Required parameter, the AvailableFunctions object of the session, or None.
+    :param run: Optional parameter, the AgentRun of the session, which records the route, default is None.
+    :return: Whether the question is decomposed first, and the external functions offered to the model. The functions
+    are offered on every route: the router only decides whether the decomposition round trip is needed, and a question
+    it wrongly takes for a direct one can still be answered from the database.
+    """
+    decision = router.route(messages.history_messages[-1]["content"] or "")
+    if run is not None:
+        run.route = decision.route
+    return decision.needs_decomposition, available_functions
+
+
+if __name__ == '__main__':
+    print("This file defines the local router that decides whether a question needs a task decomposition.")
@@ -0,0 +1,354 @@
+import os
+import re
+import time
+import threading
+from decimal import Decimal
+import pymysql
+from db import get_pool
+from tokenizer import count_tokens
+
+# Token budget of the schema summary and lifetime of the introspected schema, configurable through the environment
+DEFAULT_SCHEMA_TOKENS = int(os.getenv('MATEGEN_SCHEMA_TOKENS', 400))
+DEFAULT_SCHEMA_TTL = float(os.getenv('MATEGEN_SCHEMA_TTL', 3600))
+SAMPLE_ROWS = 1000  # Rows read from each table to find sample values
+SAMPLE_VALUES = 5  # Columns with at most this many distinct values list them all
+MAX_VALUE_LENGTH = 30
+
+# Detail levels of the summary: names only, plus types and sample values, plus the descriptions of the data dictionary
+NAMES, TYPES, DESCRIPTIONS = 0, 1, 2
+
+
+class ColumnInfo:
+    """
+    A column of the schema, with what a sample of the table shows about its values.
+    """
+
+    def __init__(self, name, data_type, key=False, description=None):
+        self.name = name
+        self.data_type = data_type
+        self.key = key  # Primary, unique or indexed column
+        self.description = description
+        self.values = None  # Every distinct value, when there are few
+        self.value_range = None  # (minimum, maximum) of a numeric column
+        self.example = None
+
+    def sample(self, values):
+        """
+        Records what a sample of the column's values shows.
+        :param values: Required parameter, the values of the column in the sampled rows.
+        """
+        values = [value for value in values if value is not None and value != '']
+        if not values:
+            return
+        distinct = list(dict.fromkeys(values))
+        if all(isinstance(value, (int, float, Decimal)) and not isinstance(value, bool) for value in distinct):
+            self.value_range = (min(distinct), max(distinct))
+        if len(distinct) <= SAMPLE_VALUES and len(values) > len(distinct):
+            self.values = sorted(distinct, key=str)
+        else:
+            self.example = distinct[0]
+
+    def terms(self):
+        # Words of the column name (camelCase and snake_case split) and of its listed values
+        words = re.findall(r'[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+', self.name)
+        for value in self.values or ():
+            words.extend(re.findall(r'[a-zA-Z]+', str(value)))
+        return {_stem(word) for word in words} | {self.name.lower()}
+
+    def render(self, detail):
+        if detail == NAMES:
+            return self.name
+        text = f"{self.name} {self.data_type}" + (" key" if self.key else "")
+        if detail >= DESCRIPTIONS and self.description:
+            text += f" ({self.description})"
+        if self.values is not None:
+            text += " {" + ", ".join(_short(value) for value in self.values) + "}"
+        elif self.value_range is not None:
+            text += f" [{_short(self.value_range[0])}..{_short(self.value_range[1])}]"
+        elif self.example is not None:
+            text += f" e.g. {_short(self.example)}"
+        return text
+
+
+class TableInfo:
+    """
+    A table of the schema: its approximate row count and its columns.
+    """
+
+    def __init__(self, name, rows=None, columns=None, description=None):
+        self.name = name
+        self.rows = rows
+        self.columns = columns if columns is not None else []
+        self.description = description
+
+    def terms(self):
+        return {_stem(word) for word in re.findall(r'[a-z]+', self.name.lower())}
+
+    def render(self, detail, columns=None):
+        columns = columns if columns is not None else self.columns
+        header = self.name + (f" ({self.rows} rows)" if self.rows is not None and detail > NAMES else "")
+        if detail >= DESCRIPTIONS and self.description:
+            header += f" - {self.description}"
+        return header + ": " + "; ".join(column.render(detail) for column in columns)
+
+
+def _stem(word):
+    word = word.lower()
+    return word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word
+
+
+def _short(value):
+    text = str(value.normalize() if isinstance(value, Decimal) else value)
+    return text if len(text) <= MAX_VALUE_LENGTH else text[:MAX_VALUE_LENGTH - 3] + "..."
+
+
+def mysql_schema(connection):
+    """
+    Reads the tables, columns and foreign keys of the current MySQL database from information_schema.
+    :param connection: Required parameter, a pymysql connection.
+    :return: The SQL dialect, the dict of table name to TableInfo and the list of foreign keys as
+    (table, column, referenced table, referenced column) tuples.
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT c.TABLE_NAME, c.COLUMN_NAME, c.DATA_TYPE, c.COLUMN_KEY, t.TABLE_ROWS "
+                       "FROM information_schema.COLUMNS c JOIN information_schema.TABLES t "
+                       "ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME "
+                       "WHERE c.TABLE_SCHEMA = DATABASE() ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION")
+        tables = {}
+        for table, column, data_type, column_key, rows in cursor.fetchall():
+            info = tables.setdefault(table, TableInfo(table, rows))
+            info.columns.append(ColumnInfo(column, data_type.upper(), key=bool(column_key)))
+        cursor.execute("SELECT TABLE_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME "
+                       "FROM information_schema.KEY_COLUMN_USAGE "
+                       "WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL")
+        foreign_keys = [tuple(row) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+    return "MySQL", tables, foreign_keys
+
+
+# Schema readers by connection type
+SCHEMA_READERS = {pymysql.connections.Connection: mysql_schema}
+
+
+def parse_data_dictionary(text):
+    """
+    Extracts the table and column descriptions of a Markdown data dictionary such as telco_data_dictionary.md:
+    '## <n>.<table>' headings, the first sentence of each 'Basic Explanation', and '| column | description | ...' rows,
+    with the value explanation of coded columns.
+    :param text: Required parameter, the Markdown text.
+    :return: A dict of table name to a dict with the 'description' of the table and the 'columns' descriptions.
+    """
+    descriptions = {}
+    table = None
+    explanation = False
+    for line in text.splitlines():
+        line = line.replace('\u200b', '').strip()
+        heading = re.match(r'##\s*\d*\.?\s*(\w+)', line)
+        if heading:
+            table = descriptions.setdefault(heading.group(1), {"description": None, "columns": {}})
+            continue
+        if table is None:
+            continue
+        if 'Basic Explanation' in line:
+            explanation = True
+        elif explanation and line and not line.startswith('-'):
+            table["description"] = re.split(r'\.(?=\s|[A-Z]|$)', line)[0]
+            explanation = False
+        cells = [cell.strip() for cell in line.strip('|').split('|')] if line.startswith('|') else []
+        if len(cells) >= 2 and cells[0] and cells[0] != 'Column Name' and not set(cells[0]) <= {'-'}:
+            description = cells[1]
+            # Coded values such as '0 (yes), 1 (no)' are kept, the sample values alone cannot tell what they mean
+            if len(cells) >= 4 and re.search(r'\d \(', cells[3]):
+                description += f": {cells[3]}"
+            table["columns"][cells[0]] = description
+    return descriptions
+
+
+class SchemaContext:
+    """
+    Schema summary sent to the model in place of a static data dictionary. The schema is introspected from the database
+    once (and again after `ttl` seconds), with sample values and join keys. For each question, only the tables and columns
+    the question is about are rendered, at the most detailed level that fits the token budget, so the prompt stays small
+    however many tables the database holds.
+    """
+
+    def __init__(self, pool=None, max_tokens=DEFAULT_SCHEMA_TOKENS, ttl=DEFAULT_SCHEMA_TTL, descriptions=None,
+                 tables=None, model="gpt-3.5-turbo"):
+        """
+        :param pool: Optional parameter, the ConnectionPool, default is db.get_pool() at the time of the introspection.
+        :param max_tokens: Optional parameter, the token budget of a rendered summary, default is 400.
+        :param ttl: Optional parameter, the number of seconds the introspected schema is reused, default is 3600.
+        :param descriptions: Optional parameter, table and column descriptions as returned by parse_data_dictionary, default is None.
+        :param tables: Optional parameter, the names of the tables to describe, default is None, every table of the database.
+        :param model: Optional parameter, the name of the model whose tokenizer counts the summary, default is 'gpt-3.5-turbo'.
+        """
+        if max_tokens <= 0:
+            raise ValueError(f"Invalid schema token budget: {max_tokens}")
+        self.pool = pool
+        self.max_tokens = max_tokens
+        self.ttl = ttl
+        self.descriptions = descriptions or {}
+        self.table_names = tables
+        self.model = model
+        self.dialect = None
+        self.tables = {}
+        self.join_keys = {}  # Column name to the tables it links
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    # Method to create a SchemaContext with the descriptions of a Markdown data dictionary file
+    @classmethod
+    def from_data_dictionary(cls, path, **options):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(descriptions=parse_data_dictionary(f.read()), **options)
+
+    def load(self, force=False):
+        """
+        Introspects the schema unless it was loaded less than `ttl` seconds ago.
+        :param force: Optional parameter, whether to introspect again now, default is False.
+        """
+        with self._lock:
+            if not force and self._loaded is not None and time.monotonic() - self._loaded < self.ttl:
+                return
+            pool = self.pool if self.pool is not None else get_pool()
+            with pool.connection() as connection:
+                reader = next((reader for connection_type, reader in SCHEMA_READERS.items()
+                               if isinstance(connection, connection_type)), None)
+                if reader is None:
+                    raise ValueError(f"No schema reader for {type(connection).__name__} connections")
+                dialect, tables, foreign_keys = reader(connection)
+                if self.table_names is not None:
+                    tables = {name: table for name, table in tables.items() if name in self.table_names}
+                for table in tables.values():
+                    self._sample(connection, table)
+            self._describe(tables)
+            self.dialect = dialect
+            self.tables = tables
+            self.join_keys = self._find_join_keys(tables, foreign_keys)
+            self._loaded = time.monotonic()
+
+    @staticmethod
+    def _sample(connection, table):
+        cursor = connection.cursor()
+        try:
+            # Backticks quote identifiers in MySQL and in SQLite
+            cursor.execute(f"SELECT * FROM `{table.name}` LIMIT {SAMPLE_ROWS}")
+            names = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        for column in table.columns:
+            if column.name in names:
+                position = names.index(column.name)
+                column.sample([row[position] for row in rows])
+
+    def _describe(self, tables):
+        for name, table in tables.items():
+            described = self.descriptions.get(name, {})
+            table.description = described.get("description")
+            for column in table.columns:
+                column.description = described.get("columns", {}).get(column.name)
+
+    @staticmethod
+    def _find_join_keys(tables, foreign_keys):
+        # Declared foreign keys, and columns of the same name in several tables that are keys or ids in one of them
+        join_keys = {}
+        for table, column, referenced_table, referenced_column in foreign_keys:
+            if column == referenced_column and table in tables and referenced_table in tables:
+                join_keys.setdefault(column, set()).update((table, referenced_table))
+        owners = {}
+        for table in tables.values():
+            for column in table.columns:
+                owners.setdefault(column.name, []).append((table.name, column))
+        for name, columns in owners.items():
+            if len(columns) > 1 and (name.lower().endswith('id') or any(column.key for _, column in columns)):
+                join_keys.setdefault(name, set()).update(table for table, _ in columns)
+        return {name: sorted(linked) for name, linked in join_keys.items()}
+
+    def select(self, question):
+        """
+        Picks the tables and columns a question is about, by the words it shares with table names, column names and the
+        listed values of the columns (e.g. 'fiber' selects InternetService). Rare words weigh more than words every
+        table has, such as 'user'.
+        :param question: Required parameter, the question text.
+        :return: A list of (TableInfo, columns) pairs, the most relevant first; every table when nothing matches.
+        """
+        words = {_stem(word) for word in re.findall(r'[a-z0-9]+', question.lower())}
+        table_terms = {name: table.terms() for name, table in self.tables.items()}
+        column_terms = {(name, column.name): column.terms()
+                        for name, table in self.tables.items() for column in table.columns}
+        frequency = {}
+        for terms in list(table_terms.values()) + list(column_terms.values()):
+            for term in terms:
+                frequency[term] = frequency.get(term, 0) + 1
+
+        def score(terms):
+            return sum(1 / frequency[term] for term in terms & words)
+
+        selected = []
+        for name, table in self.tables.items():
+            table_score = 3 * score(table_terms[name])
+            # Join keys such as customerID are in every table and say nothing of what the question is about
+            scores = {column.name: score(column_terms[(name, column.name)]) for column in table.columns
+                      if column.name not in self.join_keys}
+            total = table_score + sum(scores.values())
+            if total <= 0:
+                continue
+            if table_score <= 0:
+                # Only some columns match: keep them and the keys needed to join the table
+                columns = [column for column in table.columns
+                           if scores.get(column.name, 0) > 0 or column.name in self.join_keys]
+            else:
+                columns = table.columns
+            selected.append((total, table, columns))
+        if not selected:
+            return [(table, table.columns) for table in self.tables.values()]
+        selected.sort(key=lambda item: -item[0])
+        return [(table, columns) for _, table, columns in selected]
+
+    def _render(self, selection, details, list_others=True):
+        lines = [f"Tables of the database ({self.dialect}); columns with their type, key flag and sample values:"]
+        lines.extend(table.render(detail, columns) for (table, columns), detail in zip(selection, details))
+        names = {table.name for table, _ in selection}
+        keys = [f"{name} ({', '.join(table for table in linked if table in names)})"
+                for name, linked in self.join_keys.items() if len(set(linked) & names) > 1]
+        if keys:
+            lines.append("Join keys: " + "; ".join(keys))
+        others = [name for name in self.tables if name not in names]
+        if others:
+            lines.append("Other tables: " + (", ".join(others) if list_others else f"{len(others)} more"))
+        return "\n".join(lines)
+
+    def render(self, question=None, max_tokens=None):
+        """
+        Renders the schema summary for a question.
+        :param question: Optional parameter, the question; default is None, which renders every table.
+        :param max_tokens: Optional parameter, the token budget, default is the budget of the object.
+        :return: The summary text.
+        """
+        self.load()
+        max_tokens = max_tokens if max_tokens is not None else self.max_tokens
+        selection = self.select(question) if question else [(table, table.columns) for table in self.tables.values()]
+        details = [DESCRIPTIONS] * len(selection)
+        list_others = True
+        while True:
+            text = self._render(selection, details, list_others)
+            # Once no table is left to reduce or drop, the shortest summary is returned even if over the budget
+            reduced = len(selection) <= 1 and max(details, default=NAMES) == NAMES and not list_others
+            if reduced or count_tokens(text, self.model) <= max_tokens:
+                return text
+            # The least relevant table still detailed loses a level; once every table is reduced to names, the other
+            # tables are only counted, then the least relevant table joins them
+            position = next((i for i in reversed(range(len(details))) if details[i] > NAMES), None)
+            if position is not None:
+                details[position] -= 1
+            elif list_others:
+                list_others = False
+            else:
+                selection, details = selection[:-1], details[:-1]
+
+
+if __name__ == '__main__':
+    print("This file defines the schema summary sent to the model, introspected from the database and pruned per question.")
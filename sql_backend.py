@@ -0,0 +1,351 @@
+import os
+import re
+import sqlite3
+import threading
+import pandas as pd
+from db import ConnectionPool, mysql_connect, set_pool
+from sql_cache import NormalizedQuery, KEYWORDS, STAMP_READERS
+from sql_guard import PlanStep, PLAN_READERS
+from schema_context import ColumnInfo, TableInfo, SCHEMA_READERS
+from sql_timeout import CANCELLERS, INTERRUPTED
+
+# Directory of the telco CSV files shipped with the repository
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'telco_data')
+
+# Column types of the telco_db tables, as described in telco_data_dictionary.md; TotalCharges is stored as a number,
+# with the blank values of the customers without billing history as NULL
+TELCO_TABLES = {
+    "user_demographics": {"customerID": "TEXT", "gender": "TEXT", "SeniorCitizen": "INTEGER", "Partner": "TEXT",
+                          "Dependents": "TEXT"},
+    "user_services": {"customerID": "TEXT", "PhoneService": "TEXT", "MultipleLines": "TEXT", "InternetService": "TEXT",
+                      "OnlineSecurity": "TEXT", "OnlineBackup": "TEXT", "DeviceProtection": "TEXT", "TechSupport": "TEXT",
+                      "StreamingTV": "TEXT", "StreamingMovies": "TEXT"},
+    "user_payments": {"customerID": "TEXT", "Contract": "TEXT", "PaperlessBilling": "TEXT", "PaymentMethod": "TEXT",
+                      "MonthlyCharges": "REAL", "TotalCharges": "REAL"},
+    "user_churn": {"customerID": "TEXT", "Churn": "TEXT"},
+}
+# Version of the loading rules, stored as the user_version of the database file; a file built by other rules is rebuilt
+BUILD_VERSION = 2
+
+
+class SqlBackend:
+    """
+    A database the SQL tools can run on: how to open a connection, and the pool the connections are shared through.
+    """
+
+    name = None
+
+    def connect(self):
+        """
+        :return: A new DB-API connection.
+        """
+        raise NotImplementedError
+
+    def create_pool(self, **pool_options):
+        """
+        :param pool_options: Optional parameters passed to ConnectionPool (min_size, max_size, ...).
+        :return: A ConnectionPool opening the connections of this backend.
+        """
+        return ConnectionPool(self.connect, **pool_options)
+
+
+class MySQLBackend(SqlBackend):
+    """
+    The MySQL server described by the MYSQL_* environment variables, see db.mysql_config.
+    """
+
+    name = "mysql"
+
+    def __init__(self, **overrides):
+        """
+        :param overrides: Optional parameters replacing those of db.mysql_config().
+        """
+        self.overrides = overrides
+
+    def connect(self):
+        return mysql_connect(**self.overrides)
+
+
+class SQLiteBackend(SqlBackend):
+    """
+    An embedded SQLite database built from the telco CSV files: typed columns, TEXT compared case-insensitively like
+    MySQL's default collation, an index on customerID and planner statistics. The training splits are loaded as the
+    telco_db tables and the test splits as <table>_test. The database is rebuilt when a CSV file is newer than it.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path=None, data_dir=DEFAULT_DATA_DIR, tables=None, test_splits=True):
+        """
+        :param path: Optional parameter, the database file. Defaults to the MATEGEN_SQLITE_PATH environment variable,
+        or ~/.cache/mategen/telco_db.sqlite3.
+        :param data_dir: Optional parameter, the directory of the CSV files, default is the telco_data directory of the repository.
+        :param tables: Optional parameter, a dict of table name to a dict of column name to SQLite type, default is TELCO_TABLES.
+        :param test_splits: Optional parameter, whether to load the test splits as <table>_test tables, default is True.
+        """
+        if path is None:
+            path = os.getenv('MATEGEN_SQLITE_PATH', os.path.join('~', '.cache', 'mategen', 'telco_db.sqlite3'))
+        self.path = os.path.expanduser(path)
+        self.data_dir = data_dir
+        self.tables = tables if tables is not None else TELCO_TABLES
+        self.test_splits = test_splits
+        self._built = False
+        self._lock = threading.Lock()
+
+    # Method to list the tables to load and their CSV files
+    def sources(self):
+        sources = {}
+        for table in self.tables:
+            sources[table] = os.path.join(self.data_dir, f"{table}_train.csv")
+            if self.test_splits:
+                sources[f"{table}_test"] = os.path.join(self.data_dir, f"{table}_test.csv")
+        return {table: path for table, path in sources.items() if os.path.exists(path)}
+
+    def stale(self):
+        if not os.path.exists(self.path):
+            return True
+        connection = sqlite3.connect(self.path)
+        try:
+            if connection.execute("PRAGMA user_version").fetchone()[0] != BUILD_VERSION:
+                return True
+        finally:
+            connection.close()
+        built = os.path.getmtime(self.path)
+        return any(os.path.getmtime(path) > built for path in self.sources().values())
+
+    def build(self, force=False):
+        """
+        Loads the CSV files into a new database file, which replaces the previous one once it is complete, so that other
+        processes never open a half-built database.
+        :param force: Optional parameter, whether to rebuild an up-to-date database, default is False.
+        """
+        if not force and not self.stale():
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        building = f"{self.path}.{os.getpid()}.building"
+        if os.path.exists(building):
+            os.remove(building)
+        connection = sqlite3.connect(building)
+        try:
+            for table, source in self.sources().items():
+                columns = self.tables[table.removesuffix("_test")]
+                self._load_table(connection, table, columns, source)
+            connection.execute("ANALYZE")
+            connection.execute(f"PRAGMA user_version = {BUILD_VERSION}")
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(building, self.path)
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    @staticmethod
+    def _load_table(connection, table, columns, source):
+        definitions = ", ".join(f'"{name}" {column_type}' + (" COLLATE NOCASE" if column_type == "TEXT" else "")
+                                for name, column_type in columns.items())
+        connection.execute(f'CREATE TABLE "{table}" ({definitions})')
+        data = pd.read_csv(source, dtype=str, keep_default_na=False)
+        data = data[[name for name in columns if name in data.columns]]
+        for name in data.columns:
+            # Blank cells are missing values whatever the type of the column, as in MySQL's telco_db
+            values = data[name].str.strip()
+            if columns[name] in ("INTEGER", "REAL"):
+                data[name] = pd.to_numeric(values, errors='coerce')
+                if columns[name] == "INTEGER":
+                    data[name] = data[name].astype("Int64")
+            else:
+                data[name] = data[name].where(values != '')
+        rows = data.astype(object).where(data.notna(), None).itertuples(index=False, name=None)
+        names = ", ".join(f'"{name}"' for name in data.columns)
+        connection.executemany(f'INSERT INTO "{table}" ({names}) VALUES ({", ".join("?" * len(data.columns))})', rows)
+        if "customerID" in data.columns:
+            connection.execute(f'CREATE INDEX "{table}_customerID" ON "{table}" ("customerID")')
+
+    def connect(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    self.build()
+                    self._built = True
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA mmap_size=268435456")
+        return connection
+
+
+def _file_stamp(path):
+    try:
+        status = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return status.st_mtime_ns, status.st_size
+
+
+def sqlite_stamps(connection, tables=()):
+    """
+    Stamps the tables of a SQLite database with the modification time and size of its files, which change with every
+    committed write: any write invalidates every table.
+    :param connection: Required parameter, a sqlite3 connection.
+    :param tables: Optional parameter, the tables read by the query; every table is stamped the same way, default is ().
+    :return: A dict of table name to stamp.
+    """
+    path = next((row[2] for row in connection.execute("PRAGMA database_list") if row[1] == "main"), "")
+    # An in-memory database has no files to stamp, so its tables are not versioned
+    stamp = tuple(_file_stamp(name) for name in (path, path + "-wal")) if path else None
+    tables = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+    return {name: stamp for name, in tables}
+
+
+_SCAN = re.compile(r"(SCAN|SEARCH) (\S+)(?: USING (?:AUTOMATIC )?(?:PARTIAL )?(?:COVERING )?"
+                   r"(?:INDEX(?: ([^\s(]\S*))?|(INTEGER PRIMARY KEY)))?")
+_SUBQUERY = ("MATERIALIZE", "CO-ROUTINE", "SCALAR SUBQUERY", "CORRELATED", "LIST SUBQUERY", "COMPOUND")
+
+
+def _table_aliases(sql_query, tables):
+    # Names the plan uses for each table of the query: the table itself, or its alias
+    tokens = NormalizedQuery(sql_query).tokens
+    aliases = {table: table for table in tables}
+    for index, token in enumerate(tokens[:-1]):
+        if token in tables:
+            alias = tokens[index + 2] if tokens[index + 1] == "AS" and index + 2 < len(tokens) else tokens[index + 1]
+            if re.match(r"[a-z_]\w*$", alias, re.IGNORECASE) and alias.upper() not in KEYWORDS:
+                aliases[alias] = token
+    return aliases
+
+
+def sqlite_plan(connection, sql_query):
+    """
+    Reads the plan of a query with SQLite's EXPLAIN QUERY PLAN. SQLite joins with nested loops and reports no row
+    estimates, so a full scan is costed at the row count of the table and an index search at the average rows per key
+    recorded by ANALYZE.
+    :param connection: Required parameter, a sqlite3 connection.
+    :param sql_query: Required parameter, the SQL query.
+    :return: The list of PlanStep objects, in join order.
+    """
+    statistics = {}
+    try:
+        for table, index, stat in connection.execute("SELECT tbl, idx, stat FROM sqlite_stat1"):
+            numbers = [int(number) for number in stat.split()[:2]]
+            statistics.setdefault(table, {"rows": numbers[0]})
+            if index and len(numbers) > 1:
+                statistics[table][index] = numbers[1]
+    except sqlite3.OperationalError:
+        pass
+    aliases = _table_aliases(sql_query, {name for name, in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")})
+
+    nodes = {}
+    steps = []
+    for node_id, parent, _, detail in connection.execute("EXPLAIN QUERY PLAN " + sql_query).fetchall():
+        nodes[node_id] = (parent, detail)
+        match = _SCAN.match(detail)
+        if match is None:
+            continue
+        operation, name, index, primary_key = match.groups()
+        table = aliases.get(name, name)
+        table_rows = statistics.get(table, {}).get("rows")
+        if table_rows is None:
+            table_rows = connection.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] if table in aliases else 0
+        if operation == "SCAN":
+            access_type, rows = ("index" if index else "ALL"), table_rows
+        else:
+            access_type = "ref"
+            rows = 1 if primary_key else statistics.get(table, {}).get(index, max(table_rows // 10, 1))
+        # Steps inside a subquery belong to a separate SELECT
+        select_id, ancestor = 0, parent
+        while ancestor in nodes:
+            if nodes[ancestor][1].startswith(_SUBQUERY):
+                select_id = ancestor
+                break
+            ancestor = nodes[ancestor][0]
+        steps.append(PlanStep(select_id, table, access_type, index or ("PRIMARY" if primary_key else None), rows,
+                              extra=detail))
+    return steps
+
+
+def sqlite_schema(connection):
+    """
+    Reads the tables, columns and foreign keys of a SQLite database from its PRAGMAs; the row counts are those recorded
+    by ANALYZE.
+    :param connection: Required parameter, a sqlite3 connection.
+    :return: The SQL dialect, the dict of table name to TableInfo and the list of foreign keys as
+    (table, column, referenced table, referenced column) tuples.
+    """
+    rows = {}
+    try:
+        for table, index, stat in connection.execute("SELECT tbl, idx, stat FROM sqlite_stat1"):
+            rows.setdefault(table, int(stat.split()[0]))
+    except sqlite3.OperationalError:
+        pass
+    tables = {}
+    foreign_keys = []
+    for table, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' "
+                                     "ORDER BY name").fetchall():
+        indexed = {column for index in connection.execute(f'PRAGMA index_list("{table}")').fetchall()
+                   for _, _, column in connection.execute(f'PRAGMA index_info("{index[1]}")').fetchall()}
+        columns = [ColumnInfo(name, (column_type or "TEXT").upper(), key=bool(primary_key) or name in indexed)
+                   for _, name, column_type, _, _, primary_key in connection.execute(f'PRAGMA table_info("{table}")')]
+        tables[table] = TableInfo(table, rows.get(table), columns)
+        foreign_keys.extend((table, key[3], key[2], key[4] or key[3])
+                            for key in connection.execute(f'PRAGMA foreign_key_list("{table}")'))
+    return "SQLite", tables, foreign_keys
+
+
+def sqlite_cancel(connection, connect):
+    """
+    Cancels the statement running on a SQLite connection. SQLite runs in the process, so no side connection is needed:
+    interrupt() stops the statement at its next step.
+    :param connection: Required parameter, the sqlite3 connection running the statement.
+    :param connect: Required parameter, unused.
+    """
+    connection.interrupt()
+
+
+def sqlite_interrupted(exception):
+    return isinstance(exception, sqlite3.OperationalError) and "interrupted" in str(exception)
+
+
+STAMP_READERS[sqlite3.Connection] = sqlite_stamps
+PLAN_READERS[sqlite3.Connection] = sqlite_plan
+SCHEMA_READERS[sqlite3.Connection] = sqlite_schema
+CANCELLERS[sqlite3.Connection] = sqlite_cancel
+INTERRUPTED[sqlite3.Connection] = sqlite_interrupted
+
+# Backends by name, selected with the MATEGEN_SQL_BACKEND environment variable
+BACKENDS = {MySQLBackend.name: MySQLBackend, SQLiteBackend.name: SQLiteBackend}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Returns the process-wide backend of the SQL tools, chosen on first use with the MATEGEN_SQL_BACKEND environment
+    variable: mysql (default) or sqlite.
+    :return: The SqlBackend object.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = os.getenv('MATEGEN_SQL_BACKEND', MySQLBackend.name).lower()
+                if name not in BACKENDS:
+                    raise ValueError(f"Unknown SQL backend: {name}, expected one of {', '.join(BACKENDS)}")
+                _backend = BACKENDS[name]()
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Switches the SQL tools to another backend; the shared pool is replaced by one of the new backend.
+    :param backend: Required parameter, a SqlBackend object.
+    """
+    global _backend
+    with _backend_lock:
+        _backend = backend
+    set_pool(backend.create_pool())
+
+
+if __name__ == '__main__':
+    print("This file defines the SQL backends of the tools: the MySQL server and an embedded SQLite database of the telco CSVs.")
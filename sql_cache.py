@@ -0,0 +1,440 @@
+import os
+import re
+import sys
+import time
+import threading
+from collections import OrderedDict
+import pymysql
+from db import get_pool
+
+# Memory budget of the cached results and delay between two reads of the table versions, configurable through the environment
+DEFAULT_MAX_BYTES = int(os.getenv('MATEGEN_SQL_CACHE_BYTES', 32 * 2 ** 20))
+DEFAULT_VERSION_TTL = float(os.getenv('MATEGEN_SQL_CACHE_VERSION_TTL', 5))
+# Checksums scan their tables, so they are kept longer; a table without an update time gets one as soon as it is written
+DEFAULT_CHECKSUM_TTL = float(os.getenv('MATEGEN_SQL_CACHE_CHECKSUM_TTL', 300))
+
+# Stamp of a table that can only be versioned by a checksum of its rows, computed when a query reads the table
+NEEDS_CHECKSUM = "needs checksum"
+
+_TOKEN = re.compile(r"""
+    (?P<comment>--[^\n]*|\#[^\n]*|/\*(?![!+]).*?\*/)
+  | (?P<hint>/\*[!+].*?\*/)
+  | (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+  | (?P<quoted>`(?:[^`]|``)*`)
+  | (?P<number>0x[0-9a-f]+|(?:\d+\.?\d*|\.\d+)(?:e[+-]?\d+)?)
+  | (?P<word>[a-z_$][\w$]*)
+  | (?P<variable>@@?[\w$.]*)
+  | (?P<operator><=>|<=|>=|<>|!=|:=|\|\||&&|<<|>>|\S)
+""", re.VERBOSE | re.DOTALL | re.IGNORECASE)
+_IDENTIFIER = re.compile(r"[a-z_$][\w$]*$", re.IGNORECASE)
+
+# Words written in upper case in the normalized text; function names are recognized by the parenthesis that follows them
+KEYWORDS = frozenset("""
+    ALL AND ANY AS ASC BETWEEN BY CASE CROSS DESC DISTINCT DIV ELSE END EXISTS FALSE FOR FROM FULL GROUP HAVING IN INNER
+    INTERVAL INTO IS JOIN LEFT LIKE LIMIT LOCK MOD NATURAL NOT NULL OFFSET ON OR ORDER OUTER OVER PARTITION REGEXP RIGHT
+    RLIKE ROLLUP SELECT SET SHARE STRAIGHT_JOIN THEN TRUE UNION UPDATE USING VALUES WHEN WHERE WINDOW WITH XOR
+""".split())
+# Statements whose result is cached, and statements after which the tables they name are considered changed
+READ_STATEMENTS = frozenset(("SELECT", "WITH"))
+WRITE_STATEMENTS = frozenset(("INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "ALTER", "DROP", "TRUNCATE", "RENAME",
+                              "LOAD"))
+# Functions whose value changes between two runs of the same query
+VOLATILE_FUNCTIONS = frozenset("""
+    NOW SYSDATE CURDATE CURTIME CURRENT_DATE CURRENT_TIME CURRENT_TIMESTAMP LOCALTIME LOCALTIMESTAMP UTC_DATE UTC_TIME
+    UTC_TIMESTAMP UNIX_TIMESTAMP RAND UUID UUID_SHORT CONNECTION_ID LAST_INSERT_ID FOUND_ROWS ROW_COUNT USER CURRENT_USER
+    SESSION_USER SYSTEM_USER DATABASE SCHEMA SLEEP GET_LOCK RELEASE_LOCK IS_FREE_LOCK BENCHMARK
+""".split())
+# Schemas whose content is not versioned by the tables of the database
+SYSTEM_SCHEMAS = frozenset(("information_schema", "performance_schema", "mysql", "sys"))
+
+
+class NormalizedQuery:
+    """
+    A SQL statement in canonical form: comments removed, whitespace collapsed, keywords and function names in upper case,
+    string literals single-quoted and redundant identifier quotes dropped. Identifiers keep their case, since they name
+    the columns of the result.
+    """
+
+    def __init__(self, sql_query):
+        """
+        :param sql_query: Required parameter, the SQL text.
+        """
+        matches = [(match.lastgroup, match.group()) for match in _TOKEN.finditer(sql_query)]
+        tokens = []
+        self.names = set()  # Bare and quoted identifiers, candidates for table names
+        self.volatile = False
+        for index, (kind, text) in enumerate(matches):
+            if kind == 'comment':
+                continue
+            if kind == 'hint':
+                text = " ".join(text.split())
+            elif kind == 'string':
+                text = self._canonical_string(text)
+            elif kind == 'quoted':
+                name = text[1:-1].replace('``', '`')
+                self.names.add(name)
+                if _IDENTIFIER.match(name) and name.upper() not in KEYWORDS:
+                    text = name
+            elif kind == 'number':
+                text = text.lower()
+            elif kind == 'word':
+                following = next((other for other_kind, other in matches[index + 1:] if other_kind != 'comment'), None)
+                if text.upper() in KEYWORDS or following == '(':
+                    text = text.upper()
+                    self.volatile = self.volatile or text in VOLATILE_FUNCTIONS
+                else:
+                    self.names.add(text)
+            elif kind == 'variable':
+                self.volatile = True
+            elif text == '!=':
+                text = '<>'
+            tokens.append(text)
+        while tokens and tokens[-1] == ';':
+            tokens.pop()
+        self.tokens = tokens
+        self.text = " ".join(tokens)
+        self.keywords = {token.upper() for token in tokens if _IDENTIFIER.match(token) and token not in self.names}
+        words = [token for token in tokens if token != '(']
+        self.statement = words[0].upper() if words else ""
+
+    @staticmethod
+    def _canonical_string(text):
+        # "text" and 'text' are the same literal in MySQL; escapes are left as written
+        if text[0] == '"' and '\\' not in text:
+            return "'" + text[1:-1].replace('""', '"').replace("'", "''") + "'"
+        return text
+
+    @property
+    def cacheable(self):
+        """
+        Whether the result only depends on the data of the tables: a single SELECT statement without volatile functions,
+        user variables, locking reads or INTO clauses, and without system schemas.
+        """
+        return (self.statement in READ_STATEMENTS and not self.volatile and ';' not in self.tokens
+                and not self.keywords & {"INTO", "LOCK", "SHARE", "UPDATE", "DELETE"}
+                and not {name.lower() for name in self.names} & SYSTEM_SCHEMAS)
+
+    @property
+    def writes(self):
+        # WITH ... UPDATE and WITH ... DELETE write too
+        return self.statement in WRITE_STATEMENTS or (self.statement == "WITH" and bool(self.keywords & WRITE_STATEMENTS))
+
+
+def normalize_sql(sql_query):
+    """
+    :param sql_query: Required parameter, the SQL text.
+    :return: The canonical text of the query, used as the cache key.
+    """
+    return NormalizedQuery(sql_query).text
+
+
+def strip_statement_end(sql_query):
+    """
+    :param sql_query: Required parameter, the SQL text.
+    :return: The text without its trailing comments, semicolons and whitespace.
+    """
+    end = 0
+    for match in _TOKEN.finditer(sql_query):
+        if match.lastgroup != 'comment' and match.group() != ';':
+            end = match.end()
+    return sql_query[:end]
+
+
+def mysql_stamps(connection, tables=()):
+    """
+    Reads the version stamp of every table of the current MySQL database: its creation time and last update time from
+    information_schema.TABLES. InnoDB leaves UPDATE_TIME empty until a table is written after a server restart (and
+    always before MySQL 5.7); those tables are stamped with CHECKSUM TABLE when they are among `tables`, and with
+    NEEDS_CHECKSUM otherwise. UPDATE_TIME only counts whole seconds, so a table updated during the current second of
+    the server is not versioned: another write in the same second would leave its stamp unchanged.
+    :param connection: Required parameter, a pymysql connection.
+    :param tables: Optional parameter, the tables read by the query, checksummed when they have no update time, default is ().
+    :return: A dict of table name to stamp; the stamp is None when the table cannot be versioned.
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT TABLE_NAME, CREATE_TIME, UPDATE_TIME, NOW() FROM information_schema.TABLES "
+                       "WHERE TABLE_SCHEMA = DATABASE()")
+        stamps = {}
+        for name, create_time, update_time, now in cursor.fetchall():
+            if update_time is None:
+                stamps[name] = NEEDS_CHECKSUM
+            else:
+                stamps[name] = (create_time, update_time) if update_time < now else None
+        unknown = [name for name in tables if stamps.get(name) == NEEDS_CHECKSUM]
+        if unknown:
+            cursor.execute("CHECKSUM TABLE " + ", ".join("`" + name.replace('`', '``') + "`" for name in unknown))
+            for table, value in cursor.fetchall():
+                name = table.split('.', 1)[-1]
+                if name in stamps:
+                    stamps[name] = ("checksum", value) if value is not None else None
+    finally:
+        cursor.close()
+    return stamps
+
+
+# Stamp readers by connection type; queries on a connection without one are not cached
+STAMP_READERS = {pymysql.connections.Connection: mysql_stamps}
+
+
+def read_table_stamps(pool, tables=()):
+    """
+    Reads the version stamps of the tables with the reader registered for the pool's connections.
+    :param pool: Required parameter, the ConnectionPool.
+    :param tables: Optional parameter, the tables read by the query, for the readers that version them on demand, default is ().
+    :return: A dict of table name to stamp, empty if the connections have no stamp reader.
+    """
+    with pool.connection() as connection:
+        for connection_type, reader in STAMP_READERS.items():
+            if isinstance(connection, connection_type):
+                return reader(connection, tables)
+    return {}
+
+
+class TableVersions:
+    """
+    Version stamps of the tables of the database, read at most once every `ttl` seconds. Tables stamped NEEDS_CHECKSUM
+    are checksummed when a query reads them, and their checksums are kept for `checksum_ttl` seconds. Writes made
+    through the cache bump a local generation of the tables they name, so they invalidate the cached results at once,
+    without waiting for the next read of the stamps.
+    """
+
+    def __init__(self, pool=None, ttl=DEFAULT_VERSION_TTL, fetch=read_table_stamps, checksum_ttl=DEFAULT_CHECKSUM_TTL):
+        """
+        :param pool: Optional parameter, the ConnectionPool, default is db.get_pool() at the time of the read.
+        :param ttl: Optional parameter, the number of seconds the stamps are trusted, default is 5.
+        :param fetch: Optional parameter, a callable taking the pool and the tables to checksum and returning a dict of
+        table name to stamp, default is read_table_stamps.
+        :param checksum_ttl: Optional parameter, the number of seconds the checksum stamps are trusted, default is 300.
+        """
+        if ttl < 0 or checksum_ttl < 0:
+            raise ValueError(f"Invalid version TTL: {min(ttl, checksum_ttl)}")
+        self.pool = pool
+        self.ttl = ttl
+        self.fetch = fetch
+        self.checksum_ttl = checksum_ttl
+        self._stamps = {}
+        self._checksums = {}
+        self._generations = {}
+        self._fetched = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._fetched is not None and now - self._fetched < self.ttl:
+                return self._stamps
+        stamps = self.fetch(self.pool if self.pool is not None else get_pool(), ())
+        with self._lock:
+            self._stamps = stamps
+            self._fetched = now
+        return stamps
+
+    def _checksum(self, tables):
+        # Checksums of the tables, read again once they are older than checksum_ttl
+        now = time.monotonic()
+        with self._lock:
+            checksums = {table: self._checksums[table][0] for table in tables
+                         if table in self._checksums and now - self._checksums[table][1] < self.checksum_ttl}
+        missing = [table for table in tables if table not in checksums]
+        if missing:
+            stamps = self.fetch(self.pool if self.pool is not None else get_pool(), missing)
+            with self._lock:
+                for table in missing:
+                    stamp = stamps.get(table)
+                    checksums[table] = stamp if stamp != NEEDS_CHECKSUM else None
+                    if checksums[table] is not None:
+                        self._checksums[table] = (checksums[table], now)
+        return checksums
+
+    # Method to get the names of the tables of the database
+    def tables(self):
+        return self._refresh().keys()
+
+    def get(self, tables):
+        """
+        :param tables: Required parameter, the table names.
+        :return: The combined version of the tables, or None if one of them cannot be versioned.
+        """
+        stamps = self._refresh()
+        checksums = self._checksum([table for table in tables if stamps.get(table) == NEEDS_CHECKSUM])
+        version = []
+        for table in sorted(tables):
+            stamp = checksums.get(table, stamps.get(table))
+            if stamp is None:
+                return None
+            version.append((table, stamp, self._generations.get(table, 0)))
+        return tuple(version)
+
+    def touch(self, tables=()):
+        """
+        Marks tables as changed and forces the next read of the stamps.
+        :param tables: Optional parameter, the changed tables, default is () (new or dropped tables only).
+        """
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+                self._checksums.pop(table, None)
+            self._fetched = None
+
+
+class _Entry:
+    __slots__ = ('version', 'result', 'size')
+
+    def __init__(self, version, result, size):
+        self.version = version
+        self.result = result
+        self.size = size
+
+
+class SqlResultCache:
+    """
+    In-memory cache of SQL tool results shared by the sessions of the process. Entries are keyed by the normalized query,
+    so the same question asked with different spacing, case or quoting is answered once. A cached result is served only
+    while the version stamps of the tables it reads are unchanged, and the least recently used results are evicted once
+    the cache holds more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, versions=None):
+        """
+        :param max_bytes: Optional parameter, the memory budget of the cached results, default is 32 MB.
+        :param versions: Optional parameter, the TableVersions object, default is TableVersions() on the shared pool.
+        """
+        if max_bytes <= 0:
+            raise ValueError(f"Invalid cache size: {max_bytes}")
+        self.max_bytes = max_bytes
+        self.versions = versions if versions is not None else TableVersions()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0  # Queries run without the cache: writes, volatile or unversioned queries
+        self.invalidations = 0
+        self.evictions = 0
+
+    def _version(self, query):
+        if not query.cacheable:
+            return None
+        try:
+            tables = self.versions.tables() & query.names
+            return self.versions.get(tables) if tables else None
+        except Exception:
+            # The cache is an optimization only; unreadable versions behave like an uncacheable query
+            return None
+
+    def get_or_run(self, sql_query, run):
+        """
+        Returns the cached result of a query, or runs it and caches the result.
+        :param sql_query: Required parameter, the SQL text.
+        :param run: Required parameter, a callable without arguments running the query and returning its result as a string.
+        :return: The result.
+        """
+        query = NormalizedQuery(sql_query)
+        version = self._version(query)
+        if version is None:
+            with self._lock:
+                self.uncached += 1
+            try:
+                return run()
+            finally:
+                if query.writes:
+                    self.versions.touch(query.names)
+
+        key = query.text
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.version == version:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry.result
+                self._remove(key)
+                self.invalidations += 1
+            self.misses += 1
+
+        result = run()
+        self.put(key, version, result)
+        return result
+
+    def put(self, key, version, result):
+        size = sys.getsizeof(result) + sys.getsizeof(key)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(version, result, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key).size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "bytes": self._bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "uncached": self.uncached,
+                    "invalidations": self.invalidations,
+                    "evictions": self.evictions}
+
+
+_sql_cache = None
+_sql_cache_lock = threading.Lock()
+
+
+def sql_cache_enabled():
+    """
+    :return: Whether SQL results are cached; set the MATEGEN_SQL_CACHE environment variable to 0 to disable the cache.
+    """
+    return os.getenv('MATEGEN_SQL_CACHE', '1') != '0'
+
+
+def get_sql_cache():
+    """
+    Returns the process-wide SqlResultCache, creating it on first use.
+    :return: The shared SqlResultCache object.
+    """
+    global _sql_cache
+    if _sql_cache is None:
+        with _sql_cache_lock:
+            if _sql_cache is None:
+                _sql_cache = SqlResultCache()
+    return _sql_cache
+
+
+def set_sql_cache(cache):
+    """
+    Replaces the cache used by the SQL tools.
+    :param cache: Required parameter, a SqlResultCache object, or None to create a default one on next use.
+    """
+    global _sql_cache
+    with _sql_cache_lock:
+        _sql_cache = cache
+
+
+def cached_sql_query(sql_query, run):
+    """
+    Runs a query through the shared SqlResultCache, unless the cache is disabled.
+    :param sql_query: Required parameter, the SQL text.
+    :param run: Required parameter, a callable without arguments running the query and returning its result as a string.
+    :return: The result.
+    """
+    if not sql_cache_enabled():
+        return run()
+    return get_sql_cache().get_or_run(sql_query, run)
+
+
+if __name__ == '__main__':
+    print("This file defines the cache of SQL query results, keyed by normalized SQL and invalidated by table versions.")
@@ -0,0 +1,354 @@
+import os
+import json
+import threading
+import pymysql
+from db import get_pool
+from sql_cache import NormalizedQuery, READ_STATEMENTS, strip_statement_end
+
+# Cost limits of the queries written by the model, configurable through the environment
+DEFAULT_MAX_ROWS_EXAMINED = int(os.getenv('MATEGEN_SQL_GUARD_MAX_EXAMINED', 50000000))  # Estimated rows read by the server
+DEFAULT_MAX_RESULT_ROWS = int(os.getenv('MATEGEN_SQL_GUARD_MAX_RESULT_ROWS', 10000000))  # Estimated rows loaded by extract_data
+DEFAULT_MAX_JOIN_ROWS = int(os.getenv('MATEGEN_SQL_GUARD_MAX_JOIN_ROWS', 1000000))  # Estimated rows returned by an exploratory join
+DEFAULT_LIMIT = int(os.getenv('MATEGEN_SQL_GUARD_LIMIT', 1000))  # LIMIT added to exploratory queries over budget
+
+# Functions that make a query return one row per group
+AGGREGATE_FUNCTIONS = frozenset(("COUNT", "SUM", "AVG", "MIN", "MAX", "GROUP_CONCAT", "STD", "STDDEV", "STDDEV_POP",
+                                 "STDDEV_SAMP", "VARIANCE", "VAR_POP", "VAR_SAMP", "BIT_AND", "BIT_OR", "BIT_XOR",
+                                 "JSON_ARRAYAGG", "JSON_OBJECTAGG"))
+
+# Decisions of the guard
+ALLOWED = "allowed"
+LIMITED = "limited"
+REJECTED = "rejected"
+
+
+class PlanStep:
+    """
+    One table access of a query plan, as reported by EXPLAIN.
+    """
+
+    __slots__ = ('select_id', 'table', 'access_type', 'key', 'rows', 'filtered', 'extra')
+
+    def __init__(self, select_id, table, access_type, key, rows, filtered=100.0, extra=""):
+        self.select_id = select_id
+        self.table = table
+        self.access_type = access_type
+        self.key = key
+        self.rows = rows
+        self.filtered = filtered
+        self.extra = extra
+
+    # A read of every row of the table, or of every entry of one of its indexes
+    @property
+    def full_scan(self):
+        return self.access_type in ("ALL", "index")
+
+    def to_dict(self):
+        return {"table": self.table, "access": self.access_type, "key": self.key, "rows": self.rows,
+                "filtered": self.filtered, "extra": self.extra}
+
+
+def mysql_plan(connection, sql_query):
+    """
+    Reads the plan of a query with MySQL's EXPLAIN.
+    :param connection: Required parameter, a pymysql connection.
+    :param sql_query: Required parameter, the SQL query.
+    :return: The list of PlanStep objects, in join order.
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute("EXPLAIN " + sql_query)
+        names = [column[0].lower() for column in cursor.description]
+        rows = [dict(zip(names, row)) for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+    return [PlanStep(row.get("id"), row.get("table"), row.get("type"), row.get("key"), int(row.get("rows") or 0),
+                     float(row["filtered"]) if row.get("filtered") is not None else 100.0, row.get("extra") or "")
+            for row in rows]
+
+
+# Plan readers by connection type; a connection without one is not guarded
+PLAN_READERS = {pymysql.connections.Connection: mysql_plan}
+
+
+def read_plan(connection, sql_query):
+    """
+    :param connection: Required parameter, a DB-API connection.
+    :param sql_query: Required parameter, the SQL query.
+    :return: The list of PlanStep objects, or None if the plan of this kind of connection cannot be read.
+    """
+    for connection_type, reader in PLAN_READERS.items():
+        if isinstance(connection, connection_type):
+            return reader(connection, sql_query)
+    return None
+
+
+class QueryShape:
+    """
+    The clauses at the top level of a SELECT statement that decide how many rows it returns, and whether the server can
+    stop reading as soon as enough rows are produced.
+    """
+
+    def __init__(self, query):
+        """
+        :param query: Required parameter, a NormalizedQuery object.
+        """
+        depth = 0
+        top_level = []
+        for index, token in enumerate(query.tokens):
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            elif depth == 0:
+                following = query.tokens[index + 1] if index + 1 < len(query.tokens) else None
+                top_level.append(token.upper() + ("(" if following == '(' else ""))
+        self.has_limit = "LIMIT" in top_level
+        self.has_where = "WHERE" in top_level
+        self.grouped = "GROUP" in top_level
+        self.aggregated = any(token[:-1] in AGGREGATE_FUNCTIONS for token in top_level if token.endswith("("))
+        self.ordered = "ORDER" in top_level
+        self.distinct = "DISTINCT" in top_level
+        self.union = "UNION" in top_level
+
+    # Whether the server can stop after the first rows; sorts, groups and set operations read all their input first
+    @property
+    def streamable(self):
+        return not (self.grouped or self.aggregated or self.ordered or self.distinct or self.union)
+
+
+def unkeyed_joins(steps):
+    """
+    :param steps: Required parameter, the list of PlanStep objects.
+    :return: The steps joining a table without an index condition, each row of which is matched with every row produced
+    before it unless the WHERE clause filters them afterwards (a Cartesian product).
+    """
+    joined = set()
+    unkeyed = []
+    for step in steps:
+        if step.full_scan and step.select_id in joined and (not step.key or "join buffer" in step.extra.lower()):
+            unkeyed.append(step)
+        joined.add(step.select_id)
+    return unkeyed
+
+
+def estimate_plan(steps, shape):
+    """
+    Estimates the cost of a plan. For each SELECT, a table joined with a nested loop is read once per row produced by the
+    tables joined before it; a table joined through a join buffer (block nested loop or hash join) is read once, and the
+    rows the join produces are counted instead.
+    :param steps: Required parameter, the list of PlanStep objects.
+    :param shape: Required parameter, the QueryShape of the statement.
+    :return: The estimated rows examined and rows returned.
+    """
+    rows_examined = 0
+    produced = {}
+    for step in steps:
+        prefix = produced.get(step.select_id, 1)
+        rows = prefix * max(step.rows * step.filtered / 100, 1 if step.rows else 0)
+        if "join buffer" in step.extra.lower():
+            rows_examined += step.rows + rows
+        else:
+            rows_examined += prefix * step.rows
+        produced[step.select_id] = rows
+    result_rows = produced.get(steps[0].select_id, 0) if steps else 0
+    if shape.aggregated and not shape.grouped:
+        result_rows = min(result_rows, 1)
+    return int(rows_examined), int(result_rows)
+
+
+def add_limit(sql_query, limit):
+    """
+    :param sql_query: Required parameter, a SELECT statement without a LIMIT clause.
+    :param limit: Required parameter, the maximum number of rows.
+    :return: The statement with a LIMIT clause. Trailing comments and semicolons are removed first, so that the LIMIT
+    is neither commented out nor left as a second statement.
+    """
+    return strip_statement_end(sql_query) + f"\nLIMIT {limit}"
+
+
+class GuardDecision:
+    """
+    The outcome of the guard for one query: the statement to run (with an added LIMIT when it was limited) and an
+    explanation of the estimated cost the model can act on.
+    """
+
+    def __init__(self, sql_query, status=ALLOWED, reason="", limit=None, steps=None, rows_examined=None,
+                 result_rows=None, suggestions=()):
+        self.sql_query = sql_query
+        self.status = status
+        self.reason = reason
+        self.limit = limit
+        self.steps = steps or []
+        self.rows_examined = rows_examined
+        self.result_rows = result_rows
+        self.suggestions = list(suggestions)
+
+    @property
+    def allowed(self):
+        return self.status != REJECTED
+
+    def to_dict(self):
+        return {"status": self.status,
+                "reason": self.reason,
+                "estimated_rows_examined": self.rows_examined,
+                "estimated_result_rows": self.result_rows,
+                "limit": self.limit,
+                "full_scans": [step.table for step in self.steps if step.full_scan],
+                "plan": [step.to_dict() for step in self.steps],
+                "suggestions": self.suggestions}
+
+    # The explanation returned to the model in place of a result
+    def to_json(self):
+        return json.dumps(self.to_dict(), default=str, ensure_ascii=False)
+
+
+class QueryGuard:
+    """
+    Cost check run before the SQL tools execute a query written by the model. The plan is read with EXPLAIN to estimate
+    the rows the server will examine and return; queries over budget are rejected, or limited when a LIMIT lets the
+    server stop early. Exploratory joins that multiply the rows of their tables (more than max_join_rows rows, or a
+    table joined without a key) are also limited, while a scan of a single table keeps its exact row count.
+    """
+
+    def __init__(self, pool=None, max_rows_examined=DEFAULT_MAX_ROWS_EXAMINED, max_result_rows=DEFAULT_MAX_RESULT_ROWS,
+                 limit=DEFAULT_LIMIT, max_join_rows=DEFAULT_MAX_JOIN_ROWS):
+        """
+        :param pool: Optional parameter, the ConnectionPool used to run EXPLAIN, default is db.get_pool() at the time of the check.
+        :param max_rows_examined: Optional parameter, the largest estimated number of rows a query may read, default is 50000000.
+        :param max_result_rows: Optional parameter, the largest estimated number of rows extract_data may load, default is 10000000.
+        :param limit: Optional parameter, the LIMIT added to exploratory queries over budget, default is 1000.
+        :param max_join_rows: Optional parameter, the largest estimated number of rows an exploratory join may return
+        without a LIMIT, default is 1000000.
+        """
+        if max_rows_examined <= 0 or max_result_rows <= 0 or limit <= 0 or max_join_rows <= 0:
+            raise ValueError("Invalid query guard limits")
+        self.pool = pool
+        self.max_rows_examined = max_rows_examined
+        self.max_result_rows = max_result_rows
+        self.limit = limit
+        self.max_join_rows = max_join_rows
+
+    def check(self, sql_query, exploratory=True):
+        """
+        Decides whether and how a query runs.
+        :param sql_query: Required parameter, the SQL query.
+        :param exploratory: Optional parameter, whether the query explores the data (sql_inter) rather than loading it
+        (extract_data); only exploratory queries get a LIMIT, default is True.
+        :return: The GuardDecision object.
+        """
+        # A trailing semicolon or comment does not make a second statement
+        statement = strip_statement_end(sql_query)
+        query = NormalizedQuery(statement)
+        if query.statement not in READ_STATEMENTS or ';' in query.tokens:
+            return GuardDecision(sql_query, reason="Only single SELECT statements are checked")
+        try:
+            pool = self.pool if self.pool is not None else get_pool()
+            with pool.connection() as connection:
+                steps = read_plan(connection, statement)
+        except Exception:
+            # A query EXPLAIN cannot read fails the same way when it runs, with the server's own message
+            return GuardDecision(sql_query, reason="The plan of the query could not be read")
+        if steps is None:
+            return GuardDecision(sql_query, reason="The plan of the query cannot be read on this database")
+
+        shape = QueryShape(query)
+        rows_examined, result_rows = estimate_plan(steps, shape)
+        decision = GuardDecision(sql_query, steps=steps, rows_examined=rows_examined, result_rows=result_rows,
+                                 suggestions=self._suggestions(steps, shape, exploratory))
+        can_limit = exploratory and not shape.has_limit
+
+        if rows_examined > self.max_rows_examined:
+            if can_limit and shape.streamable:
+                decision.status = LIMITED
+                decision.reason = (f"The query would examine about {rows_examined} rows (limit {self.max_rows_examined}); "
+                                   f"it runs with LIMIT {self.limit} so that the server stops early")
+            else:
+                decision.status = REJECTED
+                decision.reason = (f"The query would examine about {rows_examined} rows, "
+                                   f"above the limit of {self.max_rows_examined}; it was not run")
+        elif not exploratory and result_rows > self.max_result_rows:
+            decision.status = REJECTED
+            decision.reason = (f"The query would load about {result_rows} rows, "
+                               f"above the limit of {self.max_result_rows}; it was not run")
+        elif can_limit and result_rows > max(step.rows for step in steps) and (
+                result_rows > self.max_join_rows or unkeyed_joins(steps)):
+            # Only a join returns more rows than its largest table; a large or keyless one would run until the timeout
+            if shape.streamable:
+                decision.status = LIMITED
+                decision.reason = (f"The join would return about {result_rows} rows; "
+                                   f"it runs with LIMIT {self.limit} so that the server stops early")
+            else:
+                decision.status = REJECTED
+                decision.reason = (f"The join would return about {result_rows} rows, which are sorted or grouped "
+                                   f"before the first one is returned; it was not run")
+
+        if decision.status == LIMITED:
+            decision.limit = self.limit
+            decision.sql_query = add_limit(sql_query, self.limit)
+        return decision
+
+    @staticmethod
+    def _suggestions(steps, shape, exploratory):
+        suggestions = []
+        for step in unkeyed_joins(steps):
+            suggestions.append(f"Table {step.table} is joined without an index condition; "
+                               f"join it on a key column such as customerID")
+        if any(step.full_scan for step in steps) and not shape.has_where and shape.streamable:
+            suggestions.append("Filter the rows with WHERE, or aggregate in SQL (COUNT, GROUP BY) "
+                               "instead of reading every row")
+        if not exploratory:
+            suggestions.append("Select only the columns and rows the analysis needs before loading them")
+        elif not shape.has_limit:
+            suggestions.append("Add a LIMIT to look at a sample of the rows")
+        return suggestions
+
+
+_query_guard = None
+_query_guard_lock = threading.Lock()
+
+
+def guard_enabled():
+    """
+    :return: Whether queries are checked before they run; set the MATEGEN_SQL_GUARD environment variable to 0 to disable the guard.
+    """
+    return os.getenv('MATEGEN_SQL_GUARD', '1') != '0'
+
+
+def get_query_guard():
+    """
+    Returns the process-wide QueryGuard, creating it on first use.
+    :return: The shared QueryGuard object.
+    """
+    global _query_guard
+    if _query_guard is None:
+        with _query_guard_lock:
+            if _query_guard is None:
+                _query_guard = QueryGuard()
+    return _query_guard
+
+
+def set_query_guard(guard):
+    """
+    Replaces the guard used by the SQL tools.
+    :param guard: Required parameter, a QueryGuard object, or None to create a default one on next use.
+    """
+    global _query_guard
+    with _query_guard_lock:
+        _query_guard = guard
+
+
+def guard_query(sql_query, exploratory=True):
+    """
+    Checks a query with the shared QueryGuard, unless the guard is disabled.
+    :param sql_query: Required parameter, the SQL query.
+    :param exploratory: Optional parameter, see QueryGuard.check, default is True.
+    :return: The GuardDecision object.
+    """
+    if not guard_enabled():
+        return GuardDecision(sql_query, reason="The query guard is disabled")
+    return get_query_guard().check(sql_query, exploratory)
+
+
+if __name__ == '__main__':
+    print("This file defines the cost guard run with EXPLAIN before the SQL tools execute a query.")
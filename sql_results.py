@@ -0,0 +1,190 @@
+import os
+import json
+from collections import deque
+from decimal import Decimal
+
+# Budgets of the result returned to the model by sql_inter, configurable through the environment
+DEFAULT_MAX_ROWS = int(os.getenv('MATEGEN_SQL_MAX_ROWS', 50))  # Results up to this size are returned in full
+DEFAULT_MAX_BYTES = int(os.getenv('MATEGEN_SQL_MAX_BYTES', 8000))  # Maximum size of the JSON payload
+DEFAULT_MAX_SCAN_ROWS = int(os.getenv('MATEGEN_SQL_MAX_SCAN_ROWS', 1000000))  # Rows read before the count stops being exact
+DEFAULT_SAMPLE_ROWS = int(os.getenv('MATEGEN_SQL_SAMPLE_ROWS', 5))  # Rows shown at each end of a large result
+MAX_DISTINCT_VALUES = 20  # Distinct values tracked per column before the column counts as high-cardinality
+
+
+def to_json(value):
+    """
+    Serializes a query result to JSON; Decimal, date and other MySQL types are written as strings.
+    """
+    return json.dumps(value, default=str, ensure_ascii=False)
+
+
+class ColumnStats:
+    """
+    Statistics of one result column, updated row by row: nulls, numeric range and mean, and the distinct values
+    while they are few.
+    """
+
+    __slots__ = ('count', 'nulls', 'numeric', 'minimum', 'maximum', 'total', 'distinct')
+
+    def __init__(self):
+        self.count = 0
+        self.nulls = 0
+        self.numeric = True
+        self.minimum = None
+        self.maximum = None
+        self.total = 0.0
+        self.distinct = set()
+
+    def add(self, value):
+        self.count += 1
+        if value is None:
+            self.nulls += 1
+            return
+        if self.distinct is not None:
+            self.distinct.add(value)
+            if len(self.distinct) > MAX_DISTINCT_VALUES:
+                self.distinct = None
+        if self.numeric and isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+            self.total += float(value)
+        else:
+            self.numeric = False
+        try:
+            if self.minimum is None or value < self.minimum:
+                self.minimum = value
+            if self.maximum is None or value > self.maximum:
+                self.maximum = value
+        except TypeError:
+            pass
+
+    def to_dict(self):
+        stats = {"nulls": self.nulls}
+        if self.minimum is not None:
+            stats["min"] = self.minimum
+            stats["max"] = self.maximum
+        non_null = self.count - self.nulls
+        if self.numeric and non_null:
+            stats["mean"] = round(self.total / non_null, 4)
+        if self.distinct is not None:
+            stats["distinct"] = len(self.distinct)
+            if not self.numeric:
+                stats["values"] = sorted(map(str, self.distinct))
+        else:
+            stats["distinct"] = f">{MAX_DISTINCT_VALUES}"
+        return stats
+
+
+class ResultSummary:
+    """
+    Bounded summary of a streamed result set. Rows are added batch by batch; it keeps the full rows while the result is
+    small, and only the first and last `sample_rows` rows, the exact row count and per-column statistics once it is not,
+    so its memory does not grow with the size of the result.
+    """
+
+    def __init__(self, columns, max_rows=DEFAULT_MAX_ROWS, max_bytes=DEFAULT_MAX_BYTES,
+                 max_scan_rows=DEFAULT_MAX_SCAN_ROWS, sample_rows=DEFAULT_SAMPLE_ROWS):
+        """
+        :param columns: Required parameter, the column names of the result.
+        :param max_rows: Optional parameter, the largest result returned in full, default is 50 rows.
+        :param max_bytes: Optional parameter, the maximum size of the JSON payload, default is 8000 bytes.
+        :param max_scan_rows: Optional parameter, the number of rows read before the reading stops, default is 1000000.
+        :param sample_rows: Optional parameter, the number of rows kept at each end of a large result, default is 5.
+        """
+        if max_rows < 0 or max_bytes <= 0 or max_scan_rows <= 0 or sample_rows < 0:
+            raise ValueError("Invalid result budgets")
+        self.columns = list(columns)
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_scan_rows = max_scan_rows
+        self.sample_rows = sample_rows
+        self.row_count = 0
+        self.complete = True  # False if the reading stopped at max_scan_rows
+        self.rows = []  # Every row while the result is small
+        self.head = None
+        self.tail = None
+        self.stats = [ColumnStats() for _ in self.columns]
+
+    @property
+    def full(self):
+        return self.row_count >= self.max_scan_rows
+
+    def add_rows(self, rows):
+        """
+        Adds a batch of rows.
+        :param rows: Required parameter, a sequence of rows.
+        :return: False once max_scan_rows rows have been read and the caller should stop reading.
+        """
+        rows = rows[:self.max_scan_rows - self.row_count]
+        for row in rows:
+            for stats, value in zip(self.stats, row):
+                stats.add(value)
+        self.row_count += len(rows)
+        if self.head is None:
+            self.rows.extend(rows)
+            if len(self.rows) > self.max_rows:
+                # Too many rows to return in full: keep both ends only
+                self.head = self.rows[:self.sample_rows]
+                self.tail = deque(self.rows, maxlen=self.sample_rows)
+                self.rows = []
+        else:
+            self.tail.extend(rows)
+        return not self.full
+
+    # Method to mark the result as cut at max_scan_rows
+    def truncate(self):
+        self.complete = False
+
+    def _summary(self, sample_rows):
+        if self.head is None:
+            head = self.rows[:sample_rows]
+            tail = self.rows[max(sample_rows, len(self.rows) - sample_rows):]
+        else:
+            head = self.head[:sample_rows]
+            tail = list(self.tail)[len(self.tail) - sample_rows:] if sample_rows else []
+        return {"columns": self.columns,
+                "row_count": self.row_count,
+                "row_count_exact": self.complete,
+                "head": [list(row) for row in head],
+                "tail": [list(row) for row in tail],
+                "column_stats": {column: stats.to_dict() for column, stats in zip(self.columns, self.stats)},
+                "note": f"The result has {'at least ' if not self.complete else ''}{self.row_count} rows; only the first "
+                        f"and last rows are shown. Aggregate in SQL, or use extract_data to load the whole table."}
+
+    def to_json(self):
+        """
+        :return: The rows as a JSON list when the result is small, otherwise a JSON summary that fits in max_bytes
+        whenever the column statistics do.
+        """
+        if self.head is None and self.complete:
+            payload = to_json(self.rows)
+            if len(payload.encode('utf-8')) <= self.max_bytes:
+                return payload
+        # Fewer sample rows until the summary fits the byte budget
+        for sample_rows in range(self.sample_rows, -1, -1):
+            payload = to_json(self._summary(sample_rows))
+            if len(payload.encode('utf-8')) <= self.max_bytes:
+                return payload
+        return payload
+
+
+def summarize_query(batches, **budgets):
+    """
+    Reads the output of db.stream_query into a ResultSummary, stopping at the scan budget.
+    :param batches: Required parameter, the generator returned by db.stream_query.
+    :param budgets: Optional parameters passed to ResultSummary (max_rows, max_bytes, max_scan_rows, sample_rows).
+    :return: The ResultSummary object.
+    """
+    try:
+        summary = ResultSummary(next(batches), **budgets)
+        for rows in batches:
+            if not summary.add_rows(rows):
+                # Stop when the budget is reached, unless the last batch happened to end the result
+                if next(batches, None) is not None:
+                    summary.truncate()
+                break
+    finally:
+        batches.close()
+    return summary
+
+
+if __name__ == '__main__':
+    print("This file defines the bounded summaries of the SQL query results returned to the model.")
@@ -0,0 +1,217 @@
+import os
+import re
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+import pymysql
+
+# Longest run of a query of the SQL tools in seconds, configurable through the environment; 0 disables the timeout
+DEFAULT_QUERY_TIMEOUT = float(os.getenv('MATEGEN_SQL_TIMEOUT', 60))
+# Extra seconds the client waits for the server to answer after a query was cancelled before dropping the connection
+READ_TIMEOUT_GRACE = float(os.getenv('MATEGEN_SQL_READ_TIMEOUT_GRACE', 5))
+
+# MySQL error codes of a cancelled statement: KILL QUERY, and the MAX_EXECUTION_TIME limit
+MYSQL_INTERRUPTED = (1317, 3024)
+
+_SELECT = re.compile(r'\s*SELECT\b', re.IGNORECASE)
+
+_session_timeout = contextvars.ContextVar('mategen_query_timeout', default=None)
+
+
+@contextmanager
+def query_timeout(seconds):
+    """
+    Sets the query timeout of the SQL tools for the block, in the current thread or task, e.g. for one MateGen session.
+    :param seconds: Required parameter, the timeout in seconds, 0 for no timeout, or None to keep the current one.
+    """
+    if seconds is None:
+        yield
+        return
+    if seconds < 0:
+        raise ValueError(f"Invalid query timeout: {seconds}")
+    token = _session_timeout.set(seconds)
+    try:
+        yield
+    finally:
+        _session_timeout.reset(token)
+
+
+def get_query_timeout(timeout=None):
+    """
+    :param timeout: Optional parameter, the timeout of one call, default is None, the timeout of the session set with
+    query_timeout(), or MATEGEN_SQL_TIMEOUT (60 seconds).
+    :return: The timeout in seconds, or None when queries are not limited.
+    """
+    for seconds in (timeout, _session_timeout.get(), DEFAULT_QUERY_TIMEOUT):
+        if seconds is not None:
+            if seconds < 0:
+                raise ValueError(f"Invalid query timeout: {seconds}")
+            return seconds or None
+
+
+def with_query_timeout(func):
+    """
+    Binds a function to the query timeout of the caller's session, for functions run on another thread such as the tool
+    thread pool, where the caller's context is not visible.
+    :param func: Required parameter, the function.
+    :return: A function running `func` under the caller's query timeout.
+    """
+    seconds = _session_timeout.get()
+
+    def run(*args, **kwargs):
+        with query_timeout(seconds):
+            return func(*args, **kwargs)
+
+    return run
+
+
+def add_execution_time_hint(sql_query, seconds):
+    """
+    Adds a MAX_EXECUTION_TIME optimizer hint to a SELECT statement, so that MySQL stops it by itself once the timeout
+    has passed. Other statements (including WITH ... SELECT, where MySQL ignores the hint) are returned unchanged.
+    :param sql_query: Required parameter, the SQL query.
+    :param seconds: Required parameter, the timeout in seconds.
+    :return: The SQL query.
+    """
+    match = _SELECT.match(sql_query)
+    if match is None or 'MAX_EXECUTION_TIME' in sql_query.upper():
+        return sql_query
+    return f"{sql_query[:match.end()]} /*+ MAX_EXECUTION_TIME({max(int(seconds * 1000), 1)}) */{sql_query[match.end():]}"
+
+
+class QueryTimeout(TimeoutError):
+    """
+    Raised when a query of the SQL tools runs longer than its timeout and was cancelled.
+    """
+
+    def __init__(self, sql_query, timeout, elapsed):
+        super().__init__(f"The query was cancelled after {elapsed:.1f} seconds (timeout {timeout:g} seconds)")
+        self.sql_query = sql_query
+        self.timeout = timeout
+        self.elapsed = elapsed
+
+    def to_dict(self):
+        return {"status": "timeout",
+                "timeout_seconds": self.timeout,
+                "elapsed_seconds": round(self.elapsed, 3),
+                "sql_query": self.sql_query,
+                "message": "The query took longer than the time limit and was cancelled on the server. Rewrite it to "
+                           "read less data: filter with WHERE on indexed columns, aggregate in SQL instead of returning "
+                           "rows, add a LIMIT, or join on key columns only."}
+
+    # Method to get the timeout as the JSON result returned to the model
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+
+def mysql_cancel(connection, connect):
+    """
+    Cancels the statement running on a MySQL connection with KILL QUERY, sent over a side connection since the
+    connection itself is busy. The connection stays open.
+    :param connection: Required parameter, the pymysql connection running the statement.
+    :param connect: Required parameter, a callable without arguments opening a side connection.
+    """
+    side = connect()
+    try:
+        cursor = side.cursor()
+        cursor.execute("KILL QUERY %s", (connection.thread_id(),))
+        cursor.close()
+    finally:
+        side.close()
+
+
+def mysql_interrupted(exception):
+    return isinstance(exception, pymysql.err.OperationalError) and exception.args[0] in MYSQL_INTERRUPTED
+
+
+# Cancellation functions and tests of the exceptions of a cancelled statement, by connection type
+CANCELLERS = {pymysql.connections.Connection: mysql_cancel}
+INTERRUPTED = {pymysql.connections.Connection: mysql_interrupted}
+
+
+def _find(registry, connection):
+    return next((value for connection_type, value in registry.items() if isinstance(connection, connection_type)), None)
+
+
+class QueryDeadline:
+    """
+    Watches one query: when its timeout has passed, the statement is cancelled on the server from a timer thread, and
+    the exception its cursor then raises is turned into a QueryTimeout. On MySQL, SELECT statements also carry a
+    MAX_EXECUTION_TIME hint, and the client read timeout is raised to the query timeout plus a grace period, so the
+    tool never waits on a server that does not answer.
+    """
+
+    def __init__(self, connection, connect, sql_query, timeout):
+        """
+        :param connection: Required parameter, the connection running the query.
+        :param connect: Required parameter, a callable without arguments opening a side connection, for KILL QUERY.
+        :param sql_query: Required parameter, the SQL query.
+        :param timeout: Required parameter, the timeout in seconds.
+        """
+        self.connection = connection
+        self.connect = connect
+        self.sql_query = sql_query
+        self.timeout = timeout
+        self.started = None
+        self.cancelled = False
+        self._timer = None
+        self._saved_read_timeout = None
+        self._finished = False
+        self._lock = threading.Lock()  # Held while cancelling, so the connection is never killed once stop() returns
+
+    # Method to get the SQL text to run, with the timeout hint when the database supports it
+    def prepare(self):
+        if isinstance(self.connection, pymysql.connections.Connection):
+            return add_execution_time_hint(self.sql_query, self.timeout)
+        return self.sql_query
+
+    def start(self):
+        if isinstance(self.connection, pymysql.connections.Connection):
+            # pymysql applies the read timeout before each read of the socket
+            self._saved_read_timeout = (self.connection._read_timeout,)
+            self.connection._read_timeout = self.timeout + READ_TIMEOUT_GRACE
+        self.started = time.monotonic()
+        self._timer = threading.Timer(self.timeout, self.cancel)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def cancel(self):
+        canceller = _find(CANCELLERS, self.connection)
+        if canceller is None:
+            return
+        with self._lock:
+            if self._finished:
+                return
+            self.cancelled = True
+            try:
+                canceller(self.connection, self.connect)
+            except Exception as e:
+                # The read timeout still ends the wait
+                print(f"Could not cancel the query on the server: {e}")
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        with self._lock:
+            self._finished = True
+        if self._saved_read_timeout is not None:
+            self.connection._read_timeout = self._saved_read_timeout[0]
+
+    def timed_out(self, exception):
+        """
+        :param exception: Required parameter, the exception raised while the query ran.
+        :return: A QueryTimeout if the exception comes from the cancellation of the query or from the read timeout,
+        otherwise None.
+        """
+        elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+        interrupted = _find(INTERRUPTED, self.connection)
+        if self.cancelled or (interrupted is not None and interrupted(exception)) or (
+                isinstance(exception, pymysql.err.OperationalError) and elapsed >= self.timeout):
+            return QueryTimeout(self.sql_query, self.timeout, elapsed)
+        return None
+
+
+if __name__ == '__main__':
+    print("This file defines the timeouts and the server-side cancellation of the queries of the SQL tools.")
@@ -0,0 +1,279 @@
+import time
+import threading
+from collections import deque
+from IPython.display import display, Markdown
+from tokenizer import count_tokens
+
+# Number of recent streamed calls kept for stream_metrics()
+MAX_STREAM_STATS = 1000
+_stream_stats = deque(maxlen=MAX_STREAM_STATS)
+_stream_stats_lock = threading.Lock()
+
+
+class StreamStats:
+    """
+    Timing of one streamed Chat call: time to first token, total time and generation speed.
+    """
+
+    def __init__(self, model, start=None):
+        self.model = model
+        self.start = time.perf_counter() if start is None else start
+        self.first_token_time = None
+        self.end_time = None
+        self.num_chunks = 0
+        self.completion_tokens = 0
+
+    # Method to record the arrival of a chunk that carries content or function call fragments
+    def on_delta(self):
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        self.num_chunks += 1
+
+    def finish(self, completion_tokens):
+        self.end_time = time.perf_counter()
+        self.completion_tokens = completion_tokens
+
+    # Seconds from sending the request to receiving the first token
+    @property
+    def time_to_first_token(self):
+        return None if self.first_token_time is None else self.first_token_time - self.start
+
+    @property
+    def total_time(self):
+        return None if self.end_time is None else self.end_time - self.start
+
+    # Generation speed, measured from the first token so that it does not include queueing and prompt processing
+    @property
+    def tokens_per_second(self):
+        if self.first_token_time is None or self.end_time is None:
+            return None
+        generation_time = self.end_time - self.first_token_time
+        return self.completion_tokens / generation_time if generation_time > 0 else None
+
+    def to_dict(self):
+        return {"model": self.model,
+                "time_to_first_token": self.time_to_first_token,
+                "total_time": self.total_time,
+                "completion_tokens": self.completion_tokens,
+                "tokens_per_second": self.tokens_per_second}
+
+    def __repr__(self):
+        return f"StreamStats({self.to_dict()})"
+
+
+def record_stream_stats(stats):
+    with _stream_stats_lock:
+        _stream_stats.append(stats)
+
+
+def get_stream_stats():
+    """
+    :return: The StreamStats objects of the recent streamed calls, oldest first.
+    """
+    with _stream_stats_lock:
+        return list(_stream_stats)
+
+
+def stream_metrics():
+    """
+    Summarizes the recent streamed calls.
+    :return: A dict with the number of calls and the mean and maximum time to first token and the mean tokens per second.
+    """
+    stats = get_stream_stats()
+    ttfts = [s.time_to_first_token for s in stats if s.time_to_first_token is not None]
+    speeds = [s.tokens_per_second for s in stats if s.tokens_per_second is not None]
+    return {"calls": len(stats),
+            "mean_time_to_first_token": sum(ttfts) / len(ttfts) if ttfts else None,
+            "max_time_to_first_token": max(ttfts) if ttfts else None,
+            "mean_tokens_per_second": sum(speeds) / len(speeds) if speeds else None}
+
+
+class StreamAssembler:
+    """
+    Rebuilds the assistant message from the chunks of a streamed Chat response. Content deltas are concatenated and the
+    name and arguments fragments of a function call, or of each parallel tool call (told apart by their index),
+    are accumulated as they arrive.
+    """
+
+    def __init__(self):
+        self.role = "assistant"
+        self.content_parts = []
+        self.function_name_parts = []
+        self.function_arguments_parts = []
+        # Parallel tool calls by index: [id, name parts, arguments parts]
+        self.tool_call_parts = {}
+        self.finish_reason = None
+
+    @property
+    def is_function_call(self):
+        return bool(self.function_name_parts or self.function_arguments_parts)
+
+    @property
+    def content(self):
+        return "".join(self.content_parts)
+
+    @property
+    def function_name(self):
+        return "".join(self.function_name_parts)
+
+    @property
+    def function_arguments(self):
+        return "".join(self.function_arguments_parts)
+
+    def feed(self, chunk):
+        """
+        Adds one chunk of the stream.
+        :param chunk: Required parameter, a chunk of a streamed ChatCompletion response.
+        :return: The content delta of the chunk (an empty string if there is none), and whether the chunk carried any fragment.
+        """
+        choice = chunk["choices"][0]
+        delta = choice.get("delta") or {}
+        if choice.get("finish_reason"):
+            self.finish_reason = choice["finish_reason"]
+        if delta.get("role"):
+            self.role = delta["role"]
+
+        has_fragment = False
+        content = delta.get("content") or ""
+        if content:
+            self.content_parts.append(content)
+            has_fragment = True
+
+        function_call = delta.get("function_call")
+        if function_call:
+            if function_call.get("name"):
+                self.function_name_parts.append(function_call["name"])
+            if function_call.get("arguments"):
+                self.function_arguments_parts.append(function_call["arguments"])
+            has_fragment = True
+
+        for tool_call in delta.get("tool_calls") or ():
+            parts = self.tool_call_parts.setdefault(tool_call.get("index", 0), [None, [], []])
+            if tool_call.get("id"):
+                parts[0] = tool_call["id"]
+            function = tool_call.get("function") or {}
+            if function.get("name"):
+                parts[1].append(function["name"])
+            if function.get("arguments"):
+                parts[2].append(function["arguments"])
+            has_fragment = True
+
+        return content, has_fragment
+
+    def message(self):
+        """
+        :return: The assembled message, in the same shape as the message of a non-streamed response.
+        """
+        message = {"role": self.role, "content": self.content if self.content_parts else None}
+        if self.is_function_call:
+            message["function_call"] = {"name": self.function_name, "arguments": self.function_arguments}
+        if self.tool_call_parts:
+            message["tool_calls"] = [{"id": tool_call_id,
+                                      "type": "function",
+                                      "function": {"name": "".join(name_parts), "arguments": "".join(arguments_parts)}}
+                                     for _, (tool_call_id, name_parts, arguments_parts)
+                                     in sorted(self.tool_call_parts.items())]
+        return message
+
+    # Method to count the generated tokens, used for tokens per second and the rate limiter's usage correction
+    def completion_tokens(self, model):
+        text = self.content + self.function_name + self.function_arguments + \
+            "".join("".join(parts[1]) + "".join(parts[2]) for parts in self.tool_call_parts.values())
+        return count_tokens(text, model) if text else 0
+
+
+class MarkdownStreamRenderer:
+    """
+    Renders a growing Markdown answer in place through an updatable display handle. Updates are throttled,
+    since re-rendering the whole Markdown on every chunk would cost more than the chunks themselves.
+    """
+
+    def __init__(self, title="Model's Answer:\n", min_interval=0.1):
+        """
+        :param title: Optional parameter, printed once before the first content is rendered.
+        :param min_interval: Optional parameter, the minimum number of seconds between two updates, default is 0.1.
+        """
+        self.title = title
+        self.min_interval = min_interval
+        self.handle = None
+        self.last_update = 0.0
+        self.text = ""
+
+    def update(self, delta):
+        self.text += delta
+        now = time.perf_counter()
+        if self.handle is None:
+            print(self.title)
+            self.handle = display(Markdown(self.text), display_id=True)
+            self.last_update = now
+        elif now - self.last_update >= self.min_interval:
+            self.handle.update(Markdown(self.text))
+            self.last_update = now
+
+    # Method to render the final text once the stream has ended
+    def close(self):
+        if self.handle is not None:
+            self.handle.update(Markdown(self.text))
+
+    @property
+    def started(self):
+        return self.handle is not None
+
+
+def render_message(message, renderer=None):
+    """
+    Renders the text of a complete message the way a streamed one is rendered, e.g. for an answer served from the response cache.
+    :param message: Required parameter, the assistant message.
+    :param renderer: Optional parameter, the MarkdownStreamRenderer to use, default is a new one.
+    """
+    if message.get("content"):
+        renderer = renderer or MarkdownStreamRenderer()
+        renderer.update(message["content"])
+        renderer.close()
+
+
+def consume_stream(chunks, model, renderer=None, start=None):
+    """
+    Reads a streamed Chat response, rendering content deltas as they arrive and timing the call.
+    :param chunks: Required parameter, the iterator returned by ChatCompletion.create(..., stream=True).
+    :param model: Required parameter, the name of the model.
+    :param renderer: Optional parameter, a MarkdownStreamRenderer for the content deltas, default is None (no rendering).
+    :param start: Optional parameter, the time.perf_counter() value at which the request was sent, default is now.
+    :return: The assembled message and its StreamStats.
+    """
+    assembler = StreamAssembler()
+    stats = StreamStats(model, start)
+    for chunk in chunks:
+        content, has_fragment = assembler.feed(chunk)
+        if has_fragment:
+            stats.on_delta()
+        if content and renderer is not None:
+            renderer.update(content)
+    if renderer is not None:
+        renderer.close()
+    stats.finish(assembler.completion_tokens(model))
+    record_stream_stats(stats)
+    return assembler.message(), stats
+
+
+async def aconsume_stream(chunks, model, renderer=None, start=None):
+    """
+    Async version of consume_stream for the async iterator returned by ChatCompletion.acreate(..., stream=True).
+    """
+    assembler = StreamAssembler()
+    stats = StreamStats(model, start)
+    async for chunk in chunks:
+        content, has_fragment = assembler.feed(chunk)
+        if has_fragment:
+            stats.on_delta()
+        if content and renderer is not None:
+            renderer.update(content)
+    if renderer is not None:
+        renderer.close()
+    stats.finish(assembler.completion_tokens(model))
+    record_stream_stats(stats)
+    return assembler.message(), stats
+
+
+if __name__ == '__main__':
+    print("This file contains the helpers used to stream responses from the Chat model.")
@@ -1,4 +1,3 @@
-import tiktoken
 import openai
 from tool import *
 from gptLearning import *
@@ -6,7 +5,8 @@ from chatmessage import ChatMessages
 from availablefunctions import AvailableFunctions
 from planning import *
 from response import *
-encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+from tokenizer import get_encoding
+encoding = get_encoding("gpt-3.5-turbo")
 with open('telco_data_dictionary.md', 'r', encoding='utf-8') as f:
     data_dictionary = f.read()
 
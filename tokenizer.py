@@ -0,0 +1,188 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import tiktoken
+
+# Encoders already loaded in this process, keyed by model name
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+# Encoding used for model names tiktoken does not know about
+DEFAULT_ENCODING_NAME = "cl100k_base"
+
+
+def get_encoding(model="gpt-3.5-turbo"):
+    """
+    Returns the tiktoken encoder of a model. Each encoder is loaded lazily the first time it is requested
+    and then shared by every caller in the process, so constructing conversations never repeats the lookup.
+    The function is safe to call from several threads.
+    :param model: Optional parameter, the name of the model, default is 'gpt-3.5-turbo'.
+    :return: The tiktoken Encoding object of the model.
+    """
+    encoding = _encodings.get(model)
+    if encoding is not None:
+        return encoding
+
+    with _encodings_lock:
+        # Another thread may have loaded the encoder while we were waiting for the lock
+        encoding = _encodings.get(model)
+        if encoding is None:
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoding = tiktoken.get_encoding(DEFAULT_ENCODING_NAME)
+            _encodings[model] = encoding
+
+    return encoding
+
+
+def count_tokens(text, model="gpt-3.5-turbo"):
+    """
+    Counts the tokens of a string with the shared encoder of a model.
+    :param text: Required parameter, the string to be counted.
+    :param model: Optional parameter, the name of the model, default is 'gpt-3.5-turbo'.
+    :return: The number of tokens.
+    """
+    return len(get_encoding(model).encode(text))
+
+
+class TokenCache:
+    """
+    Content-hash-keyed token cache for static documents such as telco_data_dictionary.md, persisted on local disk so that
+    new sessions and worker processes skip tokenizing documents that any process has already seen.
+    Entries are keyed by the SHA-256 of the encoding name and the text, so a changed document simply misses.
+    Each entry is a small JSON file written atomically, which makes the directory safe to share between processes.
+    """
+
+    def __init__(self, cache_dir=None, store_tokens=False):
+        """
+        :param cache_dir: Optional parameter, the cache directory. Defaults to the MATEGEN_TOKEN_CACHE_DIR environment variable,
+        or ~/.cache/mategen/tokens.
+        :param store_tokens: Optional parameter, whether to also store the token arrays so that encode() can skip tokenizing, default is False.
+        """
+        if cache_dir is None:
+            cache_dir = os.getenv('MATEGEN_TOKEN_CACHE_DIR', os.path.join('~', '.cache', 'mategen', 'tokens'))
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.store_tokens = store_tokens
+        self._memory = {}
+        self._lock = threading.Lock()
+        self.hits = 0  # Lookups answered from memory or disk
+        self.disk_hits = 0  # Part of the hits that had to be read from disk
+        self.misses = 0  # Lookups that had to tokenize the text
+
+    def _key(self, text, encoding):
+        return hashlib.sha256(f"{encoding.name}\0{text}".encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def _load(self, key):
+        entry = self._memory.get(key)
+        if entry is not None:
+            return entry, False
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None, False
+        self._memory[key] = entry
+        return entry, True
+
+    def _save(self, key, entry):
+        self._memory[key] = entry
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so that concurrent readers never see a partial entry
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            # The disk cache is an optimization only; keep working from memory if it cannot be written
+            pass
+
+    def _lookup(self, text, model, need_tokens):
+        encoding = get_encoding(model)
+        key = self._key(text, encoding)
+        with self._lock:
+            entry, from_disk = self._load(key)
+            if entry is not None and (not need_tokens or 'tokens' in entry):
+                self.hits += 1
+                self.disk_hits += from_disk
+                return entry
+
+        tokens = encoding.encode(text)
+        entry = {"tokens_count": len(tokens)}
+        if self.store_tokens or need_tokens:
+            entry["tokens"] = tokens
+        with self._lock:
+            self.misses += 1
+            self._save(key, entry)
+        return entry
+
+    def count(self, text, model="gpt-3.5-turbo"):
+        """
+        Counts the tokens of a document, tokenizing it only if no process has cached it before.
+        :param text: Required parameter, the document text.
+        :param model: Optional parameter, the name of the model, default is 'gpt-3.5-turbo'.
+        :return: The number of tokens.
+        """
+        return self._lookup(text, model, need_tokens=False)["tokens_count"]
+
+    def encode(self, text, model="gpt-3.5-turbo"):
+        """
+        Returns the token array of a document, tokenizing it only if it is not cached with its tokens.
+        :param text: Required parameter, the document text.
+        :param model: Optional parameter, the name of the model, default is 'gpt-3.5-turbo'.
+        :return: The list of token ids.
+        """
+        return list(self._lookup(text, model, need_tokens=True)["tokens"])
+
+    def stats(self):
+        """
+        :return: A dict with the hit, disk hit and miss counters and the hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    # Method to forget the entries held in memory; the disk entries are kept
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+
+def get_token_cache():
+    """
+    Returns the process-wide TokenCache used for system documents, creating it on first use.
+    :return: The shared TokenCache object.
+    """
+    global _token_cache
+    if _token_cache is None:
+        with _token_cache_lock:
+            if _token_cache is None:
+                _token_cache = TokenCache()
+    return _token_cache
+
+
+def count_document_tokens(text, model="gpt-3.5-turbo"):
+    """
+    Counts the tokens of a static document through the shared disk-backed TokenCache.
+    :param text: Required parameter, the document text.
+    :param model: Optional parameter, the name of the model, default is 'gpt-3.5-turbo'.
+    :return: The number of tokens.
+    """
+    return get_token_cache().count(text, model)
+
+
+if __name__ == '__main__':
+    print("This file defines the process-wide tiktoken encoder registry and the document token cache.")
@@ -1,6 +1,4 @@
-import os
 import json
-import pymysql
 import pandas as pd
 from googleapiclient.errors import HttpError
 from googleapiclient.discovery import build
@@ -12,36 +10,47 @@ import matplotlib
 import seaborn as sns
 import numpy as np
 import inspect
-import openai
-import time
+import threading
+from rate_limiter import call_with_retries
+from llm_backend import chat_completion
+from response_cache import cached_chat_completion, is_valid_json_content
+from db import stream_query
+from sql_results import summarize_query
+from sql_cache import cached_sql_query
+from sql_guard import guard_query
+from dataframes import load_dataframe
+from sql_timeout import QueryTimeout
 
 
 def sql_inter(sql_query, g='globals()'):
     """
-    Executes an SQL query and returns the results. This function connects to a MySQL database, executes the query provided, and retrieves the output.
+    Executes an SQL query and returns the results. This function takes a connection to the MySQL database from the shared pool, executes the query provided, and retrieves the output.
+    Rows are streamed from the server, so memory stays flat whatever the size of the result: a small result is returned in full,
+    a large one as its exact row count, its first and last rows and statistics of each column.
+    Queries are checked with EXPLAIN first: a query that would examine too many rows runs with a LIMIT when its rows can be
+    streamed, and is otherwise not run and the estimated cost is returned instead. A query running longer than the query timeout is cancelled on the server,
+    and a result with the status 'timeout' is returned so the query can be rewritten.
 
     :param sql_query: A string containing the SQL query to be executed on the telco_db database.
     :param g: Environment variable, default is 'globals()'.
     :return: The result of the executed SQL query as a JSON string.
     """
-    mysql_pw = os.getenv('MYSQL_PW')
-
-    connection = pymysql.connect(
-        host='localhost',
-        user='root',
-        passwd=mysql_pw,
-        db='telco_db',
-        charset='utf8'
-    )
-
+    def run():
+        # Queries over the cost budget are not run: the model gets the guard's explanation instead
+        decision = guard_query(sql_query, exploratory=True)
+        if not decision.allowed:
+            return decision.to_json()
+        summary = summarize_query(stream_query(decision.sql_query))
+        if decision.limit is not None and summary.row_count >= decision.limit:
+            summary.truncate()
+        return summary.to_json()
+
+    # Repeated queries are answered from the shared cache while the tables they read are unchanged;
+    # a timeout depends on the load of the server, so it is raised through the cache rather than cached
     try:
-        with connection.cursor() as cursor:
-            cursor.execute(sql_query)
-            results = cursor.fetchall()
-    finally:
-        connection.close()
-
-    return json.dumps(results)
+        return cached_sql_query(sql_query, run)
+    except QueryTimeout as e:
+        return e.to_json()
 
 
 def extract_data(sql_query, df_name, g='globals()'):
@@ -51,21 +60,30 @@ def extract_data(sql_query, df_name, g='globals()'):
     :param sql_query: A string containing the SQL query used to extract data from the MySQL database.
     :param df_name: A string specifying the variable name under which the retrieved table will be stored.
     :param g: Environment variable, default is 'globals()'.
-    :return: Confirmation message on successful data extraction and saving.
+    :return: Confirmation message on successful data extraction and saving, with the size of the table in memory,
+    the estimated cost of the query if it is too costly to load, or a result with the status 'timeout' if the query was
+    cancelled after the query timeout.
     """
-    mysql_pw = os.getenv('MYSQL_PW')
+    decision = guard_query(sql_query, exploratory=False)
+    if not decision.allowed:
+        return decision.to_json()
 
-    connection = pymysql.connect(
-        host='localhost',
-        user='root',
-        passwd=mysql_pw,
-        db='telco_db',
-        charset='utf8'
-    )
+    # Streamed in chunks, with low-cardinality text stored as category and numbers downcast
+    try:
+        g[df_name], report = load_dataframe(sql_query)
+    except QueryTimeout as e:
+        return e.to_json()
 
-    g[df_name] = pd.read_sql(sql_query, connection)
+    return f"Successfully created the variable: {df_name} ({report})"
 
-    return f"Successfully created the variable: {df_name}"
+
+# The SQL tools only share the connection pool and the caches, which are thread-safe, so the parallel tool calls of
+# one model turn may run them concurrently; the Python tools run one at a time
+sql_inter.thread_safe = True
+extract_data.thread_safe = True
+
+# pyplot and the matplotlib backend are global to the process, so figures are drawn by one session at a time
+_figure_lock = threading.Lock()
 
 
 def python_inter(py_code, g='globals()'):
@@ -136,21 +154,22 @@ def fig_inter(py_code, fname, g='globals()'):
     :param g: Environment variable, default is 'globals()'.
     :return: Result of the executed code and a link to the generated image if successfully uploaded.
     """
-    current_backend = matplotlib.get_backend()
-    matplotlib.use('Agg')
+    with _figure_lock:
+        current_backend = matplotlib.get_backend()
+        matplotlib.use('Agg')
 
-    import matplotlib.pyplot as plt
-    import pandas as pd
-    import seaborn as sns
+        import matplotlib.pyplot as plt
+        import pandas as pd
+        import seaborn as sns
 
-    local_vars = {"plt": plt, "pd": pd, "sns": sns}
+        local_vars = {"plt": plt, "pd": pd, "sns": sns}
 
-    try:
-        exec(py_code, g, local_vars)
-    except Exception as e:
-        return f"Error during execution: {e}"
-
-    matplotlib.use(current_backend)
+        try:
+            exec(py_code, g, local_vars)
+        except Exception as e:
+            return f"Error during execution: {e}"
+        finally:
+            matplotlib.use(current_backend)
     fig = local_vars[fname]
 
     try:
@@ -206,13 +225,17 @@ def auto_functions(functions_list):
                 f"Now, there is another function called '{function_name}' with description: '{function_description}'. "
                 "Please generate a function object for this function in the same format.")
 
-            response = openai.ChatCompletion.create(
+            messages = [
+                {"role": "user", "name": "example_user", "content": user_prompt},
+                {"role": "assistant", "name": "example_assistant", "content": assistant_message}
+            ]
+            # Descriptions of unchanged functions are served from the response cache; invalid JSON is never cached
+            response = cached_chat_completion(
+                lambda: call_with_retries(lambda: chat_completion(model="gpt-4-0613", messages=messages),
+                                          model="gpt-4-0613"),
                 model="gpt-4-0613",
-                messages=[
-                    {"role": "user", "name": "example_user", "content": user_prompt},
-                    {"role": "assistant", "name": "example_assistant", "content": assistant_message}
-                ]
-            )
+                messages=messages,
+                validate=is_valid_json_content)
             functions.append(json.loads(response.choices[0].message['content']))
         return functions
 
@@ -222,8 +245,8 @@ def auto_functions(functions_list):
             return generate_function_descriptions(functions_list)
         except Exception as e:
             attempts += 1
-            print(f"Error: {e}. Retrying after 1 minute.")
-            time.sleep(60)
+            # API errors are already retried with backoff by call_with_retries; this retries invalid descriptions
+            print(f"Error: {e}. Retrying...")
             if attempts == 3:
                 raise Exception("Maximum retry attempts reached.")
 
@@ -0,0 +1,243 @@
+from bisect import bisect_left
+from itertools import accumulate
+
+
+class TokenIndex:
+    """
+    Prefix-sum index over the token counts of the conversation messages. It answers "how many tokens do the
+    first k messages hold" in O(1) and "how many of the oldest messages must go to free n tokens" in O(log n),
+    which is what the trimming policies need to pick a cut point without popping messages one by one.
+    """
+
+    def __init__(self, tokens=()):
+        # _prefix[i] - _prefix[0] is the number of tokens held by the first i messages
+        self._prefix = list(accumulate(tokens, initial=0))
+
+    def __len__(self):
+        return len(self._prefix) - 1
+
+    def __iter__(self):
+        prefix = self._prefix
+        return (prefix[i + 1] - prefix[i] for i in range(len(prefix) - 1))
+
+    def _normalize(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError("TokenIndex index out of range")
+        return index % len(self)
+
+    # Method to get the total number of indexed tokens
+    def total(self):
+        return self._prefix[-1] - self._prefix[0]
+
+    # Method to get the token count of a single message
+    def tokens(self, index):
+        index = self._normalize(index)
+        return self._prefix[index + 1] - self._prefix[index]
+
+    # Method to get the number of tokens held by the first k messages
+    def prefix(self, k):
+        return self._prefix[k] - self._prefix[0]
+
+    # Method to find the smallest k such that the first k messages hold at least `needed` tokens
+    def find_cut(self, needed):
+        return min(bisect_left(self._prefix, self._prefix[0] + needed), len(self))
+
+    def append(self, tokens):
+        self._prefix.append(self._prefix[-1] + tokens)
+
+    def extend(self, tokens_list):
+        for tokens in tokens_list:
+            self.append(tokens)
+
+    def pop(self, index=-1):
+        index = self._normalize(index)
+        tokens = self.tokens(index)
+        if index == len(self) - 1:
+            self._prefix.pop()
+        else:
+            self.remove([index])
+        return tokens
+
+    # Method to replace the token count of one message
+    def set(self, index, tokens):
+        index = self._normalize(index)
+        delta = tokens - self.tokens(index)
+        if delta:
+            prefix = self._prefix
+            prefix[index + 1:] = [value + delta for value in prefix[index + 1:]]
+
+    # Method to drop the first k messages; the remaining prefix sums stay valid against the new base
+    def drop_prefix(self, k):
+        del self._prefix[:k]
+
+    # Method to remove several messages at once with a single rebuild
+    def remove(self, indices):
+        indices = set(indices)
+        self._prefix = list(accumulate((tokens for i, tokens in enumerate(self) if i not in indices), initial=0))
+
+    def copy(self):
+        new_index = TokenIndex.__new__(TokenIndex)
+        new_index._prefix = list(self._prefix)
+        return new_index
+
+
+def is_function_call(message):
+    return bool(message.get("function_call") or message.get("tool_calls"))
+
+
+def is_function_response(message):
+    return message.get("role") in ("function", "tool")
+
+
+def find_current_question(history_messages):
+    """
+    Finds the position of the question currently being answered, i.e. the last user message.
+    :param history_messages: Required parameter, the list of conversation messages.
+    :return: The index of the last user message, or None if there is no user message.
+    """
+    for index in range(len(history_messages) - 1, -1, -1):
+        if history_messages[index].get("role") == "user":
+            return index
+    return None
+
+
+def pair_function_messages(history_messages, indices):
+    """
+    Extends a set of message positions so that a `function_call` (or `tool_calls`) message and the `function` (or `tool`)
+    responses that follow it are always removed together; the Chat model rejects a response whose call is missing.
+    :param history_messages: Required parameter, the list of conversation messages.
+    :param indices: Required parameter, a set of positions to be removed; it is extended in place.
+    :return: The extended set of positions.
+    """
+    for index in list(indices):
+        if is_function_call(history_messages[index]):
+            next_index = index + 1
+            while next_index < len(history_messages) and is_function_response(history_messages[next_index]):
+                indices.add(next_index)
+                next_index += 1
+        elif is_function_response(history_messages[index]):
+            previous_index = index - 1
+            while previous_index >= 0 and is_function_response(history_messages[previous_index]):
+                indices.add(previous_index)
+                previous_index -= 1
+            if previous_index >= 0 and is_function_call(history_messages[previous_index]):
+                indices.add(previous_index)
+    return indices
+
+
+class TrimPolicy:
+    """
+    Base class of the context trimming policies used by ChatMessages. System messages are stored apart from the
+    conversation and are never trimmed; the current question is pinned as well. A policy only has to say which
+    conversation messages to drop to free a number of tokens.
+    """
+
+    def select(self, history_messages, token_index, needed, current_question=None):
+        """
+        Chooses the conversation messages to remove.
+        :param history_messages: Required parameter, the list of conversation messages.
+        :param token_index: Required parameter, the TokenIndex of the conversation messages.
+        :param needed: Required parameter, the number of tokens that must be freed.
+        :param current_question: Optional parameter, the position of the current question if the caller already knows it.
+        Defaults to None, in which case it is looked up with find_current_question.
+        :return: A set of positions in `history_messages` to be removed.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _pinned(history_messages, current_question):
+        return current_question if current_question is not None else find_current_question(history_messages)
+
+    # Method to drop the oldest unpinned messages until `needed` tokens are freed, skipping positions in `exclude`
+    @staticmethod
+    def _oldest_first(history_messages, token_index, needed, pinned, exclude=frozenset()):
+        if needed <= 0:
+            return set()
+
+        # Without exclusions the cut point is a single binary search over the prefix sums
+        if not exclude:
+            cut = token_index.find_cut(needed)
+            if pinned is not None and pinned < cut:
+                cut = token_index.find_cut(needed + token_index.tokens(pinned))
+            indices = set(range(cut))
+            indices.discard(pinned)
+            return indices
+
+        indices = set()
+        freed = 0
+        for index in range(len(history_messages)):
+            if freed >= needed:
+                break
+            if index == pinned or index in exclude:
+                continue
+            indices.add(index)
+            freed += token_index.tokens(index)
+        return indices
+
+
+class OldestFirstPolicy(TrimPolicy):
+    """
+    Drops the oldest conversation messages first.
+    """
+
+    def select(self, history_messages, token_index, needed, current_question=None):
+        pinned = self._pinned(history_messages, current_question)
+        indices = self._oldest_first(history_messages, token_index, needed, pinned)
+        return pair_function_messages(history_messages, indices)
+
+
+class FunctionResultsFirstPolicy(TrimPolicy):
+    """
+    Drops function calls and their results first, oldest first, since they are usually the bulkiest messages and
+    the model's own answers already summarize them. Falls back to the oldest messages if that is not enough.
+    """
+
+    def select(self, history_messages, token_index, needed, current_question=None):
+        pinned = self._pinned(history_messages, current_question)
+        indices = set()
+        freed = 0
+        for index, message in enumerate(history_messages):
+            if freed >= needed:
+                break
+            if index in indices or not (is_function_call(message) or is_function_response(message)):
+                continue
+            group = pair_function_messages(history_messages, {index})
+            indices |= group
+            freed += sum(token_index.tokens(i) for i in group)
+
+        indices |= self._oldest_first(history_messages, token_index, needed - freed, pinned, exclude=indices)
+        return pair_function_messages(history_messages, indices)
+
+
+class KeepLastTurnsPolicy(TrimPolicy):
+    """
+    Keeps only the last `num_turns` turns (a turn starts with a user message), then falls back to the oldest
+    messages within them if the conversation is still too long.
+    """
+
+    def __init__(self, num_turns=3):
+        if num_turns < 1:
+            raise ValueError(f"Invalid num_turns value: {num_turns}")
+        self.num_turns = num_turns
+
+    def select(self, history_messages, token_index, needed, current_question=None):
+        pinned = self._pinned(history_messages, current_question)
+
+        # Find where the oldest kept turn starts
+        turns = 0
+        start = 0
+        for index in range(len(history_messages) - 1, -1, -1):
+            if history_messages[index].get("role") == "user":
+                turns += 1
+                if turns == self.num_turns:
+                    start = index
+                    break
+
+        indices = set(range(start))
+        freed = token_index.prefix(start)
+        indices |= self._oldest_first(history_messages, token_index, needed - freed, pinned, exclude=indices)
+        return pair_function_messages(history_messages, indices)
+
+
+if __name__ == '__main__':
+    print("This file defines the context trimming policies used by ChatMessages.")